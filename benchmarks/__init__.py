@@ -0,0 +1,3 @@
+"""
+Offline benchmarks for the reminder hot paths
+"""
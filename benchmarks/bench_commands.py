@@ -0,0 +1,75 @@
+"""
+Micro-benchmark the inbound sms command parser. Each sample times parsing a batch
+of messages, so the reported latencies are milliseconds per batch.
+
+    python -m benchmarks.bench_commands [--batch 1000] [--iterations 200]
+                                        [--update-baseline] [--check]
+"""
+from argparse import ArgumentParser
+from time import perf_counter
+import sys
+
+from reminder.commands import parse_command
+
+from .common import summarize, report, load_baseline, save_baseline
+
+MESSAGES = {
+    "yes": ["yes", "Y", " Yes! ", "👍"],
+    "no": ["no", "N", "No.", "👎🏻"],
+    "keyword": ["STOP", "help", "Skip", "swap"],
+    "garbage": ["can we talk about this later?", "blah", "🤷‍♂️", "no problem"],
+}
+
+def _legacy_parse(body:str) -> str:
+    """
+    The check Rotation.receive made before the parser, kept as a reference
+    """
+    positive_responses = ["y","yes"]
+    negative_responses = ["n", "no"]
+    if body.lower() not in positive_responses + negative_responses:
+        return "unknown"
+    return "yes" if body.lower() in positive_responses else "no"
+
+def _time_batch(parse, messages:list[str], batch:int) -> float:
+    start = perf_counter()
+    for index in range(batch):
+        parse(messages[index % len(messages)])
+    return (perf_counter() - start) * 1000
+
+def run_scenarios(batch:int, iterations:int) -> dict:
+    """
+    Time the parser with and without its cache, and the check it replaced,
+    on each kind of message
+    """
+    parsers = {"parse": parse_command.__wrapped__, "parse_cached": parse_command,
+               "legacy": _legacy_parse}
+    results = {}
+    for kind, messages in MESSAGES.items():
+        for name, parse in parsers.items():
+            timings = [_time_batch(parse, messages, batch) for _ in range(iterations)]
+            results[f"commands/{name}/{kind}/{batch}"] = summarize(timings)
+    return results
+
+def main(argv:list[str] = None) -> int:
+    """
+    Run the benchmark, compare it with the stored baseline and optionally update it
+    """
+    parser = ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--batch", type=int, default=1000,
+                        help="messages parsed per sample")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--tolerance", type=float, default=0.5,
+                        help="allowed p50 slowdown against the baseline")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true",
+                        help="exit with an error when the parser got slower")
+    args = parser.parse_args(argv)
+
+    results = run_scenarios(args.batch, args.iterations)
+    regressions = report(results, load_baseline("commands"), args.tolerance)
+    if args.update_baseline:
+        save_baseline("commands", results)
+    return 1 if args.check and regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
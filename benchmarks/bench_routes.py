@@ -0,0 +1,121 @@
+"""
+Benchmark /send_reminders and /receive_sms through the Flask test client
+against local stand-ins for firestore and twilio.
+
+    python -m benchmarks.bench_routes [--storage-latency-ms 5] [--twilio-latency-ms 20]
+                                      [--iterations 50] [--update-baseline] [--check]
+"""
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from os import environ
+from time import time
+from unittest.mock import patch
+import sys
+
+from twilio.request_validator import RequestValidator
+
+from reminder import app
+from reminder.third_party_interfaces import NULL_DATETIME, ROTATION_QUEUE, Record, \
+                                            build_rotation_queue, SmsSender
+
+from .common import measure, report, load_baseline, save_baseline
+from .fakes import LatencyBackend, FakeTwilioClient
+
+COLLECTION = "benchmark"
+HOUSEHOLD_SIZES = [3, 25]
+
+def _phone_number(index:int) -> str:
+    return f"+1555{index:07d}"
+
+def _seed(backend:LatencyBackend, household_size:int, attempted:bool) -> None:
+    """
+    Reset the household and its rotation queue, as left by activating the reminder.
+    The first user has always just been sent the reminder.
+    """
+    users = {
+        _phone_number(index): {
+            "name": f"User {index}",
+            "last_completed": datetime(2023, 1, 1) + timedelta(days=index),
+            "last_attempted": datetime.now() if attempted or index == 0 else NULL_DATETIME,
+            "last_response": "",
+        } for index in range(household_size)
+    }
+    queue = build_rotation_queue(Record(phone_number, user) for phone_number, user in users.items())
+    backend._collections = {  # pylint: disable=protected-access
+        "reminders": {COLLECTION: {"name": "Benchmark", "status": "active",
+                                   ROTATION_QUEUE: queue}},
+        COLLECTION: users,
+        "phone_index": {_phone_number(index): {"collections": [COLLECTION]}
+                        for index in range(household_size)},
+    }
+
+def _send_reminders(client) -> None:
+    response = client.post("/send_reminders",
+                           json={"message": {"attributes": {"collection": COLLECTION}}},
+                           headers={"Authorization": "bearer token"})
+    assert response.status_code == 200, response.status_code
+
+def _receive_sms(client, body:str) -> None:
+    form = {"From": _phone_number(0), "Body": body}
+    signature = RequestValidator(environ["TWILIO_AUTH_TOKEN"]) \
+        .compute_signature("https://localhost/receive_sms", form)
+    response = client.post("/receive_sms", data=form,
+                           headers={"X-TWILIO-SIGNATURE": signature})
+    assert response.status_code == 200, response.status_code
+
+def run_scenarios(storage_latency:float, twilio_latency:float, iterations:int) -> dict:
+    """
+    Run every scenario and return its latency summary
+    """
+    backend = LatencyBackend(storage_latency)
+    twilio = FakeTwilioClient(twilio_latency)
+    claim = {"aud": "https://localhost/send_reminders", "email": environ.get("PUBSUB_USER"),
+             "email_verified": True, "exp": time() + 3600}
+    client = app.test_client()
+    # the stand-in has no account limit, so only the sender's own overhead is measured
+    sender = SmsSender(rate=1e9)
+
+    results = {}
+    with patch("reminder.third_party_interfaces.backend.get_backend", return_value=backend), \
+         patch("reminder.third_party_interfaces.twilio_client.get_twilio_client",
+               return_value=twilio), \
+         patch("reminder.third_party_interfaces.twilio_client.get_sms_sender",
+               return_value=sender), \
+         patch("reminder.main.verify_token", return_value=claim):
+        for size in HOUSEHOLD_SIZES:
+            results[f"send_reminders/next_user/{size}"] = measure(
+                lambda: _send_reminders(client), iterations,
+                setup=lambda size=size: _seed(backend, size, attempted=False))
+            results[f"send_reminders/broadcast/{size}"] = measure(
+                lambda: _send_reminders(client), iterations,
+                setup=lambda size=size: _seed(backend, size, attempted=True))
+            for body in ["yes", "no", "garbage"]:
+                results[f"receive_sms/{body}/{size}"] = measure(
+                    lambda body=body: _receive_sms(client, body), iterations,
+                    setup=lambda size=size: _seed(backend, size, attempted=False))
+    return results
+
+def main(argv:list[str] = None) -> int:
+    """
+    Run the benchmark, compare it with the stored baseline and optionally update it
+    """
+    parser = ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--storage-latency-ms", type=float, default=5)
+    parser.add_argument("--twilio-latency-ms", type=float, default=20)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed p50 slowdown against the baseline")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true",
+                        help="exit with an error when a scenario regressed")
+    args = parser.parse_args(argv)
+
+    results = run_scenarios(args.storage_latency_ms / 1000, args.twilio_latency_ms / 1000,
+                            args.iterations)
+    regressions = report(results, load_baseline("routes"), args.tolerance)
+    if args.update_baseline:
+        save_baseline("routes", results)
+    return 1 if args.check and regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
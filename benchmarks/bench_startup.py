@@ -0,0 +1,75 @@
+"""
+Benchmark cold start: import the application in fresh interpreters with
+python -X importtime and report the cumulative import time per module.
+
+    python -m benchmarks.bench_startup [--iterations 10] [--top 15]
+                                       [--update-baseline] [--check]
+"""
+from argparse import ArgumentParser
+from os import environ
+from pathlib import Path
+import subprocess
+import sys
+
+from .common import summarize, report, load_baseline, save_baseline
+
+ROOT = Path(__file__).parent.parent
+TRACKED_MODULES = ["reminder", "reminder.main", "reminder.rotation",
+                   "reminder.third_party_interfaces", "flask", "google.cloud.firestore",
+                   "google.cloud.logging", "google.oauth2.id_token", "twilio.rest"]
+
+def import_times() -> dict[str, float]:
+    """
+    Import reminder in a new interpreter and return the cumulative
+    import time of every module in milliseconds
+    """
+    env = {**environ, "CLOUD_LOGGING": "False"}
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import reminder"],
+                            cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        times[module.strip()] = int(cumulative) / 1000
+    return times
+
+def run_scenarios(iterations:int, top:int) -> dict:
+    """
+    Import the application repeatedly, print the slowest modules of the median
+    run and return latency summaries for the tracked modules
+    """
+    runs = [import_times() for _ in range(iterations)]
+    runs.sort(key=lambda times: times["reminder"])
+    median = runs[len(runs) // 2]
+    print(f"{'module':60} {'cumulative ms':>14}")
+    for module, cumulative in sorted(median.items(), key=lambda item: -item[1])[:top]:
+        print(f"{module:60} {cumulative:>14.1f}")
+    print()
+
+    return {f"import/{module}": summarize([times.get(module, 0.0) for times in runs])
+            for module in TRACKED_MODULES}
+
+def main(argv:list[str] = None) -> int:
+    """
+    Run the benchmark, compare it with the stored baseline and optionally update it
+    """
+    parser = ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--top", type=int, default=15,
+                        help="how many of the slowest modules to list")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed p50 slowdown against the baseline")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true",
+                        help="exit with an error when a module got slower to import")
+    args = parser.parse_args(argv)
+
+    results = run_scenarios(args.iterations, args.top)
+    regressions = report(results, load_baseline("startup"), args.tolerance)
+    if args.update_baseline:
+        save_baseline("startup", results)
+    return 1 if args.check and regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+"""
+Timing, percentile reporting and baseline comparison shared by the benchmarks
+"""
+from json import dumps, loads
+from pathlib import Path
+from statistics import quantiles
+from time import perf_counter
+from typing import Callable
+
+BASELINE_DIR = Path(__file__).parent / "baselines"
+
+def measure(run:Callable[[], None], iterations:int, setup:Callable[[], None] = None) -> dict:
+    """
+    Time run over a number of iterations, calling setup untimed before each one,
+    and summarise latency percentiles in milliseconds and throughput per second
+    """
+    timings = []
+    for _ in range(iterations):
+        if setup is not None:
+            setup()
+        start = perf_counter()
+        run()
+        timings.append((perf_counter() - start) * 1000)
+    return summarize(timings)
+
+def summarize(timings:list[float]) -> dict:
+    """
+    Summarise latency percentiles of timings in milliseconds and throughput per second
+    """
+    cuts = quantiles(timings, n=100, method="inclusive")
+    total = sum(timings)
+    return {
+        "p50": round(cuts[49], 3),
+        "p95": round(cuts[94], 3),
+        "p99": round(cuts[98], 3),
+        "throughput": round(len(timings) / (total / 1000), 1) if total else 0.0,
+    }
+
+def report(results:dict[str, dict], baseline:dict[str, dict] = None,
+           tolerance:float = 0.2) -> list[str]:
+    """
+    Print one line per scenario and return the scenarios whose p50 regressed
+    by more than tolerance against the baseline
+    """
+    baseline = baseline or {}
+    regressions = []
+    print(f"{'scenario':40} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'req/s':>10}")
+    for scenario, result in results.items():
+        line = f"{scenario:40} {result['p50']:>10} {result['p95']:>10} " + \
+               f"{result['p99']:>10} {result['throughput']:>10}"
+        previous = baseline.get(scenario)
+        if previous is not None and result["p50"] > previous["p50"] * (1 + tolerance):
+            regressions.append(scenario)
+            line += f"  REGRESSION (baseline p50 {previous['p50']})"
+        print(line)
+    return regressions
+
+def load_baseline(name:str) -> dict:
+    """
+    Return the stored baseline for a benchmark, or an empty one
+    """
+    path = BASELINE_DIR / f"{name}.json"
+    return loads(path.read_text()) if path.exists() else {}
+
+def save_baseline(name:str, results:dict) -> None:
+    """
+    Store results as the new baseline for a benchmark
+    """
+    BASELINE_DIR.mkdir(exist_ok=True)
+    (BASELINE_DIR / f"{name}.json").write_text(dumps(results, indent=2, sort_keys=True) + "\n")
@@ -0,0 +1,87 @@
+"""
+Local stand-ins for firestore and twilio with injectable network latency
+"""
+from time import sleep
+from types import SimpleNamespace
+
+from reminder.third_party_interfaces import MemoryBackend, Record
+
+class LatencyBackend(MemoryBackend):
+    """
+    In-memory backend that sleeps for one simulated round trip per document operation
+    """
+    def __init__(self, latency:float) -> None:
+        super().__init__()
+        self.latency = latency
+        self.round_trips = 0
+
+    def _round_trip(self) -> None:
+        self.round_trips += 1
+        sleep(self.latency)
+
+    def get_document(self, collection, document_id):
+        self._round_trip()
+        return super().get_document(collection, document_id)
+
+    def set_document(self, collection, document_id, data, merge=False):
+        self._round_trip()
+        super().set_document(collection, document_id, data, merge)
+
+    def create_document(self, collection, document_id, data):
+        self._round_trip()
+        return super().create_document(collection, document_id, data)
+
+    def update_document(self, collection, document_id, data):
+        self._round_trip()
+        super().update_document(collection, document_id, data)
+
+    def delete_document(self, collection, document_id):
+        self._round_trip()
+        super().delete_document(collection, document_id)
+
+    def stream_documents(self, collection):
+        self._round_trip()
+        return super().stream_documents(collection)
+
+    def write_documents(self, writes):
+        self._round_trip()
+        self._apply(writes)
+
+    def _apply(self, writes) -> None:
+        with self._lock:
+            for collection, document_id, data in writes:
+                if data is None:
+                    MemoryBackend.delete_document(self, collection, document_id)
+                else:
+                    MemoryBackend.set_document(self, collection, document_id, data, True)
+
+    def get_documents(self, keys):
+        # one get_all call
+        self._round_trip()
+        return {key: Record(key[1], MemoryBackend.get_document(self, *key)) for key in keys}
+
+    def commit_documents(self, writes, read):
+        # one batch commit, its preconditions checked by the server
+        self._round_trip()
+        with self._lock:
+            for collection, document_id, _ in writes:
+                record = read.get((collection, document_id))
+                if record is not None and record.to_dict() != \
+                    MemoryBackend.get_document(self, collection, document_id):
+                    return False
+            self._apply(writes)
+            return True
+
+class FakeTwilioClient:  # pylint: disable=too-few-public-methods
+    """
+    Twilio client whose messages.create sleeps for one simulated API call
+    """
+    def __init__(self, latency:float) -> None:
+        self.latency = latency
+        self.sent = []
+        self.messages = SimpleNamespace(create=self._create)
+
+    def _create(self, body:str, from_:str, to:str, **kwargs):
+        sleep(self.latency)
+        self.sent.append((from_, to, body))
+        return SimpleNamespace(sid=f"SM{len(self.sent):032d}", **kwargs)
@@ -0,0 +1,29 @@
+"""
+Gunicorn settings. Set WARMUP_ENABLED to warm each worker up before it takes requests
+and SCHEDULER_ENABLED to run the reminder scheduler in each worker.
+Buffered sms delivery states and reminder events are written when a worker exits.
+"""
+# pylint: disable=unused-argument
+
+def post_fork(server, worker):
+    """
+    Open connections in the new worker; shared clients never cross a fork.
+    The app is imported here rather than at the top so the master never creates clients.
+    """
+    # pylint: disable=import-outside-toplevel
+    from reminder.warmup import warm_up, warmup_enabled
+    from reminder.scheduler import get_scheduler, scheduler_enabled
+    if warmup_enabled():
+        warm_up()
+    if scheduler_enabled():
+        get_scheduler().start()
+
+def worker_exit(server, worker):
+    """
+    Write delivery states and reminder events still buffered when the worker stops
+    """
+    # pylint: disable=import-outside-toplevel
+    from reminder.delivery import get_status_buffer
+    from reminder.events import get_event_log
+    get_status_buffer().flush()
+    get_event_log().flush()
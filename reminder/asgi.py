@@ -0,0 +1,162 @@
+"""
+ASGI entry point serving the pub/sub and twilio routes on the async clients,
+so one worker can hold hundreds of concurrent requests while they wait on the network.
+Serve it with any ASGI server, for example: uvicorn reminder.asgi:app
+"""
+from asyncio import to_thread
+from json import loads
+from time import perf_counter
+from typing import Optional
+from urllib.parse import parse_qsl
+import logging
+
+from .async_rotation import AsyncRotation, async_find_collection
+from .commands import parse_command
+from .delivery import get_status_buffer
+from .dedup import get_deduplicator
+from .main import authenticate
+from .third_party_interfaces import observe, metrics_enabled, validate_twilio_request
+from .warmup import warm_up, warmup_enabled
+
+class Request:  # pylint: disable=too-few-public-methods
+    """
+    The parts of an ASGI http request the routes need
+    """
+    def __init__(self, scope:dict, body:bytes) -> None:
+        self.method = scope["method"]
+        self.path = scope["path"]
+        self.headers = {name.decode("latin-1").lower(): value.decode("latin-1")
+                        for name, value in scope["headers"]}
+        self.query_string = scope.get("query_string", b"").decode("latin-1")
+        self.body = body
+
+    def url(self, scheme:str = "http") -> str:
+        """
+        The full request url, including the query string
+        """
+        url = f"{scheme}://{self.headers.get('host', 'localhost')}{self.path}"
+        return f"{url}?{self.query_string}" if self.query_string else url
+
+async def hello(_request:Request) -> tuple[int, str]:
+    """
+    Hello World reponse for testing
+    """
+    return 200, "Hello World"
+
+async def send_reminders(request:Request) -> tuple[int, str]:
+    '''
+    Call this from pub/sub subscription
+    Redelivered messages are acknowledged without sending anything again
+    '''
+    if not await to_thread(authenticate, request.headers.get("authorization"),
+                           request.url()):
+        return 401, "Unauthorized"
+
+    message:dict = loads(request.body.decode("utf-8")).get("message", {})
+    attributes:dict = message.get("attributes", {})
+    collection = attributes.get("collection")
+
+    message_id = message.get("messageId") or message.get("message_id")
+    deduplicator = get_deduplicator()
+    if message_id and not await to_thread(deduplicator.claim, message_id):
+        logging.info("Skipping duplicate pub/sub message %s", message_id)
+        return 200, "OK"
+
+    try:
+        rotation = await AsyncRotation.open(collection, attributes.get("status"))
+        logging.info("Sending rotation: %s", collection)
+        await rotation.send_reminder(collection)
+    except Exception:
+        if message_id:
+            await to_thread(deduplicator.release, message_id)
+        raise
+    return 200, "OK"
+
+def _twilio_form(request:Request) -> Optional[dict]:
+    """
+    The form twilio posted, or None if the request is not signed by twilio
+    """
+    form = dict(parse_qsl(request.body.decode("utf-8"), keep_blank_values=True))
+    if not validate_twilio_request(request.url("https"), form,
+                                   request.headers.get("x-twilio-signature", "")):
+        return None
+    return form
+
+async def receive_sms(request:Request) -> tuple[int, str]:
+    """
+    Recieve sms from twilio service
+    """
+    form = _twilio_form(request)
+    if form is None:
+        return 401, "Unauthorized"
+
+    phone_number = form['From']
+    collection = await async_find_collection(phone_number) \
+        if parse_command(form['Body']).needs_storage else None
+    await AsyncRotation(collection).receive(collection, phone_number, form['Body'])
+    return 200, "{}"
+
+async def sms_status(request:Request) -> tuple[int, str]:
+    """
+    Recieve message delivery states from twilio's status callback
+    """
+    form = _twilio_form(request)
+    if form is None:
+        return 401, "Unauthorized"
+
+    get_status_buffer().record(form['MessageSid'], form['MessageStatus'], form.get('To'),
+                               form.get('ErrorCode'))
+    return 204, ""
+
+ROUTES = {
+    ("GET", "/"): hello,
+    ("POST", "/send_reminders"): send_reminders,
+    ("POST", "/receive_sms"): receive_sms,
+    ("POST", "/sms_status"): sms_status,
+}
+
+async def _read_body(receive) -> bytes:
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+async def _lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            if warmup_enabled():
+                await to_thread(warm_up)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope:dict, receive, send) -> None:
+    """
+    The ASGI application
+    """
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+
+    request = Request(scope, await _read_body(receive))
+    route = ROUTES.get((request.method, request.path))
+    start = perf_counter()
+    if route is None:
+        status, body = 404, "Not Found"
+    else:
+        try:
+            status, body = await route(request)
+        except Exception:  # pylint: disable=broad-exception-caught
+            logging.exception("Unhandled error on %s", request.path)
+            status, body = 500, "Internal Server Error"
+        if metrics_enabled():
+            observe(f"asgi.{route.__name__}", perf_counter() - start)
+
+    content_type = "application/json" if body.startswith("{") else "text/plain; charset=utf-8"
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type.encode("latin-1"))]})
+    await send({"type": "http.response.body", "body": body.encode("utf-8")})
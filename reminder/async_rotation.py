@@ -0,0 +1,145 @@
+"""
+Asynchronous rotation for the ASGI app. Mirrors rotation.py on the async
+firestore and twilio clients, so waiting on the network never holds a thread.
+"""
+# Deliberately mirrors the synchronous module line for line
+# pylint: disable=duplicate-code
+from asyncio import Semaphore, gather, to_thread
+from os import environ
+from typing import Awaitable, Callable
+import logging
+
+from .third_party_interfaces import async_database, async_send_sms
+from .outbox import enqueue_sms
+from .rotation import summarize_broadcast
+from .commands import Command, parse_command, HELP_MESSAGE, UNKNOWN_MESSAGE
+from .events import SENT, DECLINED, COMPLETED, record_event
+
+AsyncSend = Callable[[str, str], Awaitable[None]]
+
+async def async_broadcast_sms(messages: dict[str, str], send: AsyncSend = async_send_sms) -> dict:
+    """
+    Send each phone number its message concurrently, bounded by BROADCAST_CONCURRENCY.
+    Returns {"sent": [phone numbers], "failed": {phone number: error}}
+    """
+    semaphore = Semaphore(max(1, int(environ.get("BROADCAST_CONCURRENCY", "8"))))
+
+    async def send_one(phone_number:str, message:str) -> None:
+        async with semaphore:
+            await send(phone_number, message)
+
+    results = await gather(*(send_one(phone_number, message)
+                             for phone_number, message in messages.items()),
+                           return_exceptions=True)
+    return summarize_broadcast(dict(zip(messages, results)))
+
+async def async_enqueue_sms(phone_number:str, message:str) -> None:
+    """
+    Queue a reply in the outbox when OUTBOX_ENABLED is set, otherwise send it now
+    """
+    if environ.get("OUTBOX_ENABLED", "False") == "True":
+        await to_thread(enqueue_sms, phone_number, message)
+    else:
+        await async_send_sms(phone_number, message)
+
+async def async_find_collection(phone_number: str) -> str:
+    """
+    Route a phone number to its collection through the phone number index,
+    preferring a collection with an active reminder
+    """
+    collections = await async_database.get_collections_by_phone_number(phone_number)
+    if not collections:
+        return environ.get("DEFAULT_COLLECTION", "trash-reminder")
+
+    for collection in collections:
+        if await async_database.reminder_is_active(collection):
+            return collection
+    return collections[0]
+
+class AsyncRotation:
+    """
+    Rotation whose operations are coroutines. Create it with AsyncRotation.open
+    so a new reminder can be activated.
+    """
+    def __init__(self, collection:str) -> None:
+        self.collection = collection
+
+    @classmethod
+    async def open(cls, collection:str, status:str = None) -> "AsyncRotation":
+        """
+        Return the rotation for a collection, activating it when status is new
+        """
+        if status == "new":
+            await async_database.activate_reminder(collection)
+        return cls(collection)
+
+    async def send_reminder(self, collection: str, send: AsyncSend = None,
+                            swap_with: str = None) -> dict:
+        '''
+        Send the reminder to next person on the rotation
+        Returns a summary of who was sent a message and who could not be reached
+        '''
+        if send is None:
+            send = async_send_sms
+        if not await async_database.reminder_is_active(collection):
+            return {"sent": [], "failed": {}}
+
+        user_record = await async_database.get_next_user(collection)
+        if user_record is None:
+            messages = {}
+            for user in await async_database.get_all_users_by_collection(collection):
+                name = user.to_dict().get("name")
+                messages[user.id] = f"Hi {name}, NOBODY is able to take out the trash tonight!" + \
+                                     " 🤷‍♂️ Figure it out, humans!"
+            return await async_broadcast_sms(messages, send)
+
+        phone_number = user_record.id
+        name = user_record.to_dict().get("name")
+        turn = "it's" if swap_with is None else f"{swap_with} asked to swap, so it's"
+        message = f"Hi {name}, {turn} your turn to take out the trash tonight! " + \
+                   "Can you pick it up tonight? Please respond with Yes or No."
+        await send(phone_number, message)
+        await async_database.update_user_attempted(collection, phone_number)
+        record_event(collection, SENT, phone_number, name)
+        return {"sent": [phone_number], "failed": {}}
+
+    async def receive(self, collection:str, phone_number:str, message_body:str) -> None:
+        """
+        This function processes the response received from the user, classifying
+        it before reading storage
+        """
+        command = parse_command(message_body)
+        if command is Command.STOP:
+            logging.info("%s opted out", phone_number)
+            return
+        if command is Command.HELP:
+            await async_enqueue_sms(phone_number, HELP_MESSAGE)
+            return
+        if command is Command.UNKNOWN:
+            await async_enqueue_sms(phone_number, UNKNOWN_MESSAGE)
+            return
+
+        user_record = await async_database.get_user_by_phone_number(collection, phone_number)
+        if not user_record.exists:
+            raise KeyError("User not found")
+
+        if command is Command.YES:
+            if not await async_database.accept_reminder(collection, phone_number, message_body):
+                await async_enqueue_sms(phone_number,
+                                        "Someone already responded, so don't worry about it!")
+                return
+
+            await async_enqueue_sms(phone_number, "Got it! Thanks!")
+            record_event(collection, COMPLETED, phone_number)
+            return
+
+        if not await async_database.reminder_is_active(collection):
+            await async_enqueue_sms(phone_number,
+                                    "Someone already responded, so don't worry about it!")
+            return
+
+        await async_database.update_user_response(collection, phone_number, message_body)
+        await async_enqueue_sms(phone_number, "Got it! Thanks!")
+        record_event(collection, DECLINED, phone_number)
+        swap_with = user_record.to_dict().get("name") if command is Command.SWAP else None
+        await self.send_reminder(collection, async_enqueue_sms, swap_with)
@@ -0,0 +1,190 @@
+"""
+Bulk import and export of household collections.
+
+    python -m reminder.cli import COLLECTION FILE [--format csv|jsonl] [--batch-size 500]
+                                                  [--rate 500] [--progress FILE]
+    python -m reminder.cli export COLLECTION [FILE] [--format csv|jsonl]
+
+Imports write users in batches of up to 500 documents, paced to --rate writes per
+second, and record how many rows were committed in a progress file, so an interrupted
+import resumes after the last committed batch. Exports stream the collection out
+one user at a time.
+"""
+from argparse import ArgumentParser
+from csv import DictReader, DictWriter
+from datetime import datetime, timezone
+from itertools import islice
+from json import dumps, loads
+from os import replace
+from pathlib import Path
+from time import monotonic, sleep
+from typing import Iterable, Iterator, Optional, TextIO
+import sys
+
+from .third_party_interfaces import NULL_DATETIME, MAX_BATCH_SIZE, get_document, \
+                                    stream_documents, write_documents, index_collection, \
+                                    rebuild_rotation_queue
+
+FIELDS = ["phone_number", "name", "last_completed", "last_attempted", "last_response"]
+
+def _parse_datetime(value:Optional[str]) -> datetime:
+    """
+    Read an ISO 8601 time. Times with an offset are stored as naive UTC, as firestore does.
+    """
+    if not value:
+        return NULL_DATETIME
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def parse_user(row:dict, row_number:int) -> tuple[str, dict]:
+    """
+    Turn an imported row into its phone number and user document.
+    Missing dates default to NULL_DATETIME, as for a newly added user.
+
+    raises ValueError: if the row has no phone number or name, or a date is malformed
+    """
+    phone_number = (row.get("phone_number") or "").strip()
+    if not phone_number or not row.get("name"):
+        raise ValueError(f"row {row_number}: phone_number and name are required")
+    try:
+        return phone_number, {
+            "name": row["name"],
+            "last_completed": _parse_datetime(row.get("last_completed")),
+            "last_attempted": _parse_datetime(row.get("last_attempted")),
+            "last_response": row.get("last_response") or "",
+        }
+    except ValueError as error:
+        raise ValueError(f"row {row_number}: {error}") from error
+
+def read_rows(source:TextIO, file_format:str) -> Iterator[dict]:
+    """
+    Stream rows from a csv file with a header line, or from one json object per line
+    """
+    if file_format == "csv":
+        yield from DictReader(source)
+        return
+    for line in source:
+        if line.strip():
+            yield loads(line)
+
+def _read_progress(path:Path, collection:str) -> int:
+    if not path.exists():
+        return 0
+    progress = loads(path.read_text(encoding="utf-8"))
+    if progress.get("collection") != collection:
+        raise ValueError(f"{path} records an import into {progress.get('collection')}, "
+                         f"not {collection}")
+    return progress["rows"]
+
+def _write_progress(path:Path, collection:str, rows:int) -> None:
+    temporary = path.with_name(path.name + ".tmp")
+    temporary.write_text(dumps({"collection": collection, "rows": rows}), encoding="utf-8")
+    replace(temporary, path)
+
+def import_users(collection:str, rows:Iterable[dict], progress:Path = None,
+                 batch_size:int = MAX_BATCH_SIZE, rate:float = 500.0) -> int:
+    """
+    Write users to a collection in batches of up to batch_size documents, averaging
+    at most rate writes per second. Rows committed by an earlier, interrupted import
+    recorded in the progress file are skipped. The users are then added to the phone
+    number index and the rotation queue is rebuilt. Returns how many users were written.
+
+    raises ValueError: on a malformed row; the batches before it stay committed
+    """
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    committed = _read_progress(progress, collection) if progress is not None else 0
+    numbered = islice(enumerate(rows, start=1), committed, None)
+
+    imported = 0
+    while batch := list(islice(numbered, batch_size)):
+        started = monotonic()
+        write_documents([(collection, *parse_user(row, row_number))
+                         for row_number, row in batch])
+        committed += len(batch)
+        imported += len(batch)
+        if progress is not None:
+            _write_progress(progress, collection, committed)
+        sleep(max(0.0, len(batch) / rate - (monotonic() - started)))
+
+    index_collection(collection)
+    if get_document("reminders", collection) is not None:
+        rebuild_rotation_queue(collection)
+    if progress is not None:
+        progress.unlink(missing_ok=True)
+    return imported
+
+def _exported(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def export_users(collection:str, destination:TextIO, file_format:str) -> int:
+    """
+    Stream every user of a collection to destination as csv or json lines.
+    Returns how many users were written.
+    """
+    writer = None
+    if file_format == "csv":
+        writer = DictWriter(destination, FIELDS, extrasaction="ignore")
+        writer.writeheader()
+
+    exported = 0
+    for user in stream_documents(collection):
+        row = {"phone_number": user.id,
+               **{field: _exported(value) for field, value in user.to_dict().items()}}
+        if writer is not None:
+            writer.writerow(row)
+        else:
+            destination.write(dumps(row, ensure_ascii=False) + "\n")
+        exported += 1
+    return exported
+
+def _format(path:Optional[str], file_format:Optional[str]) -> str:
+    if file_format is not None:
+        return file_format
+    return "csv" if path is not None and path.lower().endswith(".csv") else "jsonl"
+
+def main(argv:list[str] = None) -> int:
+    """
+    Run an import or export
+    """
+    parser = ArgumentParser(description=__doc__.split("\n\n", maxsplit=1)[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    import_parser = commands.add_parser("import", help="import users into a collection")
+    import_parser.add_argument("collection")
+    import_parser.add_argument("file")
+    import_parser.add_argument("--format", choices=["csv", "jsonl"])
+    import_parser.add_argument("--batch-size", type=int, default=MAX_BATCH_SIZE)
+    import_parser.add_argument("--rate", type=float, default=500.0,
+                               help="maximum writes per second")
+    import_parser.add_argument("--progress",
+                               help="progress file, FILE.progress by default")
+    export_parser = commands.add_parser("export", help="export the users of a collection")
+    export_parser.add_argument("collection")
+    export_parser.add_argument("file", nargs="?", help="output file, stdout by default")
+    export_parser.add_argument("--format", choices=["csv", "jsonl"])
+    args = parser.parse_args(argv)
+
+    file_format = _format(args.file, args.format)
+    if args.command == "import":
+        progress = Path(args.progress or f"{args.file}.progress")
+        try:
+            with open(args.file, encoding="utf-8", newline="") as source:
+                imported = import_users(args.collection, read_rows(source, file_format),
+                                        progress, args.batch_size, args.rate)
+        except ValueError as error:
+            print(f"Import stopped: {error}", file=sys.stderr)
+            return 1
+        print(f"Imported {imported} users into {args.collection}", file=sys.stderr)
+        return 0
+
+    if args.file in (None, "-"):
+        exported = export_users(args.collection, sys.stdout, file_format)
+    else:
+        with open(args.file, "w", encoding="utf-8", newline="") as destination:
+            exported = export_users(args.collection, destination, file_format)
+    print(f"Exported {exported} users from {args.collection}", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+"""
+Inbound sms commands. Messages are classified before anything is read from storage,
+so replies that do not concern the reminder never cost a database read.
+"""
+from enum import Enum
+from functools import lru_cache
+from unicodedata import normalize
+import re
+
+class Command(Enum):
+    """
+    What an inbound message asks for
+    """
+    YES = "yes"
+    NO = "no"
+    SKIP = "skip"
+    SWAP = "swap"
+    STOP = "stop"
+    HELP = "help"
+    UNKNOWN = "unknown"
+
+    @property
+    def needs_storage(self) -> bool:
+        """
+        True for the replies to a reminder, which read and update the rotation
+        """
+        return self in _REMINDER_REPLIES
+
+_REMINDER_REPLIES = frozenset([Command.YES, Command.NO, Command.SKIP, Command.SWAP])
+
+_KEYWORDS = {
+    "y": Command.YES, "yes": Command.YES, "\N{THUMBS UP SIGN}": Command.YES,
+    "\N{WHITE HEAVY CHECK MARK}": Command.YES, "\N{HEAVY CHECK MARK}": Command.YES,
+    "n": Command.NO, "no": Command.NO, "\N{THUMBS DOWN SIGN}": Command.NO,
+    "\N{CROSS MARK}": Command.NO,
+    "skip": Command.SKIP,
+    "swap": Command.SWAP,
+    # the opt-out and help keywords twilio recognises
+    "stop": Command.STOP, "stopall": Command.STOP, "unsubscribe": Command.STOP,
+    "cancel": Command.STOP, "end": Command.STOP, "quit": Command.STOP,
+    "help": Command.HELP, "info": Command.HELP,
+}
+
+# emoji presentation selectors and skin tone modifiers
+_EMOJI_MODIFIERS = re.compile("[\N{VARIATION SELECTOR-16}\U0001F3FB-\U0001F3FF]")
+# whitespace and punctuation around the word, like "Yes!" or " no. "
+_SURROUNDING = re.compile(r"^[\s.,!?;:'\"()\-]+|[\s.,!?;:'\"()\-]+$")
+
+def normalize_message(body:str) -> str:
+    """
+    Fold case, compatibility characters and emoji modifiers, and strip surrounding
+    whitespace and punctuation
+    """
+    folded = normalize("NFKC", body).casefold()
+    return _SURROUNDING.sub("", _EMOJI_MODIFIERS.sub("", folded))
+
+@lru_cache(maxsize=1024)
+def parse_command(body:str) -> Command:
+    """
+    Classify an inbound message. Only the whole message counts, so
+    "no problem" is not read as a no.
+    """
+    # plain replies like "Yes" need no unicode normalization
+    command = _KEYWORDS.get(body.strip().casefold())
+    if command is not None:
+        return command
+    return _KEYWORDS.get(normalize_message(body), Command.UNKNOWN)
+
+HELP_MESSAGE = "Reply YES to take your turn, NO or SKIP to pass it to the next person, " + \
+               "SWAP to ask the next person to swap with you, or STOP to unsubscribe."
+UNKNOWN_MESSAGE = "I did not understand your response. " + \
+                  "Please send yes or no, or HELP for more options."
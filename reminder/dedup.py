@@ -0,0 +1,67 @@
+"""
+Deduplication of pub/sub pushes. Pub/sub delivers at least once, so the same
+message can arrive more than once; each message id is only processed the first time.
+"""
+from datetime import datetime, timedelta, timezone
+from os import environ
+
+from .third_party_interfaces import create_document, get_document, set_document, \
+                                    delete_document, SharedInstance, TTLCache
+
+PUBSUB_MESSAGES = "pubsub_messages"
+
+class MessageDeduplicator:
+    """
+    Remembers claimed message ids in an in-memory LRU in front of the
+    pubsub_messages collection. Stored claims carry an expires_at timestamp and
+    count as absent once it has passed; on firestore a TTL policy on expires_at
+    removes them.
+    """
+    def __init__(self, ttl:timedelta = timedelta(days=7), maxsize:int = 10000) -> None:
+        self.ttl = ttl
+        self._seen = TTLCache(ttl=ttl.total_seconds(), maxsize=maxsize)
+
+    def claim(self, message_id:str) -> bool:
+        """
+        Claim a message for processing. Returns false if it was already claimed.
+        """
+        if message_id in self._seen:
+            return False
+
+        now = datetime.now(timezone.utc)
+        claim = {"expires_at": now + self.ttl}
+        if not create_document(PUBSUB_MESSAGES, message_id, claim):
+            existing = get_document(PUBSUB_MESSAGES, message_id)
+            if existing is not None and existing["expires_at"] > now:
+                self._seen.set(message_id, True,
+                               (existing["expires_at"] - now).total_seconds())
+                return False
+            set_document(PUBSUB_MESSAGES, message_id, claim)
+
+        self._seen.set(message_id, True)
+        return True
+
+    def release(self, message_id:str) -> None:
+        """
+        Forget a claim so a redelivery of the message is processed again
+        """
+        self._seen.pop(message_id)
+        delete_document(PUBSUB_MESSAGES, message_id)
+
+def _create_deduplicator() -> MessageDeduplicator:
+    return MessageDeduplicator(
+        ttl=timedelta(seconds=float(environ.get("PUBSUB_DEDUP_TTL", "604800"))))
+
+_DEDUPLICATOR = SharedInstance(_create_deduplicator)
+
+def get_deduplicator() -> MessageDeduplicator:
+    """
+    Return the process-wide deduplicator
+    """
+    return _DEDUPLICATOR.get()
+
+def reset_deduplicator() -> None:
+    """
+    Drop the process-wide deduplicator. Used by tests.
+    """
+    _DEDUPLICATOR.reset()
@@ -0,0 +1,121 @@
+"""
+Delivery states reported by twilio's status callbacks. Callbacks are buffered in
+memory and written in batches, keeping only the latest state of each message,
+so a burst of callbacks costs a few batched writes instead of one write each.
+"""
+from datetime import datetime
+from os import environ
+from threading import Condition, Thread
+from time import sleep
+import logging
+
+from .third_party_interfaces import MAX_BATCH_SIZE, write_documents, SharedInstance
+
+SMS_STATUS = "sms_status"
+
+# how far along each state is; callbacks can arrive out of order and
+# an earlier state must not replace a later one
+_PROGRESS = {
+    "accepted": 0, "scheduled": 0, "queued": 1, "sending": 2, "sent": 3,
+    "delivered": 4, "undelivered": 4, "failed": 4, "canceled": 4, "read": 5,
+}
+
+def _progress(status:str) -> int:
+    return _PROGRESS.get(status, 0)
+
+class StatusBuffer:  # pylint: disable=too-many-instance-attributes
+    """
+    Collects delivery states and writes them to the sms_status collection, one
+    document per message sid, from a background thread. A flush happens interval
+    seconds after the first buffered state, or as soon as max_batch messages are waiting.
+    """
+    def __init__(self, interval:float = 5.0, max_batch:int = MAX_BATCH_SIZE) -> None:
+        self.interval = interval
+        self.max_batch = max(1, min(max_batch, MAX_BATCH_SIZE))
+        self._condition = Condition()
+        self._pending = {}
+        self._worker = None
+        self.recorded = 0
+        self.written = 0
+        self.flushes = 0
+
+    def _keep(self, message_sid:str, document:dict) -> None:
+        current = self._pending.get(message_sid)
+        if current is None or _progress(document["status"]) >= _progress(current["status"]):
+            self._pending[message_sid] = document
+
+    def record(self, message_sid:str, status:str, to:str = None, error_code:str = None) -> None:
+        """
+        Buffer the state of a message. Nothing is written until the next flush.
+        """
+        document = {"status": status, "to": to, "updated": datetime.now()}
+        if error_code:
+            document["error_code"] = error_code
+        with self._condition:
+            self._keep(message_sid, document)
+            self.recorded += 1
+            self._condition.notify()
+            if self._worker is None:
+                self._worker = Thread(target=self._run, name="sms-status", daemon=True)
+                self._worker.start()
+
+    def flush(self) -> int:
+        """
+        Write every buffered state in batches and return how many messages were written.
+        States that failed to write are buffered again unless a later one arrived.
+        """
+        with self._condition:
+            pending, self._pending = self._pending, {}
+        writes = [(SMS_STATUS, message_sid, document)
+                  for message_sid, document in pending.items()]
+        for start in range(0, len(writes), self.max_batch):
+            batch = writes[start:start + self.max_batch]
+            try:
+                write_documents(batch)
+            except Exception:
+                with self._condition:
+                    for _, message_sid, document in writes[start:]:
+                        self._keep(message_sid, document)
+                raise
+            with self._condition:
+                self.written += len(batch)
+                self.flushes += 1
+        return len(writes)
+
+    def pending(self) -> int:
+        """
+        Messages whose latest state has not been written yet
+        """
+        with self._condition:
+            return len(self._pending)
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending)
+                self._condition.wait_for(lambda: len(self._pending) >= self.max_batch,
+                                         self.interval)
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.exception("Failed to write sms delivery states, retrying later")
+                sleep(self.interval)
+
+def _create_status_buffer() -> StatusBuffer:
+    return StatusBuffer(interval=float(environ.get("SMS_STATUS_FLUSH_INTERVAL", "5")),
+                        max_batch=int(environ.get("SMS_STATUS_BATCH_SIZE",
+                                                  str(MAX_BATCH_SIZE))))
+
+_STATUS_BUFFER = SharedInstance(_create_status_buffer)
+
+def get_status_buffer() -> StatusBuffer:
+    """
+    Return the process-wide delivery status buffer
+    """
+    return _STATUS_BUFFER.get()
+
+def reset_status_buffer() -> None:
+    """
+    Drop the process-wide buffer without writing it. Used by tests.
+    """
+    _STATUS_BUFFER.reset()
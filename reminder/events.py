@@ -0,0 +1,131 @@
+"""
+Append-only history of the reminders sent, declined and completed in each collection.
+Events are buffered in memory and written from a background thread together with
+the collection's running totals, so reports read one aggregate document instead
+of the whole history.
+"""
+from datetime import datetime
+from os import environ
+from threading import Condition, Thread
+from time import sleep
+from uuid import uuid4
+import logging
+
+from .third_party_interfaces import MAX_BATCH_SIZE, STATS, SharedInstance, get_document, \
+                                    record_events, current_unit_of_work
+
+SENT = "sent"
+DECLINED = "declined"
+COMPLETED = "completed"
+
+class EventLog:
+    """
+    Buffers events and writes them interval seconds after the first one arrives,
+    one transaction per collection holding the events and the updated aggregates.
+    Events that fail to write are kept for the next flush.
+    """
+    def __init__(self, interval:float = 5.0) -> None:
+        self.interval = interval
+        self._condition = Condition()
+        self._pending = {}
+        self._worker = None
+
+    def record(self, collection:str, kind:str, phone_number:str, name:str = None) -> None:
+        """
+        Buffer an event. Nothing is written until the next flush.
+        """
+        event = {"type": kind, "phone_number": phone_number, "time": datetime.now()}
+        if name:
+            event["name"] = name
+        with self._condition:
+            self._pending.setdefault(collection, {})[uuid4().hex] = event
+            self._condition.notify()
+            if self._worker is None:
+                self._worker = Thread(target=self._run, name="event-log", daemon=True)
+                self._worker.start()
+
+    def flush(self) -> int:
+        """
+        Write every buffered event and return how many were written
+        """
+        with self._condition:
+            pending, self._pending = self._pending, {}
+        # one write per event plus the aggregates must fit in a transaction
+        size = MAX_BATCH_SIZE - 1
+        batches = [(collection, dict(list(events.items())[start:start + size]))
+                   for collection, events in pending.items()
+                   for start in range(0, len(events), size)]
+        for index, (collection, events) in enumerate(batches):
+            try:
+                record_events(collection, events)
+            except Exception:
+                with self._condition:
+                    for unwritten_collection, unwritten in batches[index:]:
+                        self._pending.setdefault(unwritten_collection, {}).update(unwritten)
+                raise
+        return sum(len(events) for _, events in batches)
+
+    def pending(self) -> int:
+        """
+        Events that have not been written yet
+        """
+        with self._condition:
+            return sum(len(events) for events in self._pending.values())
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending)
+            sleep(self.interval)
+            try:
+                self.flush()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.exception("Failed to write reminder events, retrying later")
+
+def _create_event_log() -> EventLog:
+    return EventLog(interval=float(environ.get("EVENTS_FLUSH_INTERVAL", "5")))
+
+_EVENT_LOG = SharedInstance(_create_event_log)
+
+def get_event_log() -> EventLog:
+    """
+    Return the process-wide event log
+    """
+    return _EVENT_LOG.get()
+
+def reset_event_log() -> None:
+    """
+    Drop the process-wide event log without writing it. Used by tests.
+    """
+    _EVENT_LOG.reset()
+
+def events_enabled() -> bool:
+    """
+    True when EVENTS_ENABLED is set, to keep the event history and aggregates
+    """
+    return environ.get("EVENTS_ENABLED", "False") == "True"
+
+def record_event(collection:str, kind:str, phone_number:str, name:str = None) -> None:
+    """
+    Buffer an event when EVENTS_ENABLED is set, once the writes of the unit of work
+    it happened in, if any, are committed
+    """
+    work = current_unit_of_work()
+    if work is not None:
+        work.after_commit(record_event, collection, kind, phone_number, name)
+    elif events_enabled():
+        get_event_log().record(collection, kind, phone_number, name)
+
+def collection_stats(collection:str) -> dict:
+    """
+    The collection's aggregates, with each person's decline rate: the share of the
+    reminders they were sent that they declined
+    """
+    stats = get_document(STATS, collection) or {}
+    users = {}
+    for phone_number, counts in stats.get("users", {}).items():
+        sent = counts.get(SENT, 0)
+        users[phone_number] = {**counts,
+                               "decline_rate": counts.get(DECLINED, 0) / sent if sent else 0.0}
+    return {"collection": collection, "totals": stats.get("totals", {}), "users": users,
+            "periods": stats.get("periods", {})}
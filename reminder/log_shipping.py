@@ -0,0 +1,173 @@
+"""
+Non-blocking log shipping. Request threads only put records on an in-memory queue;
+a background thread sends them to a sink in batches, so logging never waits on the
+network. Info and debug records can be sampled and long messages are truncated.
+"""
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler
+from os import environ
+from queue import Full, Empty, Queue
+from threading import Condition, Lock, Thread
+import logging
+import sys
+
+class MemorySink:
+    """
+    Keeps shipped batches in memory, for tests and running without a network
+    """
+    def __init__(self) -> None:
+        self.batches = []
+
+    def send(self, entries:list[dict]) -> None:
+        """
+        Store a batch of log entries
+        """
+        self.batches.append(entries)
+
+    @property
+    def entries(self) -> list[dict]:
+        """
+        Every entry shipped so far, oldest first
+        """
+        return [entry for batch in self.batches for entry in batch]
+
+class CloudLoggingSink:  # pylint: disable=too-few-public-methods
+    """
+    Writes batches to Cloud Logging with one API call each. The client is created
+    by the first send, on the shipping thread rather than during startup.
+    """
+    def __init__(self, name:str = "reminder") -> None:
+        self.name = name
+        self._logger = None
+
+    def send(self, entries:list[dict]) -> None:
+        """
+        Write a batch of log entries
+        """
+        if self._logger is None:
+            # The logging SDK is the slowest import on cold start
+            from google.cloud.logging import Client  # pylint: disable=import-outside-toplevel
+            self._logger = Client().logger(self.name)
+        batch = self._logger.batch()
+        for entry in entries:
+            batch.log_struct({"message": entry["message"], "logger": entry["logger"]},
+                             severity=entry["severity"], timestamp=entry["time"])
+        batch.commit()
+
+class SamplingFilter(logging.Filter):  # pylint: disable=too-few-public-methods
+    """
+    Keeps a rate fraction of the records below WARNING, spread evenly,
+    and every record at WARNING or above
+    """
+    def __init__(self, rate:float) -> None:
+        super().__init__()
+        self.rate = min(1.0, max(0.0, rate))
+        self._credit = 0.0
+        self._lock = Lock()
+
+    def filter(self, record:logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.rate >= 1.0:
+            return True
+        with self._lock:
+            self._credit += self.rate
+            if self._credit >= 1.0:
+                self._credit -= 1.0
+                return True
+        return False
+
+def _entry(record:logging.LogRecord) -> dict:
+    return {"message": record.getMessage(), "severity": record.levelname,
+            "logger": record.name,
+            "time": datetime.fromtimestamp(record.created, timezone.utc)}
+
+class BatchingHandler(QueueHandler):  # pylint: disable=too-many-instance-attributes
+    """
+    Queues formatted records and ships them to sink from a background thread in
+    batches of up to batch_size, waiting at most interval seconds to fill a batch.
+    Messages longer than max_length are truncated. Records are dropped and counted,
+    never waited on, when queue_size records are already waiting or the sink fails.
+    """
+    def __init__(self, sink, batch_size:int = 100, interval:float = 1.0,
+                 max_length:int = 2000, queue_size:int = 10000) -> None:
+        super().__init__(Queue(queue_size))
+        self.sink = sink
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self.max_length = max_length
+        self._condition = Condition()
+        self._unshipped = 0
+        self._worker = None
+        self.shipped = 0
+        self.dropped = 0
+
+    def prepare(self, record:logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        if len(record.msg) > self.max_length:
+            record.msg = f"{record.msg[:self.max_length]}... " \
+                          f"[{len(record.msg) - self.max_length} characters truncated]"
+        return record
+
+    def enqueue(self, record:logging.LogRecord) -> None:
+        with self._condition:
+            try:
+                self.queue.put_nowait(record)
+            except Full:
+                self.dropped += 1
+                return
+            self._unshipped += 1
+            # the worker does not survive a fork, so it is started again in the child
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = Thread(target=self._run, name="log-shipping", daemon=True)
+                self._worker.start()
+
+    def _next_batch(self) -> list[logging.LogRecord]:
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get(timeout=self.interval))
+            except Empty:
+                break
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._next_batch()
+            shipped = True
+            try:
+                self.sink.send([_entry(record) for record in batch])
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                # logging it again would only queue it behind the failing sink
+                print(f"Dropped {len(batch)} log records: {error!r}", file=sys.stderr)
+                shipped = False
+            with self._condition:
+                if shipped:
+                    self.shipped += len(batch)
+                else:
+                    self.dropped += len(batch)
+                self._unshipped -= len(batch)
+                self._condition.notify_all()
+
+    def flush(self, timeout:float = 5.0) -> bool:
+        """
+        Wait until every queued record was shipped. Also called by logging.shutdown
+        at exit. Returns false if the timeout expired first.
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self._unshipped == 0, timeout)
+
+def install_log_shipping(sink, level:int = logging.INFO) -> BatchingHandler:
+    """
+    Route the root logger through a batching handler shipping to sink, configured
+    by LOG_BATCH_SIZE, LOG_FLUSH_INTERVAL, LOG_MAX_LENGTH, LOG_QUEUE_SIZE and
+    LOG_SAMPLE_RATE, the fraction of info and debug records kept
+    """
+    handler = BatchingHandler(sink,
+                              batch_size=int(environ.get("LOG_BATCH_SIZE", "100")),
+                              interval=float(environ.get("LOG_FLUSH_INTERVAL", "1")),
+                              max_length=int(environ.get("LOG_MAX_LENGTH", "2000")),
+                              queue_size=int(environ.get("LOG_QUEUE_SIZE", "10000")))
+    handler.addFilter(SamplingFilter(float(environ.get("LOG_SAMPLE_RATE", "1"))))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
+    return handler
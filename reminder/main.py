@@ -7,36 +7,62 @@ other modules and handle errors only.
 """
 from os import environ
 from json import loads
+from time import perf_counter
 import logging
 
-from flask import Flask, request, Response, send_from_directory
+from flask import Flask, g, request, Response, send_from_directory
 from dotenv import load_dotenv
-from twilio.request_validator import RequestValidator
 from google.auth.exceptions import GoogleAuthError
-from google.cloud.logging import Client
-from google.oauth2 import id_token
-from google.auth.transport import requests
 
 from . import Rotation
+from .rotation import find_collection
+from .commands import parse_command
+from .delivery import get_status_buffer
+from .events import collection_stats
+from .log_shipping import install_log_shipping, CloudLoggingSink
+from .outbox import get_outbox
+from .dedup import get_deduplicator
+from .warmup import warm_up, warmup_enabled
+from .scheduler import get_scheduler
+from .third_party_interfaces import verify_token, timed, observe, metrics_enabled, \
+                                    render_metrics, validate_twilio_request
 
 app = Flask(__name__)
 load_dotenv()
 
 if environ.get("CLOUD_LOGGING", "False") == "True":
-    client = Client()
-    client.setup_logging()
+    # Shipped in batches from a background thread, which also imports the logging SDK
+    install_log_shipping(CloudLoggingSink())
 
+@app.before_request
+def start_timer() -> None:
+    """
+    Note when the request started so its route can be timed
+    """
+    if metrics_enabled():
+        g.request_start = perf_counter()
+
+@app.teardown_request
+def record_request_time(_error:BaseException = None) -> None:
+    """
+    Record how long the route took, including failed requests
+    """
+    start = g.pop("request_start", None)
+    if start is not None and request.endpoint is not None:
+        observe(f"route.{request.endpoint}", perf_counter() - start)
+
+@timed
 def authenticate(bearer_token:str, base_url:str) -> bool:
     """
     Authenticate google oauth2 token
     """
+    if not bearer_token or " " not in bearer_token:
+        return False
     try:
         token = bearer_token.split(" ")[1]
 
-        # Verify and decode the JWT. `verify_oauth2_token` verifies
-        claim = id_token.verify_oauth2_token(
-            token, requests.Request()
-        )
+        # Verify and decode the JWT, reusing cached certificates and claims
+        claim = verify_token(token)
 
         if claim['aud'] !=  base_url.replace("http://", "https://", 1):
             return False
@@ -69,6 +95,7 @@ def send_reminders() -> Response:
     '''
     Call this from pub/sub subscription
     pass reminder key
+    Redelivered messages are acknowledged without sending anything again
     '''
     if not authenticate(request.headers.get("Authorization"), request.base_url):
         return "Unauthorized", 401
@@ -80,42 +107,126 @@ def send_reminders() -> Response:
     collection = attributes.get("collection")
     status = attributes.get("status")
 
-    rotation = Rotation(collection, status)
-    logging.info("Sending rotation reminders")
-    logging.info("Sending rotation: %s", collection)
-    rotation.send_reminder(collection)
+    message_id = message.get("messageId") or message.get("message_id")
+    deduplicator = get_deduplicator()
+    if message_id and not deduplicator.claim(message_id):
+        logging.info("Skipping duplicate pub/sub message %s", message_id)
+        return "OK", 200
 
-    logging.warning(request.data.decode("utf-8"))
+    try:
+        rotation = Rotation(collection, status)
+        logging.info("Sending rotation: %s", collection)
+        rotation.send_reminder(collection)
+    except Exception:
+        if message_id:
+            deduplicator.release(message_id)
+        raise
+
+    logging.info("Handled pub/sub message %s for %s", message_id, collection)
     # Returning any 2xx status indicates successful receipt of the message.
     return "OK", 200
 
-@app.route("/receive_sms", methods=["POST"])
-def receive_sms() -> Response:
+@app.route("/scheduler/tick", methods=["POST"])
+def scheduler_tick() -> Response:
+    '''
+    Call this every minute from one Cloud Scheduler job
+    Starts every rotation whose schedule is due
+    '''
+    if not authenticate(request.headers.get("Authorization"), request.base_url):
+        return "Unauthorized", 401
+
+    return get_scheduler().tick()
+
+@app.route("/outbox", methods=["GET"])
+def outbox_stats() -> Response:
     """
-    Recieve sms from twilio service
+    Report outbox queue depth and drain throughput
+    """
+    if not authenticate(request.headers.get("Authorization"), request.base_url):
+        return "Unauthorized", 401
+
+    return get_outbox().stats()
+
+@app.route("/stats", methods=["GET"])
+def stats() -> Response:
+    """
+    Report a collection's completions, declines and decline rates from its
+    aggregates, without reading its history
+    """
+    if not authenticate(request.headers.get("Authorization"), request.base_url):
+        return "Unauthorized", 401
+
+    collection = request.args.get("collection")
+    if not collection:
+        return "collection is required", 400
+    return collection_stats(collection)
+
+@app.route("/_ah/warmup", methods=["GET"])
+def warmup() -> Response:
+    """
+    Open connections ahead of the first request and report how long each step took
+    """
+    if not warmup_enabled():
+        return "Not Found", 404
+    if not authenticate(request.headers.get("Authorization"), request.base_url):
+        return "Unauthorized", 401
+
+    return warm_up()
+
+@app.route("/metrics", methods=["GET"])
+def metrics() -> Response:
+    """
+    Export operation latency histograms in the prometheus text format
+    """
+    if not metrics_enabled():
+        return "Not Found", 404
+
+    gauges = {}
+    if environ.get("OUTBOX_ENABLED", "False") == "True":
+        gauges["reminder_outbox_depth"] = get_outbox().depth()
+    return Response(render_metrics(gauges), mimetype="text/plain; version=0.0.4")
+
+def twilio_request_valid() -> bool:
+    """
+    Check the twilio signature of the current request
     """
-    auth_token = environ['TWILIO_AUTH_TOKEN']
     # url is incorrectly being set to http causing validator to fail
     https_url = f"https{request.url[4:]}"
-    validator = RequestValidator(auth_token)
-    request_valid = validator.validate(
-            https_url,
-            request.form,
-            request.headers.get('X-TWILIO-SIGNATURE', ''))
+    return validate_twilio_request(https_url, request.form,
+                                   request.headers.get('X-TWILIO-SIGNATURE', ''))
 
-    if not request_valid:
+@app.route("/receive_sms", methods=["POST"])
+def receive_sms() -> Response:
+    """
+    Recieve sms from twilio service
+    """
+    if not twilio_request_valid():
         return "Unauthorized", 401
 
     phone_number = request.form['From']
     message_body = request.form['Body']
 
-    collection = "trash-reminder"
+    # help, stop and unrecognised messages are answered without a collection
+    collection = find_collection(phone_number) \
+        if parse_command(message_body).needs_storage else None
 
     rotation = Rotation(collection)
     rotation.receive(collection, phone_number, message_body)
 
     return {}
 
+@app.route("/sms_status", methods=["POST"])
+def sms_status() -> Response:
+    """
+    Recieve message delivery states from twilio's status callback
+    """
+    if not twilio_request_valid():
+        return "Unauthorized", 401
+
+    get_status_buffer().record(request.form['MessageSid'], request.form['MessageStatus'],
+                               request.form.get('To'), request.form.get('ErrorCode'))
+    return "", 204
+
 
 if __name__ == "__main__":
     debug = environ.get("DEBUG")
@@ -0,0 +1,207 @@
+"""
+Outbox for outgoing sms. Messages are persisted in the storage layer and sent
+by a background worker with retries, so webhooks can return without waiting on twilio.
+Each pending message carries a lease held by the instance sending it; only messages
+whose lease expired are recovered by another instance.
+"""
+from collections import deque
+from datetime import datetime, timedelta
+from heapq import heappush, heappop
+from itertools import count
+from os import environ
+from threading import Condition, Thread
+from time import monotonic
+from typing import Callable
+from uuid import uuid4
+import logging
+
+from .third_party_interfaces import send_sms, set_document, update_document, \
+                                    delete_document, stream_documents, commit_documents, \
+                                    SharedInstance, current_unit_of_work
+
+OUTBOX = "outbox"
+
+class Outbox:  # pylint: disable=too-many-instance-attributes
+    """
+    Persisted queue of outgoing sms drained by a single background thread, which
+    sends with send_sms unless another send function is given.
+    Failed sends are retried with exponential backoff up to max_attempts,
+    after which the message is kept in storage with a failed status.
+    A message's lease is renewed with every attempt, lease seconds past its next one.
+    """
+    def __init__(self, send:Callable[[str, str], None] = None, max_attempts:int = 5,
+                 backoff:float = 1.0, lease:float = 300.0) -> None:
+        self._send = send
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = timedelta(seconds=lease)
+        self._condition = Condition()
+        self._ready = []
+        self._messages = {}
+        self._sequence = count()
+        self._in_flight = 0
+        self._sent_times = deque(maxlen=100000)
+        self._worker = None
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def enqueue(self, phone_number:str, message:str) -> str:
+        """
+        Persist a message and queue it for sending. Returns the outbox message id.
+        """
+        message_id = uuid4().hex
+        now = datetime.now()
+        document = {"to": phone_number, "body": message, "attempts": 0,
+                    "status": "pending", "created": now, "lease_expires": now + self.lease}
+        set_document(OUTBOX, message_id, document)
+        self._schedule(message_id, document, monotonic())
+        return message_id
+
+    def recover(self) -> int:
+        """
+        Requeue pending messages whose lease expired, left in storage by an instance
+        that stopped before sending them. Each is claimed with a new lease first, so
+        a message is recovered by one instance only. Returns how many were requeued.
+        """
+        now = datetime.now()
+        recovered = 0
+        for record in stream_documents(OUTBOX):
+            document = record.to_dict()
+            if document.get("status") != "pending" or record.id in self._messages:
+                continue
+            # messages written before leases expire a lease after they were created
+            expires = document.get("lease_expires") or document.get("created", now) + self.lease
+            if expires.replace(tzinfo=None) > now:
+                continue
+            lease = {"lease_expires": now + self.lease}
+            if not commit_documents([(OUTBOX, record.id, lease)], {(OUTBOX, record.id): record}):
+                continue
+            self._schedule(record.id, {**document, **lease}, monotonic())
+            recovered += 1
+        return recovered
+
+    def _schedule(self, message_id:str, document:dict, ready_at:float) -> None:
+        with self._condition:
+            self._messages[message_id] = document
+            heappush(self._ready, (ready_at, next(self._sequence), message_id))
+            self._condition.notify()
+            if self._worker is None:
+                self._worker = Thread(target=self._drain, name="outbox", daemon=True)
+                self._worker.start()
+
+    def _next_message(self) -> str:
+        with self._condition:
+            while not self._ready or self._ready[0][0] > monotonic():
+                timeout = self._ready[0][0] - monotonic() if self._ready else None
+                self._condition.wait(timeout)
+            self._in_flight += 1
+            return heappop(self._ready)[2]
+
+    def _drain(self) -> None:
+        while True:
+            message_id = self._next_message()
+            try:
+                self._deliver(message_id)
+            except Exception:  # pylint: disable=broad-exception-caught
+                # the stored message is left as it was for recover to pick up
+                logging.exception("Failed to record outbox message %s", message_id)
+                with self._condition:
+                    self._messages.pop(message_id, None)
+            finally:
+                with self._condition:
+                    self._in_flight -= 1
+                    self._condition.notify_all()
+
+    def _deliver(self, message_id:str) -> None:
+        document = self._messages[message_id]
+        try:
+            (self._send or send_sms)(document["to"], document["body"])
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            document["attempts"] += 1
+            if document["attempts"] < self.max_attempts:
+                self.retried += 1
+                logging.warning("Retrying outbox message %s: %s", message_id, error)
+                delay = self.backoff * 2 ** (document["attempts"] - 1)
+                update_document(OUTBOX, message_id, {
+                    "attempts": document["attempts"],
+                    "lease_expires": datetime.now() + timedelta(seconds=delay) + self.lease})
+                with self._condition:
+                    heappush(self._ready, (monotonic() + delay, next(self._sequence),
+                                           message_id))
+                return
+
+            self.failed += 1
+            logging.error("Giving up on outbox message %s: %s", message_id, error)
+            update_document(OUTBOX, message_id, {"attempts": document["attempts"],
+                                                 "status": "failed", "error": str(error)})
+        else:
+            self.sent += 1
+            with self._condition:
+                self._sent_times.append(monotonic())
+            delete_document(OUTBOX, message_id)
+
+        with self._condition:
+            self._messages.pop(message_id, None)
+
+    def depth(self) -> int:
+        """
+        Messages waiting to be sent, including retries and sends in progress
+        """
+        with self._condition:
+            return len(self._ready) + self._in_flight
+
+    def stats(self, window:float = 60.0) -> dict:
+        """
+        Queue depth, totals and messages sent per second over the last window seconds
+        """
+        with self._condition:
+            while self._sent_times and self._sent_times[0] < monotonic() - window:
+                self._sent_times.popleft()
+            drain_rate = len(self._sent_times) / window
+        return {"depth": self.depth(), "sent": self.sent, "failed": self.failed,
+                "retried": self.retried, "drain_rate": drain_rate}
+
+    def wait_until_empty(self, timeout:float = None) -> bool:
+        """
+        Block until every queued message was sent or given up on.
+        Returns false if the timeout expired first.
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._ready and self._in_flight == 0, timeout)
+
+def _create_outbox() -> Outbox:
+    outbox = Outbox(max_attempts=int(environ.get("OUTBOX_MAX_ATTEMPTS", "5")),
+                    backoff=float(environ.get("OUTBOX_BACKOFF", "1")),
+                    lease=float(environ.get("OUTBOX_LEASE", "300")))
+    outbox.recover()
+    return outbox
+
+_OUTBOX = SharedInstance(_create_outbox)
+
+def get_outbox() -> Outbox:
+    """
+    Return the process-wide outbox, recovering pending messages on first use
+    """
+    return _OUTBOX.get()
+
+def reset_outbox() -> None:
+    """
+    Drop the process-wide outbox. Used by tests; forked children reset it automatically.
+    """
+    _OUTBOX.reset()
+
+def enqueue_sms(phone_number:str, message:str) -> None:
+    """
+    Queue a message in the outbox when OUTBOX_ENABLED is set, otherwise send it now.
+    Inside a unit of work the message waits for the unit's writes to commit.
+    """
+    work = current_unit_of_work()
+    if work is not None:
+        work.after_commit(enqueue_sms, phone_number, message)
+        return
+    if environ.get("OUTBOX_ENABLED", "False") == "True":
+        get_outbox().enqueue(phone_number, message)
+    else:
+        send_sms(phone_number, message)
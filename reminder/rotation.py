@@ -3,10 +3,70 @@ Rotation is a type of reminder that will rotate through a list of
 possible people and reminding in order of who completed the task
 least recently
 """
-from .third_party_interfaces import get_users_by_last_completed_date, send_sms
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
+from os import environ
+from typing import Callable
+import logging
+
+from .third_party_interfaces import get_next_user, send_sms
 from .third_party_interfaces import get_user_by_phone_number, update_user_response
-from .third_party_interfaces import complete_reminder, reminder_is_active, activate_reminder, \
-                                    update_user_attempted, get_all_users_by_collection
+from .third_party_interfaces import accept_reminder, reminder_is_active, activate_reminder, \
+                                    update_user_attempted, get_all_users_by_collection, \
+                                    get_collections_by_phone_number, open_unit_of_work, \
+                                    WriteConflict
+from .outbox import enqueue_sms
+from .commands import Command, parse_command, HELP_MESSAGE, UNKNOWN_MESSAGE
+from .events import SENT, DECLINED, COMPLETED, record_event
+
+def broadcast_sms(messages: dict[str, str],
+                  send: Callable[[str, str], None] = send_sms) -> dict:
+    """
+    Send each phone number its message in parallel, bounded by BROADCAST_CONCURRENCY.
+    A failed recipient does not stop the others; failures are collected and returned
+    as {"sent": [phone numbers], "failed": {phone number: error}}
+    """
+    summary = {"sent": [], "failed": {}}
+    if not messages:
+        return summary
+
+    max_workers = max(1, min(len(messages), int(environ.get("BROADCAST_CONCURRENCY", "8"))))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # each send sees the caller's unit of work, if one is open
+        futures = {phone_number: executor.submit(copy_context().run, send, phone_number,
+                                                 message)
+                   for phone_number, message in messages.items()}
+
+    return summarize_broadcast({phone_number: future.exception()
+                                for phone_number, future in futures.items()})
+
+def summarize_broadcast(errors: dict[str, BaseException]) -> dict:
+    """
+    Turn each recipient's send error, or None, into a broadcast summary
+    """
+    summary = {"sent": [], "failed": {}}
+    for phone_number, error in errors.items():
+        if error is None:
+            summary["sent"].append(phone_number)
+        else:
+            logging.warning("Failed to send broadcast to %s: %s", phone_number, error)
+            summary["failed"][phone_number] = str(error)
+    return summary
+
+def find_collection(phone_number: str) -> str:
+    """
+    Route a phone number to its collection through the phone number index.
+    When a number belongs to several collections the one with an active reminder wins.
+    Numbers missing from the index fall back to DEFAULT_COLLECTION.
+    """
+    collections = get_collections_by_phone_number(phone_number)
+    if not collections:
+        return environ.get("DEFAULT_COLLECTION", "trash-reminder")
+
+    for collection in collections:
+        if reminder_is_active(collection):
+            return collection
+    return collections[0]
 
 class Rotation:
     """
@@ -19,56 +79,95 @@ class Rotation:
         if status == "new":
             activate_reminder(collection)
 
-    def send_reminder(self, collection: str):
+    def send_reminder(self, collection: str, send: Callable[[str, str], None] = None,
+                      swap_with: str = None) -> dict:
         '''
         Send the reminder to next person on the rotation
         Assumes that the reminder is scheduled to run today and not completed
+        Messages go through send, which defaults to sending immediately
+        When swap_with is given, the message says who asked to swap
+        Returns a summary of who was sent a message and who could not be reached
         '''
+        if send is None:
+            send = send_sms
         if not reminder_is_active(collection):
-            return
+            return {"sent": [], "failed": {}}
 
-        user_record = list(get_users_by_last_completed_date(collection, 1))
-        if len(user_record) == 0:
-            user_records = get_all_users_by_collection(collection)
-            for user in user_records:
+        user_record = get_next_user(collection)
+        if user_record is None:
+            messages = {}
+            for user in get_all_users_by_collection(collection):
                 name = user.to_dict().get("name")
-                failed_message = f"Hi {name}, NOBODY is able to take out the trash tonight!" + \
-                                  " 🤷‍♂️ Figure it out, humans!"
-                send_sms(user.id, failed_message)
-            return
+                messages[user.id] = f"Hi {name}, NOBODY is able to take out the trash tonight!" + \
+                                     " 🤷‍♂️ Figure it out, humans!"
+            return broadcast_sms(messages, send)
 
-        phone_number = user_record[0].id
-        user = user_record[0].to_dict()
+        phone_number = user_record.id
+        user = user_record.to_dict()
 
         name = user.get("name")
-        message = f"Hi {name}, it's your turn to take out the trash tonight! " + \
+        turn = "it's" if swap_with is None else f"{swap_with} asked to swap, so it's"
+        message = f"Hi {name}, {turn} your turn to take out the trash tonight! " + \
                    "Can you pick it up tonight? Please respond with Yes or No."
-        send_sms(phone_number, message)
+        send(phone_number, message)
         update_user_attempted(collection, phone_number)
+        record_event(collection, SENT, phone_number, name)
+        return {"sent": [phone_number], "failed": {}}
 
     def receive(self, collection:str, phone_number:str, message_body:str):
         """
         This function processes the response received from the user
+        The message is classified first; HELP, STOP and unknown messages are
+        answered without reading storage, so collection may be None for them
+        Replies go through the outbox so the webhook does not wait on twilio
+        A yes or no is handled in a unit of work: the user and reminder are read
+        together and the writes are committed in one batch, before any reply is queued.
+        If another request changed them first, the reply is handled again on its own.
+        """
+        command = parse_command(message_body)
+        if command is Command.STOP:
+            # twilio confirms the opt-out and blocks further messages itself
+            logging.info("%s opted out", phone_number)
+            return
+        if command is Command.HELP:
+            enqueue_sms(phone_number, HELP_MESSAGE)
+            return
+        if command is Command.UNKNOWN:
+            enqueue_sms(phone_number, UNKNOWN_MESSAGE)
+            return
+
+        try:
+            with open_unit_of_work([(collection, phone_number), ("reminders", collection)]):
+                self._reply(collection, phone_number, message_body, command)
+        except WriteConflict as conflict:
+            # the unit's replies were dropped with its writes, so it is safe to start over
+            logging.info("Replying to %s again after a conflict: %s", phone_number, conflict)
+            self._reply(collection, phone_number, message_body, command)
+
+    def _reply(self, collection:str, phone_number:str, message_body:str,
+               command:Command) -> None:
+        """
+        Record a yes or no and answer it, passing the reminder on after a no
         """
         user_record = get_user_by_phone_number(collection, phone_number)
         if not user_record.exists:
             raise KeyError("User not found")
 
-        positive_responses = ["y","yes"]
-        negative_responses = ["n", "no"]
-        if message_body.lower() not in positive_responses + negative_responses:
-            send_sms(phone_number,
-                     "I did not understand your response. Please send only yes, no, y or n.")
+        if command is Command.YES:
+            if not accept_reminder(collection, phone_number, message_body):
+                enqueue_sms(phone_number, "Someone already responded, so don't worry about it!")
+                return
+
+            enqueue_sms(phone_number, "Got it! Thanks!")
+            record_event(collection, COMPLETED, phone_number)
             return
 
         if not reminder_is_active(collection):
-            send_sms(phone_number, "Someone already responded, so don't worry about it!")
+            enqueue_sms(phone_number, "Someone already responded, so don't worry about it!")
             return
 
         update_user_response(collection, phone_number, message_body)
-        send_sms(phone_number, "Got it! Thanks!")
-
-        if message_body.lower() in positive_responses:
-            complete_reminder(collection, phone_number)
-        else:
-            self.send_reminder(collection)
+        enqueue_sms(phone_number, "Got it! Thanks!")
+        record_event(collection, DECLINED, phone_number)
+        swap_with = user_record.to_dict().get("name") if command is Command.SWAP else None
+        self.send_reminder(collection, enqueue_sms, swap_with)
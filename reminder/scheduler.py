@@ -0,0 +1,382 @@
+"""
+In-process scheduler. Reads the cron schedule of every reminder, keeps the next
+due times in a priority queue and starts every rotation due in a tick, in place
+of one pub/sub push per collection. Response deadlines stored on the reminders are
+kept in a second priority queue; when one expires without an answer, the reminder
+moves on to the next person.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from functools import partial
+from heapq import heapify, heappop, heappush
+from os import environ
+from threading import Condition, Thread
+from typing import Callable, Optional
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import logging
+
+from .rotation import Rotation
+from .dedup import get_deduplicator
+from .third_party_interfaces import stream_documents, get_document, deadline_of, SharedInstance
+
+_NAMES = {
+    "JAN": 1, "FEB": 2, "MAR": 3, "APR": 4, "MAY": 5, "JUN": 6,
+    "JUL": 7, "AUG": 8, "SEP": 9, "OCT": 10, "NOV": 11, "DEC": 12,
+    "SUN": 0, "MON": 1, "TUE": 2, "WED": 3, "THU": 4, "FRI": 5, "SAT": 6,
+}
+
+def _value(token:str) -> int:
+    return _NAMES[token] if token in _NAMES else int(token)
+
+def _parse_field(field:str, low:int, high:int) -> set[int]:
+    values = set()
+    for part in field.upper().split(","):
+        expression, _, step = part.partition("/")
+        if expression == "*":
+            start, end = low, high
+        else:
+            first, _, last = expression.partition("-")
+            start = _value(first)
+            end = _value(last) if last else high if step else start
+        if not low <= start <= end <= high:
+            raise ValueError(f"{part} is outside {low}-{high}")
+        values.update(range(start, end + 1, int(step) if step else 1))
+    return values
+
+class CronSchedule:  # pylint: disable=too-many-instance-attributes,too-few-public-methods
+    """
+    A five field cron expression: minute, hour, day of month, month and day of week.
+    Supports *, lists, ranges, steps and month and day names. As in cron, a day
+    matches either day field when both are restricted. With a zone, the fields are
+    matched against that zone's wall clock instead of the process's local time.
+    """
+    def __init__(self, expression:str, zone:Optional[ZoneInfo] = None) -> None:
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Expected 5 cron fields, got {expression!r}")
+        self.expression = expression
+        self.zone = zone
+        self.minutes = _parse_field(fields[0], 0, 59)
+        self.hours = _parse_field(fields[1], 0, 23)
+        self.days = _parse_field(fields[2], 1, 31)
+        self.months = _parse_field(fields[3], 1, 12)
+        self.weekdays = {day % 7 for day in _parse_field(fields[4], 0, 7)}
+        self._any_day = fields[2] == "*"
+        self._any_weekday = fields[4] == "*"
+
+    def _matches_day(self, day:datetime) -> bool:
+        if day.month not in self.months:
+            return False
+        in_days = day.day in self.days
+        in_weekdays = (day.weekday() + 1) % 7 in self.weekdays
+        if self._any_day or self._any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def next_after(self, after:datetime) -> datetime:
+        """
+        The first time strictly after the given one that matches the schedule.
+        Both are naive local times, as returned by datetime.now().
+        """
+        if self.zone is not None:
+            after = after.astimezone(self.zone).replace(tzinfo=None)
+        start = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day = start.replace(hour=0, minute=0)
+        for _ in range(366 * 5):
+            if self._matches_day(day):
+                for hour in sorted(self.hours):
+                    for minute in sorted(self.minutes):
+                        candidate = day.replace(hour=hour, minute=minute)
+                        if candidate >= start:
+                            return self._local(candidate)
+            day += timedelta(days=1)
+        raise ValueError(f"{self.expression} never matches")
+
+    def _local(self, wall_time:datetime) -> datetime:
+        if self.zone is None:
+            return wall_time
+        return wall_time.replace(tzinfo=self.zone).astimezone().replace(tzinfo=None)
+
+def _time_zone(reminder:dict) -> Optional[ZoneInfo]:
+    """
+    The zone a reminder's schedule runs in: its time_zone field, else SCHEDULER_TZ,
+    else None for the process's local time
+    """
+    name = reminder.get("time_zone") or environ.get("SCHEDULER_TZ")
+    return ZoneInfo(name) if name else None
+
+class Scheduler:  # pylint: disable=too-many-instance-attributes
+    """
+    Keeps (due time, collection) in a heap. Each tick starts Rotation(collection, "new")
+    for every collection due, with at most max_workers rotations in parallel.
+    Each due time is claimed through the message deduplicator first,
+    so several instances ticking at once start a rotation only once.
+    Expired response deadlines, kept as (due time, collection, phone number) in a
+    second heap, are claimed the same way and passed to escalate.
+    A rotation that fails gives its claim back and is tried again retry_delay later;
+    a failed escalation gives its claim back and is found again by the next load.
+    """
+    def __init__(self, start_rotation:Callable[[str], object] = None, max_workers:int = 8,
+                 reload_interval:timedelta = timedelta(minutes=5),
+                 grace:timedelta = timedelta(minutes=5),
+                 escalate:Callable[[str], object] = None) -> None:
+        self._start_rotation = _start_rotation if start_rotation is None else start_rotation
+        self._escalate = _escalate if escalate is None else escalate
+        self.max_workers = max_workers
+        self.reload_interval = reload_interval
+        self.grace = grace
+        self.retry_delay = timedelta(minutes=1)
+        self._heap = []
+        self._retries = {}
+        self._deadlines = []
+        self._schedules = {}
+        self._loaded_at = None
+        self._condition = Condition()
+        self._thread = None
+        self._stopped = False
+
+    def load(self, now:datetime = None) -> None:
+        """
+        Read the schedule, time zone and response deadline of every reminder.
+        Collections whose schedule did not change keep their due time; new ones are due
+        at their first time within the grace period.
+        """
+        now = now or datetime.now()
+        with self._condition:
+            due_times = {collection: due for due, collection in self._heap}
+        schedules = {}
+        heap = []
+        deadlines = []
+        for record in stream_documents("reminders"):
+            reminder = record.to_dict()
+            deadline = deadline_of(reminder)
+            if deadline is not None:
+                deadlines.append((deadline[0], record.id, deadline[1]))
+            expression = reminder.get("schedule")
+            if not expression:
+                continue
+            try:
+                zone = _time_zone(reminder)
+            except (ValueError, ZoneInfoNotFoundError) as error:
+                logging.warning("Skipping reminder %s with time zone %r: %s",
+                                record.id, reminder.get("time_zone"), error)
+                continue
+            previous = self._schedules.get(record.id)
+            if previous is not None and previous.expression == expression \
+                and previous.zone == zone and record.id in due_times:
+                schedules[record.id] = previous
+                heap.append((due_times[record.id], record.id))
+                continue
+            try:
+                schedule = CronSchedule(expression, zone)
+                heap.append((schedule.next_after(now - self.grace), record.id))
+            except ValueError as error:
+                logging.warning("Skipping reminder %s with schedule %r: %s",
+                                record.id, expression, error)
+                continue
+            schedules[record.id] = schedule
+
+        heapify(heap)
+        heapify(deadlines)
+        with self._condition:
+            self._heap, self._schedules, self._loaded_at = heap, schedules, now
+            self._deadlines = deadlines
+            self._retries = {collection: due_at for collection, due_at in self._retries.items()
+                             if schedules.get(collection) is self._schedules.get(collection)}
+            self._condition.notify()
+
+    def due(self, now:datetime) -> list[tuple[datetime, str]]:
+        """
+        Pop every (due time, collection) at or before now and queue its next run.
+        A retry reports the due time it is retrying.
+        """
+        due = []
+        with self._condition:
+            while self._heap and self._heap[0][0] <= now:
+                due_at, collection = heappop(self._heap)
+                due.append((self._retries.pop(collection, due_at), collection))
+                heappush(self._heap, (self._schedules[collection].next_after(now), collection))
+        return due
+
+    def _retry(self, collection:str, due_at:datetime, now:datetime) -> None:
+        """
+        Replace the collection's next run with a retry of due_at after retry_delay
+        """
+        with self._condition:
+            if collection not in self._schedules:
+                return
+            self._heap = [entry for entry in self._heap if entry[1] != collection]
+            heapify(self._heap)
+            heappush(self._heap, (now + self.retry_delay, collection))
+            self._retries[collection] = due_at
+            self._condition.notify()
+
+    def expired(self, now:datetime) -> list[tuple[datetime, str, str]]:
+        """
+        Pop every (due time, collection, phone number) deadline at or before now
+        """
+        expired = []
+        with self._condition:
+            while self._deadlines and self._deadlines[0][0] <= now:
+                expired.append(heappop(self._deadlines))
+        return expired
+
+    def add_deadline(self, due:datetime, collection:str, phone_number:str) -> None:
+        """
+        Track a response deadline set since the last load
+        """
+        with self._condition:
+            heappush(self._deadlines, (due, collection, phone_number))
+            self._condition.notify()
+
+    def next_due(self) -> datetime:
+        """
+        When the earliest collection or response deadline is due, or None without either
+        """
+        with self._condition:
+            earliest = [queue[0][0] for queue in (self._heap, self._deadlines) if queue]
+            return min(earliest) if earliest else None
+
+    def tick(self, now:datetime = None) -> dict:
+        """
+        Start every rotation that is due and escalate every expired response deadline,
+        reloading schedules when they are stale.
+        Returns {"started": [collections], "escalated": [collections], "skipped":
+        [collections another instance handled], "failed": {collection: error}}
+        """
+        now = now or datetime.now()
+        if self._loaded_at is None or now - self._loaded_at >= self.reload_interval:
+            self.load(now)
+
+        deduplicator = get_deduplicator()
+        summary = {"started": [], "escalated": [], "skipped": [], "failed": {}}
+        claimed = []
+        for due_at, collection in self.due(now):
+            claim = _claim_id(collection, due_at)
+            if deduplicator.claim(claim):
+                claimed.append(("started", collection, claim,
+                                partial(self._start_rotation, collection),
+                                partial(self._retry, collection, due_at, now)))
+            else:
+                summary["skipped"].append(collection)
+        for due_at, collection, phone_number in self.expired(now):
+            claim = _claim_id(collection, due_at, phone_number)
+            if deduplicator.claim(claim):
+                claimed.append(("escalated", collection, claim,
+                                partial(self._escalate_deadline, collection, phone_number,
+                                        due_at), None))
+            else:
+                summary["skipped"].append(collection)
+        if not claimed:
+            return summary
+
+        with ThreadPoolExecutor(max_workers=max(1, min(len(claimed), self.max_workers))) \
+            as executor:
+            futures = [(outcome, collection, claim, retry, executor.submit(run))
+                       for outcome, collection, claim, run, retry in claimed]
+
+        for outcome, collection, claim, retry, future in futures:
+            error = future.exception()
+            if error is None:
+                # a deadline answered since it was loaded is left alone
+                summary[outcome if future.result() is not False else "skipped"] \
+                    .append(collection)
+            else:
+                logging.error("Scheduled rotation %s failed: %s", collection, error)
+                summary["failed"][collection] = str(error)
+                deduplicator.release(claim)
+                if retry is not None:
+                    retry()
+        return summary
+
+    def _escalate_deadline(self, collection:str, phone_number:str, due_at:datetime) -> bool:
+        """
+        Escalate if the reminder still waits on this deadline; it may have been answered
+        or moved on since it was loaded. Tracks the deadline the escalation started.
+        """
+        reminder = get_document("reminders", collection) or {}
+        if deadline_of(reminder) != (due_at, phone_number):
+            return False
+
+        logging.info("%s did not answer %s in time", phone_number, collection)
+        self._escalate(collection)
+        deadline = deadline_of(get_document("reminders", collection) or {})
+        if deadline is not None and deadline != (due_at, phone_number):
+            self.add_deadline(deadline[0], collection, deadline[1])
+        return True
+
+    def start(self) -> None:
+        """
+        Tick in a background thread whenever the next collection is due
+        """
+        with self._condition:
+            if self._thread is None:
+                self._stopped = False
+                self._thread = Thread(target=self._run, name="scheduler", daemon=True)
+                self._thread.start()
+
+    def stop(self) -> None:
+        """
+        Stop the background thread after its current tick
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.tick()
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                logging.error("Scheduler tick failed: %s", error)
+            with self._condition:
+                next_due = self.next_due()
+                wait = self.reload_interval.total_seconds() if next_due is None else \
+                    min((next_due - datetime.now()).total_seconds(),
+                        self.reload_interval.total_seconds())
+                self._condition.wait_for(lambda: self._stopped, max(wait, 0))
+                if self._stopped:
+                    return
+
+def _claim_id(collection:str, due_at:datetime, phone_number:str = None) -> str:
+    if phone_number is not None:
+        return f"deadline:{collection}:{phone_number}:{due_at.isoformat()}"
+    return f"schedule:{collection}:{due_at.isoformat()}"
+
+def _start_rotation(collection:str) -> dict:
+    return Rotation(collection, "new").send_reminder(collection)
+
+def _escalate(collection:str) -> dict:
+    # whoever did not answer was attempted today, so the next eligible person is asked
+    return Rotation(collection).send_reminder(collection)
+
+def _create_scheduler() -> Scheduler:
+    scheduler = Scheduler(
+        max_workers=int(environ.get("SCHEDULER_CONCURRENCY", "8")),
+        reload_interval=timedelta(seconds=float(environ.get("SCHEDULER_RELOAD", "300"))),
+        grace=timedelta(seconds=float(environ.get("SCHEDULER_GRACE", "300"))))
+    scheduler.retry_delay = timedelta(seconds=float(environ.get("SCHEDULER_RETRY", "60")))
+    return scheduler
+
+_SCHEDULER = SharedInstance(_create_scheduler)
+
+def get_scheduler() -> Scheduler:
+    """
+    Return the process-wide scheduler
+    """
+    return _SCHEDULER.get()
+
+def reset_scheduler() -> None:
+    """
+    Drop the process-wide scheduler. Used by tests; forked children reset it automatically.
+    """
+    _SCHEDULER.reset()
+
+def scheduler_enabled() -> bool:
+    """
+    True when SCHEDULER_ENABLED is set, to tick in a background thread
+    """
+    return environ.get("SCHEDULER_ENABLED", "False") == "True"
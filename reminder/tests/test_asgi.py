@@ -0,0 +1,126 @@
+"""
+Tests for the ASGI entry point
+"""
+from asyncio import run
+from json import dumps
+from unittest.mock import patch, MagicMock, AsyncMock
+from urllib.parse import urlencode
+from assertpy import assert_that
+
+from reminder.asgi import app
+
+# pylint: disable=unused-argument
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+
+def _call(method:str, path:str, body:bytes = b"", headers:dict = None) -> tuple[int, bytes]:
+    scope = {"type": "http", "method": method, "path": path, "query_string": b"",
+             "headers": [(b"host", b"localhost")] +
+                        [(name.encode(), value.encode()) for name, value in
+                         (headers or {}).items()]}
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    run(app(scope, receive, send))
+    return sent[0]["status"], sent[1]["body"]
+
+def test_404():
+    status, _ = _call("GET", "/bad_path")
+    assert_that(status).is_equal_to(404)
+
+@patch("reminder.asgi.authenticate", return_value=True)
+@patch("reminder.asgi.get_deduplicator")
+@patch("reminder.asgi.AsyncRotation")
+def test_send_reminders(rotation:MagicMock, get_deduplicator:MagicMock,
+                        authenticate:MagicMock):
+    rotation.open = AsyncMock()
+    rotation.open.return_value.send_reminder = AsyncMock()
+    get_deduplicator.return_value.claim.return_value = True
+
+    status, body = _call("POST", "/send_reminders", dumps(
+        {"message": {"messageId": "42",
+                     "attributes": {"collection": "123", "status": "active"}}}).encode(),
+        {"authorization": "bearer ABC123"})
+    authenticate.assert_called_once_with("bearer ABC123", "http://localhost/send_reminders")
+    rotation.open.assert_awaited_once_with("123", "active")
+    rotation.open.return_value.send_reminder.assert_awaited_once_with("123")
+    assert_that((status, body)).is_equal_to((200, b"OK"))
+
+@patch("reminder.asgi.authenticate", return_value=False)
+@patch("reminder.asgi.AsyncRotation")
+def test_send_reminders_requires_authentication(rotation:MagicMock, authenticate:MagicMock):
+    status, _ = _call("POST", "/send_reminders", b"{}", {"authorization": "bearer ABC123"})
+    assert_that(status).is_equal_to(401)
+    rotation.open.assert_not_called()
+
+@patch("reminder.asgi.authenticate", return_value=True)
+@patch("reminder.asgi.get_deduplicator")
+@patch("reminder.asgi.AsyncRotation")
+def test_send_reminders_releases_failed_message(rotation:MagicMock, get_deduplicator:MagicMock,
+                                                authenticate:MagicMock):
+    rotation.open = AsyncMock(side_effect=RuntimeError("firestore unavailable"))
+    get_deduplicator.return_value.claim.return_value = True
+
+    status, _ = _call("POST", "/send_reminders", dumps(
+        {"message": {"messageId": "42", "attributes": {"collection": "123"}}}).encode(),
+        {"authorization": "bearer ABC123"})
+    get_deduplicator.return_value.release.assert_called_once_with("42")
+    assert_that(status).is_equal_to(500)
+
+@patch("reminder.asgi.async_find_collection")
+@patch("reminder.asgi.AsyncRotation")
+@patch("twilio.request_validator.RequestValidator")
+def test_receive_sms(request_validator:MagicMock, rotation:MagicMock,
+                     find_collection:MagicMock):
+    find_collection.return_value = "trash-reminder"
+    rotation.return_value.receive = AsyncMock()
+    validator = request_validator.return_value
+    validator.validate.return_value = True
+
+    form = {"From": "+11111111111", "Body": "yes"}
+    status, body = _call("POST", "/receive_sms", urlencode(form).encode(),
+                         {"x-twilio-signature": "123"})
+    request_validator.assert_called_once_with("DEF")
+    validator.validate.assert_called_once_with("https://localhost/receive_sms", form, "123")
+    rotation.return_value.receive.assert_awaited_once_with("trash-reminder", "+11111111111",
+                                                           "yes")
+    assert_that((status, body)).is_equal_to((200, b"{}"))
+
+@patch("reminder.asgi.AsyncRotation")
+@patch("twilio.request_validator.RequestValidator")
+def test_receive_invalid_sms(request_validator:MagicMock, rotation:MagicMock):
+    request_validator.return_value.validate.return_value = False
+    status, _ = _call("POST", "/receive_sms", b"From=123&Body=blah",
+                      {"x-twilio-signature": "123"})
+    assert_that(status).is_equal_to(401)
+    rotation.assert_not_called()
+
+@patch("reminder.asgi.get_status_buffer")
+@patch("twilio.request_validator.RequestValidator")
+def test_sms_status(request_validator:MagicMock, get_status_buffer:MagicMock):
+    request_validator.return_value.validate.return_value = True
+    form = {"MessageSid": "SM1", "MessageStatus": "delivered", "To": "+11111111111"}
+    status, _ = _call("POST", "/sms_status", urlencode(form).encode(),
+                      {"x-twilio-signature": "123"})
+    get_status_buffer.return_value.record.assert_called_once_with(
+        "SM1", "delivered", "+11111111111", None)
+    assert_that(status).is_equal_to(204)
+
+def test_lifespan():
+    messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message["type"])
+
+    run(app({"type": "lifespan"}, receive, send))
+    assert_that(sent).is_equal_to(["lifespan.startup.complete", "lifespan.shutdown.complete"])
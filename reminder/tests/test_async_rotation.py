@@ -0,0 +1,94 @@
+"""
+Tests for the asynchronous rotation
+"""
+from asyncio import run
+from unittest.mock import patch, MagicMock, AsyncMock, call
+from assertpy import assert_that
+
+from reminder.async_rotation import AsyncRotation, async_broadcast_sms, async_find_collection
+from reminder.commands import HELP_MESSAGE
+
+# pylint: disable=unused-argument
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+
+def _user(phone_number:str, name:str) -> MagicMock:
+    user = MagicMock(id=phone_number, exists=True)
+    user.to_dict.return_value = {"name": name}
+    return user
+
+def _database(active:bool = True, next_user:MagicMock = None, users:list = None) -> MagicMock:
+    database = MagicMock()
+    database.reminder_is_active = AsyncMock(return_value=active)
+    database.get_next_user = AsyncMock(return_value=next_user)
+    database.get_all_users_by_collection = AsyncMock(return_value=users or [])
+    database.get_user_by_phone_number = AsyncMock(return_value=_user("+11111111111", "Brian"))
+    for name in ["update_user_attempted", "update_user_response", "accept_reminder",
+                 "activate_reminder", "get_collections_by_phone_number"]:
+        setattr(database, name, AsyncMock())
+    return database
+
+def test_broadcast_collects_failures():
+    send = AsyncMock(side_effect=[None, OSError("unreachable")])
+    summary = run(async_broadcast_sms({"+11111111111": "a", "+12222222222": "b"}, send))
+    assert_that(summary).is_equal_to({"sent": ["+11111111111"],
+                                      "failed": {"+12222222222": "unreachable"}})
+
+class TestAsyncRotation:
+
+    def test_open_new_rotation_activates_it(self):
+        with patch("reminder.async_rotation.async_database", _database()) as database:
+            rotation = run(AsyncRotation.open("123", "new"))
+        database.activate_reminder.assert_awaited_once_with("123")
+        assert_that(rotation.collection).is_equal_to("123")
+
+    def test_send_reminder_to_next_user(self):
+        send = AsyncMock()
+        with patch("reminder.async_rotation.async_database",
+                   _database(next_user=_user("+11111111111", "Brian"))) as database:
+            summary = run(AsyncRotation("123").send_reminder("123", send))
+        send.assert_awaited_once()
+        assert_that(send.call_args.args[1]).starts_with("Hi Brian")
+        database.update_user_attempted.assert_awaited_once_with("123", "+11111111111")
+        assert_that(summary).is_equal_to({"sent": ["+11111111111"], "failed": {}})
+
+    def test_send_reminder_broadcasts_when_nobody_is_left(self):
+        send = AsyncMock()
+        with patch("reminder.async_rotation.async_database", _database(
+            users=[_user("+11111111111", "Brian"), _user("+12222222222", "Annie")])):
+            summary = run(AsyncRotation("123").send_reminder("123", send))
+        assert_that(send.await_count).is_equal_to(2)
+        assert_that(summary["sent"]).is_equal_to(["+11111111111", "+12222222222"])
+
+    @patch("reminder.async_rotation.async_enqueue_sms", new_callable=AsyncMock)
+    def test_receive_yes(self, enqueue_sms:AsyncMock):
+        with patch("reminder.async_rotation.async_database", _database()) as database:
+            database.accept_reminder.return_value = True
+            run(AsyncRotation("123").receive("123", "+11111111111", "Yes"))
+        database.accept_reminder.assert_awaited_once_with("123", "+11111111111", "Yes")
+        enqueue_sms.assert_awaited_once_with("+11111111111", "Got it! Thanks!")
+
+    @patch("reminder.async_rotation.async_enqueue_sms", new_callable=AsyncMock)
+    def test_receive_no_sends_to_next_user(self, enqueue_sms:AsyncMock):
+        with patch("reminder.async_rotation.async_database",
+                   _database(next_user=_user("+12222222222", "Annie"))) as database:
+            run(AsyncRotation("123").receive("123", "+11111111111", "no"))
+        database.update_user_response.assert_awaited_once_with("123", "+11111111111", "no")
+        assert_that(enqueue_sms.call_args_list[0]).is_equal_to(
+            call("+11111111111", "Got it! Thanks!"))
+        assert_that(enqueue_sms.call_args_list[1].args[0]).is_equal_to("+12222222222")
+
+    @patch("reminder.async_rotation.async_enqueue_sms", new_callable=AsyncMock)
+    def test_receive_help_without_storage(self, enqueue_sms:AsyncMock):
+        with patch("reminder.async_rotation.async_database", _database()) as database:
+            run(AsyncRotation(None).receive(None, "+11111111111", "HELP"))
+            run(AsyncRotation(None).receive(None, "+11111111111", "stop"))
+        database.get_user_by_phone_number.assert_not_called()
+        enqueue_sms.assert_awaited_once_with("+11111111111", HELP_MESSAGE)
+
+def test_find_collection_prefers_active_reminder():
+    database = _database()
+    database.get_collections_by_phone_number.return_value = ["456", "123"]
+    database.reminder_is_active.side_effect = [False, True]
+    with patch("reminder.async_rotation.async_database", database):
+        assert_that(run(async_find_collection("+11111111111"))).is_equal_to("123")
@@ -0,0 +1,111 @@
+"""
+Tests for the bulk import and export command line
+"""
+from datetime import datetime
+from io import StringIO
+from json import dumps
+from unittest.mock import patch, MagicMock
+from assertpy import assert_that
+
+from reminder.cli import import_users, export_users, read_rows, main
+from reminder.third_party_interfaces import NULL_DATETIME, ROTATION_QUEUE, MemoryBackend
+
+# pylint: disable=unused-argument
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+
+ROWS = [
+    {"phone_number": "+11111111111", "name": "Brian", "last_completed": "2023-02-01T00:00:00"},
+    {"phone_number": "+12222222222", "name": "Annie",
+     "last_completed": "2023-01-01T00:00:00+00:00", "last_attempted": "2023-01-02T00:00:00"},
+    {"phone_number": "+13333333333", "name": "Haley"},
+]
+
+def _jsonl(rows:list[dict]) -> str:
+    return "".join(dumps(row) + "\n" for row in rows)
+
+@patch("reminder.third_party_interfaces.backend.get_backend")
+class TestImport:
+
+    def test_users_written_in_batches(self, get_backend:MagicMock, tmp_path):
+        backend = get_backend.return_value = MemoryBackend()
+        backend.set_document("reminders", "123", {"status": "inactive"})
+        progress = tmp_path / "users.jsonl.progress"
+        with patch.object(backend, "write_documents", wraps=backend.write_documents) as writes:
+            assert_that(import_users("123", ROWS, progress, batch_size=2)).is_equal_to(3)
+        user_batches = [call.args[0] for call in writes.call_args_list
+                        if call.args[0][0][0] == "123"]
+        assert_that([len(batch) for batch in user_batches]).is_equal_to([2, 1])
+
+        assert_that(backend.get_document("123", "+12222222222")).is_equal_to(
+            {"name": "Annie", "last_completed": datetime(2023,1,1),
+             "last_attempted": datetime(2023,1,2), "last_response": ""})
+        assert_that(backend.get_document("123", "+13333333333")["last_attempted"]) \
+            .is_equal_to(NULL_DATETIME)
+        assert_that(backend.get_collections_by_phone_number("+11111111111")).is_equal_to(["123"])
+        queue = backend.get_document("reminders", "123")[ROTATION_QUEUE]
+        assert_that([entry["phone_number"] for entry in queue]) \
+            .is_equal_to(["+13333333333", "+11111111111", "+12222222222"])
+        assert_that(progress.exists()).is_false()
+
+    def test_import_resumes_after_committed_rows(self, get_backend:MagicMock, tmp_path):
+        backend = get_backend.return_value = MemoryBackend()
+        progress = tmp_path / "users.jsonl.progress"
+        progress.write_text(dumps({"collection": "123", "rows": 2}))
+        assert_that(import_users("123", ROWS, progress)).is_equal_to(1)
+        assert_that([user.id for user in backend.stream_documents("123")]) \
+            .is_equal_to(["+13333333333"])
+
+    def test_malformed_row_keeps_earlier_batches(self, get_backend:MagicMock, tmp_path):
+        backend = get_backend.return_value = MemoryBackend()
+        progress = tmp_path / "users.jsonl.progress"
+        rows = ROWS[:2] + [{"phone_number": "+14444444444"}]
+        assert_that(import_users).raises(ValueError).when_called_with(
+            "123", rows, progress, batch_size=2).contains("row 3")
+        assert_that(list(backend.stream_documents("123"))).is_length(2)
+        assert_that(progress.read_text()).contains('"rows": 2')
+        assert_that(import_users).raises(ValueError).when_called_with(
+            "456", rows, progress).contains("123")
+
+    def test_writes_are_paced_to_the_rate(self, get_backend:MagicMock):
+        get_backend.return_value = MemoryBackend()
+        with patch("reminder.cli.sleep") as sleep:
+            import_users("123", ROWS, batch_size=1, rate=10)
+        assert_that(sleep.call_count).is_equal_to(3)
+        assert_that(sleep.call_args.args[0]).is_close_to(0.1, 0.05)
+
+@patch("reminder.third_party_interfaces.backend.get_backend")
+class TestExport:
+
+    def test_csv_export_imports_back(self, get_backend:MagicMock):
+        backend = get_backend.return_value = MemoryBackend()
+        import_users("123", ROWS)
+        exported = StringIO()
+        assert_that(export_users("123", exported, "csv")).is_equal_to(3)
+        assert_that(exported.getvalue().splitlines()[0]) \
+            .is_equal_to("phone_number,name,last_completed,last_attempted,last_response")
+
+        exported.seek(0)
+        import_users("456", read_rows(exported, "csv"))
+        for user in backend.stream_documents("123"):
+            assert_that(backend.get_document("456", user.id)).is_equal_to(user.to_dict())
+
+    def test_main_round_trips_json_lines(self, get_backend:MagicMock, tmp_path, capsys):
+        backend = get_backend.return_value = MemoryBackend()
+        source = tmp_path / "users.jsonl"
+        source.write_text(_jsonl(ROWS) + "\n")
+        assert_that(main(["import", "123", str(source)])).is_equal_to(0)
+        assert_that(capsys.readouterr().err).contains("Imported 3 users into 123")
+
+        assert_that(main(["export", "123"])).is_equal_to(0)
+        lines = capsys.readouterr().out.splitlines()
+        assert_that(lines).is_length(3)
+        assert_that(lines[0]).contains('"name": "Brian"', '"last_completed": "2023-02-01T00:00:00"')
+        assert_that(list(backend.stream_documents("123"))).is_length(3)
+
+    def test_main_reports_bad_rows(self, get_backend:MagicMock, tmp_path, capsys):
+        get_backend.return_value = MemoryBackend()
+        source = tmp_path / "users.csv"
+        source.write_text("phone_number,name\n+11111111111,\n")
+        assert_that(main(["import", "123", str(source)])).is_equal_to(1)
+        assert_that(capsys.readouterr().err).contains("row 1: phone_number and name are required")
@@ -0,0 +1,29 @@
+"""
+Tests for the inbound sms command parser
+"""
+import pytest
+from assertpy import assert_that
+
+from reminder.commands import Command, parse_command, normalize_message
+
+# pylint: disable=missing-function-docstring
+
+@pytest.mark.parametrize("body, command", [
+    ("y", Command.YES), ("YES", Command.YES), ("  Yes!  ", Command.YES), ("👍", Command.YES),
+    ("👍🏽", Command.YES), ("✅", Command.YES), ("✔️", Command.YES), ("ｙｅｓ", Command.YES),
+    ("n", Command.NO), ("No.", Command.NO), ("👎", Command.NO), ("❌", Command.NO),
+    ("skip", Command.SKIP), ("SWAP", Command.SWAP),
+    ("STOP", Command.STOP), ("unsubscribe", Command.STOP), ("Quit", Command.STOP),
+    ("help", Command.HELP), ("INFO?", Command.HELP),
+    ("no problem", Command.UNKNOWN), ("yes no", Command.UNKNOWN), ("", Command.UNKNOWN),
+    ("blah", Command.UNKNOWN), ("🤷‍♂️", Command.UNKNOWN),
+])
+def test_parse_command(body, command):
+    assert_that(parse_command(body)).is_equal_to(command)
+
+def test_only_reminder_replies_need_storage():
+    needs_storage = [command for command in Command if command.needs_storage]
+    assert_that(needs_storage).contains_only(Command.YES, Command.NO, Command.SKIP, Command.SWAP)
+
+def test_normalize_message():
+    assert_that(normalize_message("\tSwap, Please!\n")).is_equal_to("swap, please")
@@ -0,0 +1,48 @@
+"""
+Tests for pub/sub message deduplication
+"""
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch, MagicMock
+from assertpy import assert_that
+
+from reminder.dedup import MessageDeduplicator, PUBSUB_MESSAGES
+from reminder.third_party_interfaces import MemoryBackend
+
+# pylint: disable=unused-argument
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+
+@patch("reminder.third_party_interfaces.backend.get_backend")
+class TestMessageDeduplicator:
+
+    def test_message_is_claimed_once(self, get_backend:MagicMock):
+        backend = get_backend.return_value = MemoryBackend()
+        deduplicator = MessageDeduplicator()
+
+        assert_that(deduplicator.claim("42")).is_true()
+        assert_that(deduplicator.claim("42")).is_false()
+        assert_that(backend.get_document(PUBSUB_MESSAGES, "42")).contains_key("expires_at")
+
+    def test_claim_is_shared_through_storage(self, get_backend:MagicMock):
+        get_backend.return_value = MemoryBackend()
+
+        assert_that(MessageDeduplicator().claim("42")).is_true()
+        assert_that(MessageDeduplicator().claim("42")).is_false()
+
+    def test_expired_claim_is_ignored(self, get_backend:MagicMock):
+        backend = get_backend.return_value = MemoryBackend()
+        backend.set_document(PUBSUB_MESSAGES, "42", {
+            "expires_at": datetime.now(timezone.utc) - timedelta(minutes=1)})
+
+        assert_that(MessageDeduplicator().claim("42")).is_true()
+        assert_that(backend.get_document(PUBSUB_MESSAGES, "42")["expires_at"]) \
+            .is_greater_than(datetime.now(timezone.utc))
+
+    def test_released_message_can_be_claimed_again(self, get_backend:MagicMock):
+        backend = get_backend.return_value = MemoryBackend()
+        deduplicator = MessageDeduplicator()
+
+        deduplicator.claim("42")
+        deduplicator.release("42")
+        assert_that(backend.get_document(PUBSUB_MESSAGES, "42")).is_none()
+        assert_that(deduplicator.claim("42")).is_true()
@@ -0,0 +1,62 @@
+"""
+Tests for the buffered sms delivery states
+"""
+from time import monotonic, sleep
+from unittest.mock import patch, MagicMock
+from assertpy import assert_that
+
+from reminder.delivery import StatusBuffer, SMS_STATUS
+from reminder.third_party_interfaces import MemoryBackend
+
+# pylint: disable=unused-argument
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+
+@patch("reminder.third_party_interfaces.backend.get_backend")
+class TestStatusBuffer:
+
+    @patch("reminder.delivery.Thread")
+    def test_states_written_in_batches(self, thread:MagicMock, get_backend:MagicMock):
+        backend = get_backend.return_value = MemoryBackend()
+        buffer = StatusBuffer(interval=60, max_batch=2)
+        for index in range(3):
+            buffer.record(f"SM{index}", "sent", f"+1222222222{index}")
+        with patch.object(backend, "write_documents", wraps=backend.write_documents) as writes:
+            assert_that(buffer.flush()).is_equal_to(3)
+        assert_that([len(call.args[0]) for call in writes.call_args_list]).is_equal_to([2, 1])
+        assert_that(backend.get_document(SMS_STATUS, "SM1")) \
+            .contains_entry({"status": "sent"}, {"to": "+12222222221"})
+        assert_that(buffer.pending()).is_equal_to(0)
+
+    def test_only_latest_state_is_written(self, get_backend:MagicMock):
+        backend = get_backend.return_value = MemoryBackend()
+        buffer = StatusBuffer(interval=60)
+        buffer.record("SM1", "queued", "+12222222222")
+        buffer.record("SM1", "undelivered", "+12222222222", "30003")
+        buffer.record("SM1", "sent", "+12222222222")
+        assert_that(buffer.pending()).is_equal_to(1)
+        buffer.flush()
+        assert_that(backend.get_document(SMS_STATUS, "SM1")) \
+            .contains_entry({"status": "undelivered"}, {"error_code": "30003"})
+        assert_that((buffer.recorded, buffer.written, buffer.flushes)).is_equal_to((3, 1, 1))
+
+    def test_failed_write_keeps_states(self, get_backend:MagicMock):
+        backend = get_backend.return_value = MemoryBackend()
+        buffer = StatusBuffer(interval=60)
+        buffer.record("SM1", "sent", "+12222222222")
+        with patch.object(backend, "write_documents", side_effect=RuntimeError("unavailable")):
+            assert_that(buffer.flush).raises(RuntimeError).when_called_with()
+        buffer.record("SM1", "delivered", "+12222222222")
+        assert_that(buffer.flush()).is_equal_to(1)
+        assert_that(backend.get_document(SMS_STATUS, "SM1")["status"]).is_equal_to("delivered")
+
+    def test_full_batch_is_flushed_in_background(self, get_backend:MagicMock):
+        backend = get_backend.return_value = MemoryBackend()
+        buffer = StatusBuffer(interval=60, max_batch=2)
+        buffer.record("SM1", "delivered", "+12222222222")
+        buffer.record("SM2", "delivered", "+13333333333")
+        deadline = monotonic() + 5
+        while buffer.written < 2 and monotonic() < deadline:
+            sleep(0.01)
+        assert_that([record.id for record in backend.stream_documents(SMS_STATUS)]) \
+            .contains_only("SM1", "SM2")
@@ -0,0 +1,79 @@
+"""
+Tests for the reminder event history and aggregates
+"""
+from unittest.mock import patch, MagicMock
+from assertpy import assert_that
+
+from reminder.events import EventLog, collection_stats, get_event_log, reset_event_log, \
+                            SENT, DECLINED
+from reminder.rotation import Rotation
+from reminder.third_party_interfaces import MemoryBackend, EVENTS
+
+# pylint: disable=unused-argument
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+
+@patch("reminder.events.Thread")
+@patch("reminder.third_party_interfaces.backend.get_backend")
+class TestEventLog:
+
+    def test_events_written_per_collection(self, get_backend:MagicMock, thread:MagicMock):
+        backend = get_backend.return_value = MemoryBackend()
+        log = EventLog()
+        log.record("123", SENT, "+11111111111", "Brian")
+        log.record("123", DECLINED, "+11111111111")
+        log.record("456", SENT, "+12222222222", "Annie")
+        with patch.object(backend, "record_events", wraps=backend.record_events) as writes:
+            assert_that(log.flush()).is_equal_to(3)
+        assert_that(writes.call_count).is_equal_to(2)
+        assert_that(list(backend.stream_documents(EVENTS))).is_length(3)
+        assert_that(log.pending()).is_equal_to(0)
+        thread.return_value.start.assert_called_once()
+
+    def test_failed_write_keeps_events(self, get_backend:MagicMock, thread:MagicMock):
+        backend = get_backend.return_value = MemoryBackend()
+        log = EventLog()
+        log.record("123", SENT, "+11111111111")
+        with patch.object(backend, "record_events", side_effect=RuntimeError("unavailable")):
+            assert_that(log.flush).raises(RuntimeError).when_called_with()
+        assert_that(log.pending()).is_equal_to(1)
+        log.flush()
+        assert_that(collection_stats("123")["totals"]).is_equal_to({"sent": 1})
+
+    def test_stats_include_decline_rate(self, get_backend:MagicMock, thread:MagicMock):
+        get_backend.return_value = MemoryBackend()
+        log = EventLog()
+        for kind in [SENT, DECLINED, SENT, SENT]:
+            log.record("123", kind, "+11111111111", "Brian")
+        log.flush()
+        stats = collection_stats("123")
+        assert_that(stats["users"]["+11111111111"]) \
+            .contains_entry({"sent": 3}, {"declined": 1}, {"name": "Brian"})
+        assert_that(stats["users"]["+11111111111"]["decline_rate"]).is_close_to(1 / 3, 1e-9)
+        assert_that(collection_stats("000")) \
+            .is_equal_to({"collection": "000", "totals": {}, "users": {}, "periods": {}})
+
+@patch.dict("os.environ", {"EVENTS_ENABLED": "True"})
+@patch("reminder.events.Thread")
+@patch("reminder.rotation.enqueue_sms")
+@patch("reminder.rotation.send_sms")
+@patch("reminder.third_party_interfaces.backend.get_backend")
+def test_rotation_records_sends_and_replies(get_backend:MagicMock, send_sms:MagicMock,
+                                            enqueue_sms:MagicMock, thread:MagicMock):
+    backend = get_backend.return_value = MemoryBackend()
+    backend.set_document("reminders", "trash", {})
+    backend.add_user("trash", "+11111111111", "Brian")
+    backend.add_user("trash", "+12222222222", "Annie")
+    reset_event_log()
+    try:
+        rotation = Rotation("trash", "new")
+        rotation.send_reminder("trash")
+        first = send_sms.call_args.args[0]
+        rotation.receive("trash", first, "no")
+        rotation.receive("trash", enqueue_sms.call_args.args[0], "yes")
+        get_event_log().flush()
+    finally:
+        reset_event_log()
+    assert_that(collection_stats("trash")["totals"]) \
+        .is_equal_to({"sent": 2, "declined": 1, "completed": 1})
+    assert_that(collection_stats("trash")["users"][first]["decline_rate"]).is_equal_to(1.0)
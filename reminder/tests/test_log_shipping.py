@@ -0,0 +1,100 @@
+"""
+Tests for the batched log shipping
+"""
+import logging
+from unittest.mock import patch, MagicMock
+from assertpy import assert_that
+
+from reminder.log_shipping import BatchingHandler, MemorySink, SamplingFilter, \
+                                  CloudLoggingSink, install_log_shipping
+
+# pylint: disable=unused-argument
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+
+def _logger(handler:logging.Handler) -> logging.Logger:
+    logger = logging.getLogger(f"test.{id(handler)}")
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
+    return logger
+
+class TestBatchingHandler:
+
+    def test_records_shipped_in_batches(self):
+        sink = MemorySink()
+        handler = BatchingHandler(sink, batch_size=2, interval=0.05)
+        logger = _logger(handler)
+        for index in range(5):
+            logger.info("message %s", index)
+        assert_that(handler.flush(5)).is_true()
+
+        assert_that([entry["message"] for entry in sink.entries]) \
+            .is_equal_to([f"message {index}" for index in range(5)])
+        assert_that(max(len(batch) for batch in sink.batches)).is_less_than_or_equal_to(2)
+        assert_that(sink.entries[0]).contains_entry({"severity": "INFO"},
+                                                    {"logger": logger.name})
+        assert_that(handler.shipped).is_equal_to(5)
+
+    def test_long_messages_are_truncated(self):
+        sink = MemorySink()
+        handler = BatchingHandler(sink, interval=0, max_length=10)
+        _logger(handler).warning("%s", "x" * 25)
+        handler.flush(5)
+        assert_that(sink.entries[0]["message"]) \
+            .is_equal_to("xxxxxxxxxx... [15 characters truncated]")
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        sink = MagicMock()
+        handler = BatchingHandler(sink, queue_size=1)
+        with patch("reminder.log_shipping.Thread"):
+            logger = _logger(handler)
+            logger.info("kept")
+            logger.info("dropped")
+        assert_that(handler.dropped).is_equal_to(1)
+        sink.send.assert_not_called()
+
+    def test_failing_sink_drops_batch(self, capsys):
+        sink = MagicMock()
+        sink.send.side_effect = RuntimeError("unavailable")
+        handler = BatchingHandler(sink, interval=0)
+        _logger(handler).error("lost")
+        assert_that(handler.flush(5)).is_true()
+        assert_that((handler.shipped, handler.dropped)).is_equal_to((0, 1))
+        assert_that(capsys.readouterr().err).contains("Dropped 1 log records")
+
+def test_info_sampled_and_warnings_kept():
+    sink = MemorySink()
+    handler = BatchingHandler(sink, interval=0)
+    handler.addFilter(SamplingFilter(0.25))
+    logger = _logger(handler)
+    for index in range(8):
+        logger.info("info %s", index)
+    logger.warning("warning")
+    handler.flush(5)
+    assert_that([entry["message"] for entry in sink.entries]) \
+        .is_equal_to(["info 3", "info 7", "warning"])
+
+@patch.dict("os.environ", {"LOG_BATCH_SIZE": "7", "LOG_SAMPLE_RATE": "0.5"})
+def test_install_log_shipping():
+    root = logging.getLogger()
+    level = root.level
+    handler = install_log_shipping(MemorySink())
+    try:
+        assert_that(root.handlers).contains(handler)
+        assert_that(handler.batch_size).is_equal_to(7)
+        assert_that(handler.filters[0].rate).is_equal_to(0.5)
+    finally:
+        root.removeHandler(handler)
+        root.setLevel(level)
+
+@patch("google.cloud.logging.Client")
+def test_cloud_logging_sink_commits_one_batch(client:MagicMock):
+    sink = CloudLoggingSink()
+    entry = {"message": "hello", "severity": "INFO", "logger": "root", "time": None}
+    sink.send([entry, entry])
+    sink.send([entry])
+    client.assert_called_once()
+    batch = client.return_value.logger.return_value.batch.return_value
+    assert_that(batch.log_struct.call_count).is_equal_to(3)
+    assert_that(batch.commit.call_count).is_equal_to(2)
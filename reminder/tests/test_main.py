@@ -1,12 +1,14 @@
 """
 Tests for the main flask module
 """
+from os import environ
 from unittest.mock import patch, MagicMock, call
 
 from werkzeug.datastructures import ImmutableMultiDict
 from assertpy import assert_that
 
 from reminder import main
+from reminder.third_party_interfaces import reset_metrics
 
 # pylint: disable=unused-argument
 # pylint: disable=missing-function-docstring
@@ -18,11 +20,11 @@ def test_404():
     response = client.get("/bad_path")
     assert_that(response.status_code).is_equal_to(404)
 
-@patch("reminder.main.id_token")
+@patch("reminder.main.verify_token")
 @patch("reminder.main.Rotation")
-def test_send_reminders(rotation:MagicMock, id_token:MagicMock):
-    id_token.verify_oauth2_token.return_value = { "aud": "https://localhost/send_reminders",
-                                                 "email": "USER@email.com", "email_verified": True}
+def test_send_reminders(rotation:MagicMock, verify_token:MagicMock):
+    verify_token.return_value = { "aud": "https://localhost/send_reminders",
+                                  "email": "USER@email.com", "email_verified": True}
 
     response = client.post("/send_reminders",
                            json={"message": { "attributes":
@@ -31,14 +33,50 @@ def test_send_reminders(rotation:MagicMock, id_token:MagicMock):
     rotation.assert_has_calls([call('123', 'active'), call().send_reminder('123')])
     assert_that(response.status_code).is_equal_to(200)
 
+@patch("reminder.main.verify_token")
+@patch("reminder.main.get_deduplicator")
 @patch("reminder.main.Rotation")
-@patch("reminder.main.RequestValidator")
-def test_receive_sms(request_validator:MagicMock, rotation:MagicMock):
+def test_send_reminders_skips_duplicate_message(rotation:MagicMock, get_deduplicator:MagicMock,
+                                                verify_token:MagicMock):
+    verify_token.return_value = { "aud": "https://localhost/send_reminders",
+                                  "email": "USER@email.com", "email_verified": True}
+    get_deduplicator.return_value.claim.return_value = False
+
+    response = client.post("/send_reminders",
+                           json={"message": { "messageId": "42", "attributes":
+                                             { "collection": "123", "status": "active"}}},
+                           headers={"Authorization": "bearer ABC123"})
+    get_deduplicator.return_value.claim.assert_called_once_with("42")
+    rotation.assert_not_called()
+    assert_that(response.status_code).is_equal_to(200)
+
+@patch("reminder.main.verify_token")
+@patch("reminder.main.get_deduplicator")
+@patch("reminder.main.Rotation")
+def test_send_reminders_releases_failed_message(rotation:MagicMock, get_deduplicator:MagicMock,
+                                                verify_token:MagicMock):
+    verify_token.return_value = { "aud": "https://localhost/send_reminders",
+                                  "email": "USER@email.com", "email_verified": True}
+    get_deduplicator.return_value.claim.return_value = True
+    rotation.return_value.send_reminder.side_effect = RuntimeError("firestore unavailable")
+
+    response = client.post("/send_reminders",
+                           json={"message": { "messageId": "42", "attributes":
+                                             { "collection": "123", "status": "active"}}},
+                           headers={"Authorization": "bearer ABC123"})
+    get_deduplicator.return_value.release.assert_called_once_with("42")
+    assert_that(response.status_code).is_equal_to(500)
+
+@patch("reminder.main.find_collection")
+@patch("reminder.main.Rotation")
+@patch("twilio.request_validator.RequestValidator")
+def test_receive_sms(request_validator:MagicMock, rotation:MagicMock, find_collection:MagicMock):
+    find_collection.return_value = "trash-reminder"
     validator = request_validator.return_value
     validator.validate.return_value = True
 
     from_number = "+11111111111"
-    message_body = "blah"
+    message_body = "yes"
     response = client.post("/receive_sms",
                            data={"From": from_number, "Body": message_body},
                            headers={"X-TWILIO-SIGNATURE": 123})
@@ -48,11 +86,25 @@ def test_receive_sms(request_validator:MagicMock, rotation:MagicMock):
                                                                   ("Body", message_body)]),
                                               '123')])
     rotation.assert_has_calls([call('trash-reminder'), call().receive('trash-reminder',
-                                                                      '+11111111111', 'blah')])
+                                                                      '+11111111111', 'yes')])
+    find_collection.assert_called_once_with(from_number)
+    assert_that(response.status_code).is_equal_to(200)
+
+@patch("reminder.main.find_collection")
+@patch("reminder.main.Rotation")
+@patch("twilio.request_validator.RequestValidator")
+def test_receive_unknown_sms_skips_collection_lookup(request_validator:MagicMock,
+                                                    rotation:MagicMock,
+                                                    find_collection:MagicMock):
+    request_validator.return_value.validate.return_value = True
+    response = client.post("/receive_sms", data={"From": "+11111111111", "Body": "blah"},
+                           headers={"X-TWILIO-SIGNATURE": 123})
+    find_collection.assert_not_called()
+    rotation.return_value.receive.assert_called_once_with(None, "+11111111111", "blah")
     assert_that(response.status_code).is_equal_to(200)
 
 @patch("reminder.main.Rotation")
-@patch("reminder.main.RequestValidator")
+@patch("twilio.request_validator.RequestValidator")
 def test_receive_invalid_sms(request_validator:MagicMock, rotation:MagicMock):
     validator = request_validator.return_value
     validator.validate.return_value = False
@@ -61,3 +113,109 @@ def test_receive_invalid_sms(request_validator:MagicMock, rotation:MagicMock):
                            headers={"X-TWILIO-SIGNATURE": 123})
     assert_that(response.status_code).is_equal_to(401)
     rotation.assert_not_called()
+
+@patch("reminder.main.get_status_buffer")
+@patch("twilio.request_validator.RequestValidator")
+def test_sms_status(request_validator:MagicMock, get_status_buffer:MagicMock):
+    validator = request_validator.return_value
+    validator.validate.return_value = True
+    form = {"MessageSid": "SM1", "MessageStatus": "undelivered", "To": "+11111111111",
+            "ErrorCode": "30003"}
+    response = client.post("/sms_status", data=form, headers={"X-TWILIO-SIGNATURE": 123})
+    validator.validate.assert_called_once_with('https://localhost/sms_status',
+                                               ImmutableMultiDict(form), '123')
+    get_status_buffer.return_value.record.assert_called_once_with(
+        "SM1", "undelivered", "+11111111111", "30003")
+    assert_that(response.status_code).is_equal_to(204)
+
+@patch("reminder.main.get_status_buffer")
+@patch("twilio.request_validator.RequestValidator")
+def test_invalid_sms_status(request_validator:MagicMock, get_status_buffer:MagicMock):
+    request_validator.return_value.validate.return_value = False
+    response = client.post("/sms_status", data={"MessageSid": "SM1", "MessageStatus": "sent"})
+    get_status_buffer.assert_not_called()
+    assert_that(response.status_code).is_equal_to(401)
+
+@patch("reminder.main.verify_token")
+@patch("reminder.main.get_outbox")
+def test_outbox_stats(get_outbox:MagicMock, verify_token:MagicMock):
+    verify_token.return_value = { "aud": "https://localhost/outbox",
+                                  "email": "USER@email.com", "email_verified": True}
+    get_outbox.return_value.stats.return_value = {"depth": 2, "sent": 5}
+    response = client.get("/outbox", headers={"Authorization": "bearer ABC123"})
+    assert_that(response.status_code).is_equal_to(200)
+    assert_that(response.json).is_equal_to({"depth": 2, "sent": 5})
+
+@patch("reminder.main.verify_token")
+def test_outbox_stats_requires_authentication(verify_token:MagicMock):
+    verify_token.side_effect = ValueError("Wrong number of segments in token")
+    response = client.get("/outbox", headers={"Authorization": "bearer ABC123"})
+    assert_that(response.status_code).is_equal_to(401)
+
+@patch("reminder.main.verify_token")
+@patch("reminder.main.collection_stats")
+def test_stats(collection_stats:MagicMock, verify_token:MagicMock):
+    verify_token.return_value = { "aud": "https://localhost/stats",
+                                  "email": "USER@email.com", "email_verified": True}
+    collection_stats.return_value = {"collection": "trash", "totals": {"completed": 3}}
+    response = client.get("/stats?collection=trash", headers={"Authorization": "bearer ABC123"})
+    collection_stats.assert_called_once_with("trash")
+    assert_that(response.json).is_equal_to(collection_stats.return_value)
+
+    response = client.get("/stats", headers={"Authorization": "bearer ABC123"})
+    assert_that(response.status_code).is_equal_to(400)
+
+@patch.dict(environ, {"METRICS_ENABLED": "False"})
+def test_metrics_disabled():
+    response = client.get("/metrics")
+    assert_that(response.status_code).is_equal_to(404)
+
+@patch.dict(environ, {"METRICS_ENABLED": "True", "OUTBOX_ENABLED": "True"})
+@patch("reminder.main.get_outbox")
+def test_metrics(get_outbox:MagicMock):
+    reset_metrics()
+    get_outbox.return_value.depth.return_value = 4
+    client.get("/")
+
+    response = client.get("/metrics")
+    reset_metrics()
+    assert_that(response.status_code).is_equal_to(200)
+    assert_that(response.text).contains(
+        'reminder_operation_seconds_count{operation="route.test"} 1',
+        "reminder_outbox_depth 4")
+
+@patch.dict(environ, {"WARMUP_ENABLED": "False"})
+@patch("reminder.main.warm_up")
+def test_warmup_disabled(warm_up:MagicMock):
+    response = client.get("/_ah/warmup")
+    assert_that(response.status_code).is_equal_to(404)
+    warm_up.assert_not_called()
+
+@patch.dict(environ, {"WARMUP_ENABLED": "True"})
+@patch("reminder.main.verify_token")
+@patch("reminder.main.warm_up")
+def test_warmup(warm_up:MagicMock, verify_token:MagicMock):
+    verify_token.return_value = { "aud": "https://localhost/_ah/warmup",
+                                  "email": "USER@email.com", "email_verified": True}
+    warm_up.return_value = {"steps": {"storage": 1.5}, "total": 1.5}
+    response = client.get("/_ah/warmup", headers={"Authorization": "bearer ABC123"})
+    assert_that(response.status_code).is_equal_to(200)
+    assert_that(response.json).is_equal_to(warm_up.return_value)
+
+@patch.dict(environ, {"WARMUP_ENABLED": "True"})
+@patch("reminder.main.warm_up")
+def test_warmup_requires_authentication(warm_up:MagicMock):
+    response = client.get("/_ah/warmup")
+    assert_that(response.status_code).is_equal_to(401)
+    warm_up.assert_not_called()
+
+@patch("reminder.main.verify_token")
+@patch("reminder.main.get_scheduler")
+def test_scheduler_tick(get_scheduler:MagicMock, verify_token:MagicMock):
+    verify_token.return_value = { "aud": "https://localhost/scheduler/tick",
+                                  "email": "USER@email.com", "email_verified": True}
+    get_scheduler.return_value.tick.return_value = {"started": ["123"], "skipped": [],
+                                                    "failed": {}}
+    response = client.post("/scheduler/tick", headers={"Authorization": "bearer ABC123"})
+    assert_that(response.status_code).is_equal_to(200)
+    assert_that(response.json["started"]).is_equal_to(["123"])
@@ -0,0 +1,149 @@
+"""
+Tests for the sms outbox
+"""
+from datetime import datetime, timedelta
+from unittest.mock import patch, MagicMock
+from assertpy import assert_that
+
+from reminder.outbox import Outbox, enqueue_sms, OUTBOX
+from reminder.third_party_interfaces import MemoryBackend
+
+# pylint: disable=unused-argument
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=protected-access
+
+@patch("reminder.third_party_interfaces.backend.get_backend")
+class TestOutbox:
+
+    def test_enqueued_message_is_sent_and_removed(self, get_backend:MagicMock):
+        backend = get_backend.return_value = MemoryBackend()
+        send = MagicMock()
+        outbox = Outbox(send)
+        outbox.enqueue("+12222222222", "Got it! Thanks!")
+        assert_that(outbox.wait_until_empty(5)).is_true()
+
+        send.assert_called_once_with("+12222222222", "Got it! Thanks!")
+        assert_that(list(backend.stream_documents(OUTBOX))).is_empty()
+        assert_that(outbox.stats()).contains_entry({"depth": 0}, {"sent": 1}, {"failed": 0})
+
+    def test_failed_send_is_retried(self, get_backend:MagicMock):
+        get_backend.return_value = MemoryBackend()
+        send = MagicMock(side_effect=[RuntimeError("timeout"), None])
+        outbox = Outbox(send, backoff=0)
+        outbox.enqueue("+12222222222", "Got it! Thanks!")
+        assert_that(outbox.wait_until_empty(5)).is_true()
+
+        assert_that(send.call_count).is_equal_to(2)
+        assert_that(outbox.stats()).contains_entry({"sent": 1}, {"retried": 1})
+
+    def test_message_kept_after_last_attempt(self, get_backend:MagicMock):
+        backend = get_backend.return_value = MemoryBackend()
+        send = MagicMock(side_effect=RuntimeError("unreachable"))
+        outbox = Outbox(send, max_attempts=2, backoff=0)
+        message_id = outbox.enqueue("+12222222222", "Got it! Thanks!")
+        assert_that(outbox.wait_until_empty(5)).is_true()
+
+        assert_that(send.call_count).is_equal_to(2)
+        assert_that(backend.get_document(OUTBOX, message_id)) \
+            .contains_entry({"status": "failed"}, {"attempts": 2}, {"error": "unreachable"})
+        assert_that(outbox.stats()).contains_entry({"failed": 1})
+
+    def test_storage_failure_does_not_stop_the_worker(self, get_backend:MagicMock):
+        backend = get_backend.return_value = MemoryBackend()
+        failures = [RuntimeError("unavailable")]
+        def delete_document(collection:str, document_id:str) -> None:
+            if failures:
+                raise failures.pop()
+            MemoryBackend.delete_document(backend, collection, document_id)
+        backend.delete_document = delete_document
+        send = MagicMock()
+        outbox = Outbox(send)
+        outbox.enqueue("+12222222222", "Got it! Thanks!")
+        assert_that(outbox.wait_until_empty(5)).is_true()
+        outbox.enqueue("+13333333333", "Got it! Thanks!")
+        assert_that(outbox.wait_until_empty(5)).is_true()
+
+        assert_that(send.call_count).is_equal_to(2)
+        assert_that(outbox._worker.is_alive()).is_true()
+        assert_that(outbox._messages).is_empty()
+        assert_that([record.id for record in backend.stream_documents(OUTBOX)]).is_length(1)
+        assert_that(outbox.stats()).contains_entry({"depth": 0}, {"sent": 2})
+
+    def test_recover_requeues_messages_with_expired_leases(self, get_backend:MagicMock):
+        backend = get_backend.return_value = MemoryBackend()
+        now = datetime.now()
+        expired, live = now - timedelta(minutes=1), now + timedelta(minutes=1)
+        backend.set_document(OUTBOX, "expired", {"to": "+1", "body": "a", "attempts": 0,
+                                                 "status": "pending", "created": now,
+                                                 "lease_expires": expired})
+        backend.set_document(OUTBOX, "leased", {"to": "+2", "body": "b", "attempts": 0,
+                                                "status": "pending", "created": now,
+                                                "lease_expires": live})
+        backend.set_document(OUTBOX, "unleased", {"to": "+3", "body": "c", "attempts": 0,
+                                                  "status": "pending",
+                                                  "created": now - timedelta(hours=1)})
+        backend.set_document(OUTBOX, "failed", {"to": "+4", "body": "d", "attempts": 5,
+                                                "status": "failed", "created": now,
+                                                "lease_expires": expired})
+        send = MagicMock()
+        outbox = Outbox(send)
+        assert_that(outbox.recover()).is_equal_to(2)
+        assert_that(outbox.wait_until_empty(5)).is_true()
+        assert_that(sorted(call.args for call in send.call_args_list)) \
+            .is_equal_to([("+1", "a"), ("+3", "c")])
+
+    @patch("reminder.outbox.Thread")
+    def test_recovered_once_across_instances(self, thread:MagicMock, get_backend:MagicMock):
+        backend = get_backend.return_value = MemoryBackend()
+        backend.set_document(OUTBOX, "stale", {"to": "+1", "body": "a", "attempts": 0,
+                                               "status": "pending", "created": datetime.now(),
+                                               "lease_expires": datetime(2023, 1, 1)})
+        assert_that(Outbox(MagicMock()).recover()).is_equal_to(1)
+        assert_that(Outbox(MagicMock()).recover()).is_equal_to(0)
+        assert_that(backend.get_document(OUTBOX, "stale")["lease_expires"]) \
+            .is_greater_than(datetime.now())
+
+    @patch("reminder.outbox.commit_documents", return_value=False)
+    def test_message_claimed_by_another_instance_is_not_recovered(self,
+                                                                  commit_documents:MagicMock,
+                                                                  get_backend:MagicMock):
+        backend = get_backend.return_value = MemoryBackend()
+        backend.set_document(OUTBOX, "stale", {"to": "+1", "body": "a", "attempts": 0,
+                                               "status": "pending", "created": datetime.now(),
+                                               "lease_expires": datetime(2023, 1, 1)})
+        send = MagicMock()
+        outbox = Outbox(send)
+        assert_that(outbox.recover()).is_equal_to(0)
+        commit_documents.assert_called_once()
+        assert_that(outbox.depth()).is_equal_to(0)
+        send.assert_not_called()
+
+    @patch("reminder.outbox.Thread")
+    def test_retry_renews_the_lease(self, thread:MagicMock, get_backend:MagicMock):
+        backend = get_backend.return_value = MemoryBackend()
+        send = MagicMock(side_effect=RuntimeError("timeout"))
+        outbox = Outbox(send, max_attempts=3, backoff=60, lease=30)
+        message_id = outbox.enqueue("+12222222222", "Got it! Thanks!")
+        enqueued = backend.get_document(OUTBOX, message_id)["lease_expires"]
+        outbox._deliver(message_id)
+        assert_that(backend.get_document(OUTBOX, message_id)) \
+            .contains_entry({"attempts": 1})
+        assert_that(backend.get_document(OUTBOX, message_id)["lease_expires"] - enqueued) \
+            .is_greater_than_or_equal_to(timedelta(seconds=59))
+
+@patch("reminder.outbox.get_outbox")
+@patch("reminder.outbox.send_sms")
+def test_enqueue_sms_sends_immediately_when_disabled(send_sms:MagicMock,
+                                                     get_outbox:MagicMock):
+    enqueue_sms("+12222222222", "message")
+    send_sms.assert_called_once_with("+12222222222", "message")
+    get_outbox.assert_not_called()
+
+@patch.dict("os.environ", {"OUTBOX_ENABLED": "True"})
+@patch("reminder.outbox.get_outbox")
+@patch("reminder.outbox.send_sms")
+def test_enqueue_sms_uses_outbox_when_enabled(send_sms:MagicMock, get_outbox:MagicMock):
+    enqueue_sms("+12222222222", "message")
+    get_outbox.return_value.enqueue.assert_called_once_with("+12222222222", "message")
+    send_sms.assert_not_called()
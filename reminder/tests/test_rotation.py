@@ -5,6 +5,9 @@ from unittest.mock import patch, MagicMock, call
 from itertools import islice
 from assertpy import assert_that
 from reminder import Rotation
+from reminder.rotation import find_collection
+from reminder.commands import HELP_MESSAGE, UNKNOWN_MESSAGE
+from reminder.third_party_interfaces import MemoryBackend
 
 # pylint: disable=unused-argument
 # pylint: disable=missing-function-docstring
@@ -24,7 +27,29 @@ class TestRotation:
         activate_reminder.assert_not_called()
 
 @patch("reminder.rotation.reminder_is_active")
-@patch("reminder.rotation.get_users_by_last_completed_date")
+@patch("reminder.rotation.get_collections_by_phone_number")
+class TestFindCollection:
+
+    def test_unindexed_number_uses_default(self, get_collections:MagicMock,
+                                           reminder_is_active:MagicMock):
+        get_collections.return_value = []
+        assert_that(find_collection("+5551234567")).is_equal_to("trash-reminder")
+        reminder_is_active.assert_not_called()
+
+    def test_single_collection(self, get_collections:MagicMock,
+                               reminder_is_active:MagicMock):
+        get_collections.return_value = ["123"]
+        reminder_is_active.return_value = False
+        assert_that(find_collection("+5551234567")).is_equal_to("123")
+
+    def test_active_collection_wins(self, get_collections:MagicMock,
+                                    reminder_is_active:MagicMock):
+        get_collections.return_value = ["123", "456"]
+        reminder_is_active.side_effect = lambda collection: collection == "456"
+        assert_that(find_collection("+5551234567")).is_equal_to("456")
+
+@patch("reminder.rotation.reminder_is_active")
+@patch("reminder.rotation.get_next_user")
 @patch("reminder.rotation.get_all_users_by_collection")
 @patch("reminder.rotation.send_sms")
 @patch("reminder.rotation.update_user_attempted")
@@ -34,30 +59,82 @@ class TestSendReminder:
                                                     update_user_attempted:MagicMock,
                                                     send_sms:MagicMock,
                                                     get_all_users_by_collection:MagicMock,
-                                                    get_users_by_last_completed:MagicMock,
+                                                    get_next_user:MagicMock,
                                                     reminder_is_active:MagicMock):
         """
         This test ensures that if a key is sent in that does not match a user,
         the proper error is thrown by the application
         """
-        get_users_by_last_completed.return_value = islice([],0)
+        get_next_user.return_value = None
         snapshot = MagicMock()
         snapshot.to_dict.return_value = {"name": "Brian"}
         snapshot.id = "123"
         get_all_users_by_collection.return_value = islice([snapshot], None)
 
         rotation = Rotation("collection", "unknown")
-        rotation.send_reminder("collection")
+        summary = rotation.send_reminder("collection")
 
-        get_users_by_last_completed.assert_called()
+        get_next_user.assert_called_once_with("collection")
         send_sms.assert_called_once_with("123", "Hi Brian, NOBODY is able to take out the trash " +
                                          "tonight! 🤷‍♂️ Figure it out, humans!")
+        assert_that(summary).is_equal_to({"sent": ["123"], "failed": {}})
+
+    def test_send_reminder_broadcast_collects_failures(self,
+                                                    update_user_attempted:MagicMock,
+                                                    send_sms:MagicMock,
+                                                    get_all_users_by_collection:MagicMock,
+                                                    get_next_user:MagicMock,
+                                                    reminder_is_active:MagicMock):
+        """
+        A recipient that cannot be reached should not stop the rest of the household
+        from being sent the broadcast
+        """
+        get_next_user.return_value = None
+        snapshots = []
+        for phone_number, name in [("111", "Brian"), ("222", "Annie"), ("333", "Haley")]:
+            snapshot = MagicMock()
+            snapshot.to_dict.return_value = {"name": name}
+            snapshot.id = phone_number
+            snapshots.append(snapshot)
+        get_all_users_by_collection.return_value = islice(snapshots, None)
+
+        def fail_for_annie(phone_number, message):
+            if phone_number == "222":
+                raise RuntimeError("unreachable")
+        send_sms.side_effect = fail_for_annie
+
+        rotation = Rotation("collection", "unknown")
+        summary = rotation.send_reminder("collection")
+
+        assert_that(send_sms.call_count).is_equal_to(3)
+        assert_that(summary["sent"]).contains_only("111", "333")
+        assert_that(summary["failed"]).is_equal_to({"222": "unreachable"})
+
+    @patch.dict("os.environ", {"BROADCAST_CONCURRENCY": "0"})
+    def test_send_reminder_broadcast_with_no_concurrency(self,
+                                                    update_user_attempted:MagicMock,
+                                                    send_sms:MagicMock,
+                                                    get_all_users_by_collection:MagicMock,
+                                                    get_next_user:MagicMock,
+                                                    reminder_is_active:MagicMock):
+        """
+        A misconfigured concurrency still sends the broadcast one message at a time
+        """
+        get_next_user.return_value = None
+        snapshot = MagicMock()
+        snapshot.to_dict.return_value = {"name": "Brian"}
+        snapshot.id = "123"
+        get_all_users_by_collection.return_value = islice([snapshot], None)
+
+        summary = Rotation("collection", "unknown").send_reminder("collection")
+
+        assert_that(summary).is_equal_to({"sent": ["123"], "failed": {}})
 
     def test_send_reminder(self,
                             update_user_attempted:MagicMock,
                             send_sms:MagicMock,
                             get_all_users_by_collection:MagicMock,
-                            get_users_by_last_completed:MagicMock,
+                            get_next_user:MagicMock,
                             reminder_is_active:MagicMock):
         """
         This tests the send_reminder function
@@ -69,7 +146,7 @@ class TestSendReminder:
         user_record = MagicMock()
         user_record.id = phone_number
         user_record.to_dict.return_value = { "name": name, }
-        get_users_by_last_completed.return_value = islice([user_record], None)
+        get_next_user.return_value = user_record
 
         rotation = Rotation("collection", "unknown")
         rotation.send_reminder("123")
@@ -78,17 +155,17 @@ class TestSendReminder:
         update_user_attempted.assert_called_once_with("123", phone_number)
 
 @patch("reminder.rotation.reminder_is_active")
-@patch("reminder.rotation.complete_reminder")
+@patch("reminder.rotation.accept_reminder")
 @patch("reminder.rotation.update_user_response")
 @patch("reminder.rotation.get_user_by_phone_number")
-@patch("reminder.rotation.send_sms")
+@patch("reminder.rotation.enqueue_sms")
 class TestRecieve:
 
     def test_recieve_positive_response(self,
-                                    send_sms:MagicMock,
+                                    enqueue_sms:MagicMock,
                                     get_user_by_phone_number:MagicMock,
                                     update_user_response:MagicMock,
-                                    complete_reminder:MagicMock,
+                                    accept_reminder:MagicMock,
                                     reminder_is_active:MagicMock):
         """
         This test verifies that the application responds correctly 
@@ -100,20 +177,21 @@ class TestRecieve:
         user_record = MagicMock()
         user_record.exists = True
         get_user_by_phone_number.return_value = user_record
-        reminder_is_active.return_value = True
+        accept_reminder.return_value = True
 
         rotation = Rotation("", "")
         rotation.receive(collection, phone_number, message_body)
 
-        send_sms.assert_called_once_with(phone_number, "Got it! Thanks!")
-        update_user_response.assert_called_once_with(collection, phone_number, message_body)
-        complete_reminder.assert_called_once_with(collection, phone_number)
+        enqueue_sms.assert_called_once_with(phone_number, "Got it! Thanks!")
+        accept_reminder.assert_called_once_with(collection, phone_number, message_body)
+        update_user_response.assert_not_called()
+        reminder_is_active.assert_not_called()
 
     def test_recieve_from_non_user(self,
-                                    send_sms:MagicMock,
+                                    enqueue_sms:MagicMock,
                                     get_user_by_phone_number:MagicMock,
                                     update_user_response:MagicMock,
-                                    complete_reminder:MagicMock,
+                                    accept_reminder:MagicMock,
                                     reminder_is_active:MagicMock):
         '''
         This should not happen, because the number should be validated before calling this function
@@ -123,14 +201,14 @@ class TestRecieve:
         get_user_by_phone_number.return_value = user_record
 
         rotation = Rotation("", "")
-        assert_that(rotation.receive).raises(KeyError).when_called_with("123", "123", "blah")\
+        assert_that(rotation.receive).raises(KeyError).when_called_with("123", "123", "yes")\
         .contains('not found')
 
     def test_recieve_non_valid_response(self,
-                                    send_sms:MagicMock,
+                                    enqueue_sms:MagicMock,
                                     get_user_by_phone_number:MagicMock,
                                     update_user_response:MagicMock,
-                                    complete_reminder:MagicMock,
+                                    accept_reminder:MagicMock,
                                     reminder_is_active:MagicMock):
         """
         This tests that the recieve function responds correctly to 
@@ -147,16 +225,34 @@ class TestRecieve:
         rotation = Rotation("", "")
         rotation.receive(collection, phone_number, message_body)
 
-        send_sms.assert_called_once_with(phone_number, "I did not understand your response." +
-                                         " Please send only yes, no, y or n.")
+        enqueue_sms.assert_called_once_with(phone_number, "I did not understand your response." +
+                                         " Please send yes or no, or HELP for more options.")
+        get_user_by_phone_number.assert_not_called()
         update_user_response.assert_not_called()
-        complete_reminder.assert_not_called()
+        accept_reminder.assert_not_called()
+
+    def test_help_and_stop_do_not_read_storage(self,
+                                    enqueue_sms:MagicMock,
+                                    get_user_by_phone_number:MagicMock,
+                                    update_user_response:MagicMock,
+                                    accept_reminder:MagicMock,
+                                    reminder_is_active:MagicMock):
+        """
+        HELP is answered and STOP left to twilio without touching storage
+        """
+        rotation = Rotation(None)
+        rotation.receive(None, "+5551234567", " Help ")
+        rotation.receive(None, "+5551234567", "STOP")
+
+        enqueue_sms.assert_called_once_with("+5551234567", HELP_MESSAGE)
+        get_user_by_phone_number.assert_not_called()
+        reminder_is_active.assert_not_called()
 
     def test_recieve_completed_reminder(self,
-                                    send_sms:MagicMock,
+                                    enqueue_sms:MagicMock,
                                     get_user_by_phone_number:MagicMock,
                                     update_user_response:MagicMock,
-                                    complete_reminder:MagicMock,
+                                    accept_reminder:MagicMock,
                                     reminder_is_active:MagicMock):
         """
         This test makes sure the application responds correctly when
@@ -169,25 +265,25 @@ class TestRecieve:
         user_record = MagicMock()
         user_record.exists = True
         get_user_by_phone_number.return_value = user_record
-        reminder_is_active.return_value = False
+        accept_reminder.return_value = False
 
         rotation = Rotation("", "")
         rotation.receive(collection, phone_number, message_body)
 
-        send_sms.assert_called_once_with(phone_number, "Someone already responded, " +
+        enqueue_sms.assert_called_once_with(phone_number, "Someone already responded, " +
                                          "so don't worry about it!")
         update_user_response.assert_not_called()
-        complete_reminder.assert_not_called()
+        accept_reminder.assert_called_once_with(collection, phone_number, message_body)
 
-    @patch("reminder.rotation.get_users_by_last_completed_date")
+    @patch("reminder.rotation.get_next_user")
     @patch("reminder.rotation.update_user_attempted")
     def test_recieve_negative_response(self,
                                     update_user_attempted:MagicMock,
-                                    get_users_by_last_completed_date:MagicMock,
-                                    send_sms:MagicMock,
+                                    get_next_user:MagicMock,
+                                    enqueue_sms:MagicMock,
                                     get_user_by_phone_number:MagicMock,
                                     update_user_response:MagicMock,
-                                    complete_reminder:MagicMock,
+                                    accept_reminder:MagicMock,
                                     reminder_is_active:MagicMock):
         """
         This test verifies that the receive function responds correctly when
@@ -208,13 +304,101 @@ class TestRecieve:
         next_user_record.to_dict.return_value = { "name": "Other", }
         get_user_by_phone_number.return_value = user_record
         reminder_is_active.return_value = True
-        get_users_by_last_completed_date.return_value = islice([next_user_record], None)
+        get_next_user.return_value = next_user_record
 
         rotation = Rotation("", "")
         rotation.receive(collection, phone_number, message_body)
 
-        send_sms.assert_has_calls([call(phone_number, message),
+        enqueue_sms.assert_has_calls([call(phone_number, message),
                                    call(next_phone_number, next_message)])
         update_user_response.assert_called_once_with(collection, phone_number ,message_body)
         update_user_attempted.assert_called_once_with(collection, next_phone_number)
-        complete_reminder.assert_not_called()
+        accept_reminder.assert_not_called()
+
+    @patch("reminder.rotation.get_next_user")
+    @patch("reminder.rotation.update_user_attempted")
+    def test_recieve_swap_names_the_swapper(self,
+                                    update_user_attempted:MagicMock,
+                                    get_next_user:MagicMock,
+                                    enqueue_sms:MagicMock,
+                                    get_user_by_phone_number:MagicMock,
+                                    update_user_response:MagicMock,
+                                    accept_reminder:MagicMock,
+                                    reminder_is_active:MagicMock):
+        """
+        SWAP hands the turn on like no, telling the next person who asked to swap
+        """
+        get_user_by_phone_number.return_value.to_dict.return_value = {"name": "Brian"}
+        next_user_record = MagicMock(id="+4441234567")
+        next_user_record.to_dict.return_value = {"name": "Other"}
+        get_next_user.return_value = next_user_record
+        reminder_is_active.return_value = True
+
+        Rotation("").receive("123", "+5551234567", "swap 👍🏽")
+        enqueue_sms.assert_called_once_with("+5551234567", UNKNOWN_MESSAGE)
+
+        enqueue_sms.reset_mock()
+        Rotation("").receive("123", "+5551234567", "Swap!")
+        enqueue_sms.assert_called_with("+4441234567", "Hi Other, Brian asked to swap, so it's " +
+                                       "your turn to take out the trash tonight! Can you pick " +
+                                       "it up tonight? Please respond with Yes or No.")
+        update_user_response.assert_called_once_with("123", "+5551234567", "Swap!")
+
+@patch("reminder.outbox.send_sms")
+@patch("reminder.third_party_interfaces.backend.get_backend")
+class TestReplyUnitOfWork:
+    @staticmethod
+    def _household(get_backend:MagicMock) -> tuple[MemoryBackend, str, str]:
+        """
+        Returns the backend, who was asked first and who is next
+        """
+        backend = MemoryBackend()
+        backend.set_document("reminders", "123", {})
+        backend.add_user("123", "+11111111111", "Brian")
+        backend.add_user("123", "+12222222222", "Annie")
+        get_backend.return_value = backend
+        send = MagicMock()
+        Rotation("123", "new").send_reminder("123", send)
+        first = send.call_args.args[0]
+        return backend, first, ({"+11111111111", "+12222222222"} - {first}).pop()
+
+    def test_no_read_and_written_once(self, get_backend:MagicMock, send_sms:MagicMock):
+        """
+        A no reads the user and reminder in one batch and commits in one batch,
+        sending the replies only after the commit
+        """
+        backend, first, second = self._household(get_backend)
+        get_backend.return_value = MagicMock(wraps=backend)
+        get_backend.return_value.commit_documents.side_effect = lambda *args: \
+            send_sms.assert_not_called() or backend.commit_documents(*args)
+
+        Rotation("123").receive("123", first, "No")
+
+        get_backend.return_value.get_documents.assert_called_once()
+        get_backend.return_value.get_document.assert_not_called()
+        get_backend.return_value.commit_documents.assert_called_once()
+        assert_that(send_sms.call_args_list).is_length(2)
+        send_sms.assert_any_call(first, "Got it! Thanks!")
+        assert_that(send_sms.call_args.args[0]).is_equal_to(second)
+        assert_that(backend.get_document("123", first)["last_response"]).is_equal_to("No")
+        assert_that(backend.get_document("123", second)["last_attempted"].year) \
+            .is_greater_than(2000)
+
+    def test_conflict_handled_again(self, get_backend:MagicMock, send_sms:MagicMock):
+        """
+        A reply racing another write is dropped with its messages and handled again
+        """
+        backend, first, _ = self._household(get_backend)
+        get_backend.return_value = MagicMock(wraps=backend)
+        def racing_read(keys):
+            records = backend.get_documents(keys)
+            backend.update_document("123", first, {"last_response": "Maybe"})
+            return records
+        get_backend.return_value.get_documents.side_effect = racing_read
+
+        Rotation("123").receive("123", first, "Yes")
+
+        get_backend.return_value.commit_documents.assert_called_once()
+        send_sms.assert_called_once_with(first, "Got it! Thanks!")
+        assert_that(backend.get_document("reminders", "123")["status"]).is_equal_to("inactive")
+        assert_that(backend.get_document("123", first)["last_response"]).is_equal_to("Yes")
@@ -0,0 +1,224 @@
+"""
+Tests for the in-process scheduler
+"""
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from unittest.mock import patch, MagicMock
+from assertpy import assert_that
+
+from reminder.dedup import reset_deduplicator
+from reminder.rotation import Rotation
+from reminder.scheduler import CronSchedule, Scheduler
+from reminder.third_party_interfaces import MemoryBackend, RESPONSE_DEADLINE, deadline_of
+
+# pylint: disable=unused-argument
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=protected-access
+
+THURSDAY = datetime(2023, 3, 2, 12, 0)
+
+class TestCronSchedule:
+
+    def test_weekly_schedule(self):
+        schedule = CronSchedule("0 17 * * THU")
+        assert_that(schedule.next_after(THURSDAY)).is_equal_to(datetime(2023, 3, 2, 17, 0))
+        assert_that(schedule.next_after(datetime(2023, 3, 2, 17, 0))) \
+            .is_equal_to(datetime(2023, 3, 9, 17, 0))
+
+    def test_lists_ranges_and_steps(self):
+        schedule = CronSchedule("*/15 9-10 * * 1-5")
+        assert_that(schedule.next_after(datetime(2023, 3, 3, 10, 50))) \
+            .is_equal_to(datetime(2023, 3, 6, 9, 0))
+        assert_that(schedule.next_after(datetime(2023, 3, 6, 9, 0))) \
+            .is_equal_to(datetime(2023, 3, 6, 9, 15))
+        assert_that(CronSchedule("30 8 1,15 * *").next_after(THURSDAY)) \
+            .is_equal_to(datetime(2023, 3, 15, 8, 30))
+
+    def test_sunday_is_zero_or_seven(self):
+        assert_that(CronSchedule("0 0 * * 7").next_after(THURSDAY)) \
+            .is_equal_to(CronSchedule("0 0 * * SUN").next_after(THURSDAY))
+
+    def test_either_day_field_matches_when_both_are_set(self):
+        assert_that(CronSchedule("0 0 13 * FRI").next_after(THURSDAY)) \
+            .is_equal_to(datetime(2023, 3, 3, 0, 0))
+
+    def test_schedule_in_time_zone(self):
+        new_york = ZoneInfo("America/New_York")
+        def local(wall_time:datetime) -> datetime:
+            return wall_time.replace(tzinfo=new_york).astimezone().replace(tzinfo=None)
+
+        schedule = CronSchedule("0 17 * * THU", new_york)
+        assert_that(schedule.next_after(local(THURSDAY))) \
+            .is_equal_to(local(datetime(2023, 3, 2, 17, 0)))
+        # daylight saving time starts between the two runs
+        assert_that(schedule.next_after(local(datetime(2023, 3, 9, 17, 0)))) \
+            .is_equal_to(local(datetime(2023, 3, 16, 17, 0)))
+
+    def test_invalid_expressions(self):
+        assert_that(CronSchedule).raises(ValueError).when_called_with("0 17 * *")
+        assert_that(CronSchedule).raises(ValueError).when_called_with("0 25 * * *")
+        assert_that(CronSchedule).raises(ValueError).when_called_with("0 17 * * FUNDAY")
+
+@patch("reminder.third_party_interfaces.backend.get_backend")
+class TestScheduler:
+
+    def setup_method(self):
+        reset_deduplicator()
+
+    def _backend(self, get_backend:MagicMock) -> MemoryBackend:
+        backend = get_backend.return_value = MemoryBackend()
+        backend.set_document("reminders", "trash", {"schedule": "0 17 * * THU"})
+        backend.set_document("reminders", "recycling", {"schedule": "30 17 * * THU"})
+        backend.set_document("reminders", "manual", {"status": "active"})
+        return backend
+
+    def test_tick_starts_due_rotations_once(self, get_backend:MagicMock):
+        self._backend(get_backend)
+        start_rotation = MagicMock()
+        scheduler = Scheduler(start_rotation)
+
+        assert_that(scheduler.tick(THURSDAY)["started"]).is_empty()
+        assert_that(scheduler.next_due()).is_equal_to(datetime(2023, 3, 2, 17, 0))
+        summary = scheduler.tick(datetime(2023, 3, 2, 17, 31))
+        assert_that(sorted(summary["started"])).is_equal_to(["recycling", "trash"])
+        assert_that(summary["skipped"]).is_empty()
+        assert_that(scheduler.tick(datetime(2023, 3, 2, 17, 32))["started"]).is_empty()
+        assert_that(start_rotation.call_count).is_equal_to(2)
+        assert_that(scheduler.next_due()).is_equal_to(datetime(2023, 3, 9, 17, 0))
+
+    def test_other_instance_already_started_rotation(self, get_backend:MagicMock):
+        self._backend(get_backend)
+        first, second = MagicMock(), MagicMock()
+        Scheduler(first).tick(datetime(2023, 3, 2, 17, 1))
+        summary = Scheduler(second).tick(datetime(2023, 3, 2, 17, 2))
+        first.assert_called_once_with("trash")
+        second.assert_not_called()
+        assert_that(summary["skipped"]).is_equal_to(["trash"])
+
+    def test_failed_rotation_does_not_stop_others(self, get_backend:MagicMock):
+        self._backend(get_backend)
+        start_rotation = MagicMock(side_effect=lambda collection:
+                                   1 / 0 if collection == "trash" else None)
+        summary = Scheduler(start_rotation, grace=timedelta(hours=1)) \
+            .tick(datetime(2023, 3, 2, 17, 31))
+        assert_that(summary["started"]).is_equal_to(["recycling"])
+        assert_that(summary["failed"]).contains_key("trash")
+
+    def test_failed_rotation_is_retried(self, get_backend:MagicMock):
+        self._backend(get_backend)
+        failures = [RuntimeError("unavailable")]
+        def fail_once(collection:str) -> None:
+            if failures:
+                raise failures.pop()
+        start_rotation = MagicMock(side_effect=fail_once)
+        scheduler = Scheduler(start_rotation)
+        assert_that(scheduler.tick(datetime(2023, 3, 2, 17, 1))["failed"]).contains_key("trash")
+        assert_that(scheduler.next_due()).is_equal_to(datetime(2023, 3, 2, 17, 2))
+
+        assert_that(scheduler.tick(datetime(2023, 3, 2, 17, 2))["started"]) \
+            .is_equal_to(["trash"])
+        assert_that(start_rotation.call_count).is_equal_to(2)
+        assert_that(Scheduler(MagicMock()).tick(datetime(2023, 3, 2, 17, 3))["skipped"]) \
+            .is_equal_to(["trash"])
+        scheduler.tick(datetime(2023, 3, 2, 17, 30))
+        assert_that(scheduler.next_due()).is_equal_to(datetime(2023, 3, 9, 17, 0))
+
+    def test_invalid_schedules_are_skipped(self, get_backend:MagicMock):
+        backend = self._backend(get_backend)
+        backend.set_document("reminders", "typo", {"schedule": "0 17 * *"})
+        backend.set_document("reminders", "never", {"schedule": "0 17 31 2 *"})
+        start_rotation = MagicMock()
+        summary = Scheduler(start_rotation).tick(datetime(2023, 3, 2, 17, 1))
+        assert_that(summary["started"]).is_equal_to(["trash"])
+        start_rotation.assert_called_once_with("trash")
+
+    @patch.dict("os.environ", {"SCHEDULER_TZ": "America/New_York"})
+    def test_schedules_run_in_configured_time_zone(self, get_backend:MagicMock):
+        backend = self._backend(get_backend)
+        backend.update_document("reminders", "recycling", {"time_zone": "Europe/Paris"})
+        backend.set_document("reminders", "unknown", {"schedule": "0 17 * * THU",
+                                                      "time_zone": "Mars/Olympus_Mons"})
+        scheduler = Scheduler(MagicMock())
+        # a day early, so both runs are still ahead whatever the local time zone
+        scheduler.load(THURSDAY - timedelta(days=1))
+        due = {collection: due for due, collection in scheduler._heap}
+        assert_that(due).is_equal_to({
+            "trash": datetime(2023, 3, 2, 17, 0, tzinfo=ZoneInfo("America/New_York"))
+                .astimezone().replace(tzinfo=None),
+            "recycling": datetime(2023, 3, 2, 17, 30, tzinfo=ZoneInfo("Europe/Paris"))
+                .astimezone().replace(tzinfo=None)})
+
+    def test_changed_schedule_is_reloaded(self, get_backend:MagicMock):
+        backend = self._backend(get_backend)
+        scheduler = Scheduler(MagicMock(), reload_interval=timedelta(minutes=5))
+        scheduler.tick(THURSDAY)
+        backend.update_document("reminders", "trash", {"schedule": "0 13 * * THU"})
+        scheduler.tick(THURSDAY + timedelta(minutes=1))
+        assert_that(scheduler.next_due()).is_equal_to(datetime(2023, 3, 2, 17, 0))
+        scheduler.tick(THURSDAY + timedelta(minutes=5))
+        assert_that(scheduler.next_due()).is_equal_to(datetime(2023, 3, 2, 13, 0))
+
+    def test_background_thread_ticks_until_stopped(self, get_backend:MagicMock):
+        get_backend.return_value = MemoryBackend()
+        scheduler = Scheduler(MagicMock())
+        scheduler.start()
+        scheduler.stop()
+        assert_that(scheduler.next_due()).is_none()
+
+@patch("reminder.third_party_interfaces.backend.get_backend")
+class TestResponseDeadlines:
+
+    def setup_method(self):
+        reset_deduplicator()
+
+    def _backend(self, get_backend:MagicMock, due:datetime) -> MemoryBackend:
+        backend = get_backend.return_value = MemoryBackend()
+        backend.set_document("reminders", "trash", {
+            "status": "active", RESPONSE_DEADLINE: {"phone_number": "+12222222222", "due": due}})
+        return backend
+
+    def test_expired_deadline_escalates_once(self, get_backend:MagicMock):
+        backend = self._backend(get_backend, THURSDAY)
+        next_deadline = {"phone_number": "+11111111111", "due": THURSDAY + timedelta(hours=1)}
+        escalate = MagicMock(side_effect=lambda collection: backend.update_document(
+            "reminders", collection, {RESPONSE_DEADLINE: next_deadline}))
+        scheduler = Scheduler(MagicMock(), escalate=escalate)
+
+        assert_that(scheduler.tick(THURSDAY - timedelta(minutes=1))["escalated"]).is_empty()
+        assert_that(scheduler.next_due()).is_equal_to(THURSDAY)
+        assert_that(scheduler.tick(THURSDAY)["escalated"]).is_equal_to(["trash"])
+        escalate.assert_called_once_with("trash")
+        assert_that(scheduler.next_due()).is_equal_to(next_deadline["due"])
+
+        summary = Scheduler(MagicMock(), escalate=escalate).tick(THURSDAY)
+        assert_that(summary["escalated"]).is_empty()
+        escalate.assert_called_once()
+
+    def test_answered_deadline_is_skipped(self, get_backend:MagicMock):
+        backend = self._backend(get_backend, THURSDAY)
+        escalate = MagicMock()
+        scheduler = Scheduler(MagicMock(), reload_interval=timedelta(days=1), escalate=escalate)
+        scheduler.load(THURSDAY - timedelta(hours=1))
+        backend.update_document("reminders", "trash", {"status": "inactive"})
+        summary = scheduler.tick(THURSDAY)
+        assert_that(summary["skipped"]).is_equal_to(["trash"])
+        escalate.assert_not_called()
+
+    @patch("reminder.rotation.send_sms")
+    def test_unanswered_reminder_moves_to_next_person(self, send_sms:MagicMock,
+                                                      get_backend:MagicMock):
+        backend = get_backend.return_value = MemoryBackend()
+        backend.set_document("reminders", "trash", {"response_timeout": 3600})
+        backend.add_user("trash", "+11111111111", "Brian")
+        backend.add_user("trash", "+12222222222", "Annie")
+        Rotation("trash", "new").send_reminder("trash")
+        first = send_sms.call_args.args[0]
+
+        scheduler = Scheduler(MagicMock())
+        assert_that(scheduler.tick(datetime.now())["escalated"]).is_empty()
+        summary = scheduler.tick(datetime.now() + timedelta(hours=1, seconds=1))
+        assert_that(summary["escalated"]).is_equal_to(["trash"])
+        second = send_sms.call_args.args[0]
+        assert_that(second).is_not_equal_to(first)
+        assert_that(deadline_of(backend.get_reminder("trash"))[1]).is_equal_to(second)
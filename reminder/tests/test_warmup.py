@@ -0,0 +1,31 @@
+"""
+Tests for the instance warm-up
+"""
+from unittest.mock import patch, MagicMock
+from assertpy import assert_that
+
+from reminder import warmup
+
+# pylint: disable=unused-argument
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+
+def test_warm_up_runs_every_step():
+    steps = [("first", MagicMock()), ("second", MagicMock())]
+    with patch.object(warmup, "STEPS", steps):
+        report = warmup.warm_up()
+    for _, step in steps:
+        step.assert_called_once_with()
+    assert_that(report["steps"]).contains_key("first", "second")
+    assert_that(report["total"]).is_equal_to(
+        round(sum(report["steps"].values()), 3))
+
+def test_failing_step_does_not_stop_warm_up(caplog):
+    last = MagicMock()
+    steps = [("twilio", MagicMock(side_effect=OSError("connection refused"))), ("last", last)]
+    with patch.object(warmup, "STEPS", steps):
+        report = warmup.warm_up()
+    last.assert_called_once_with()
+    assert_that(report).does_not_contain_key("errors")
+    assert_that(report["steps"]).contains_key("twilio", "last")
+    assert_that(caplog.text).contains("twilio", "connection refused")
@@ -1,8 +1,28 @@
 """
 Expose third party interface classes and functions for reminder consumption
 """
-from .database import get_users_by_last_completed_date, NULL_DATETIME, \
-                        get_user_by_phone_number, update_user_response, complete_reminder, \
-                        reminder_is_active, activate_reminder, update_user_attempted, \
-                        get_all_users_by_collection
-from .twilio_client import send_sms
+from .storage import NULL_DATETIME, MAX_BATCH_SIZE, ROTATION_QUEUE, RESPONSE_DEADLINE, \
+                     EVENTS, STATS, Record, StorageBackend, build_rotation_queue, deadline_of, \
+                     apply_events
+from .database import get_client, reset_client, clear_reminder_cache, FirestoreBackend
+from .memory_backend import MemoryBackend
+from .sqlite_backend import SQLiteBackend
+from .backend import get_backend, reset_backend, get_users_by_last_completed_date, \
+                     get_user_by_phone_number, update_user_response, reminder_is_active, \
+                     activate_reminder, update_user_attempted, get_all_users_by_collection, \
+                     accept_reminder, get_reminder, add_user, index_collection, \
+                     get_collections_by_phone_number, get_document, set_document, \
+                     create_document, update_document, delete_document, stream_documents, \
+                     write_documents, prime_reminder_cache, get_next_user, \
+                     rebuild_rotation_queue, verify_rotation_queue, record_events, \
+                     open_unit_of_work, commit_documents
+from .unit_of_work import UnitOfWork, WriteConflict, unit_of_work, current_unit_of_work
+from .twilio_client import send_sms, get_twilio_client, reset_twilio_client, \
+                           open_twilio_session, async_send_sms, reset_async_twilio_client, \
+                           SmsSender, get_sms_sender, reset_sms_sender, validate_twilio_request
+from . import async_database
+from .google_auth import verify_token, reset_token_cache, fetch_certificates
+from .shared import SharedInstance
+from .cache import TTLCache
+from .throttle import TokenBucket, KeyedTurns
+from .metrics import timed, observe, metrics_enabled, render_metrics, reset_metrics
@@ -0,0 +1,227 @@
+"""
+Asynchronous versions of the database functions on firestore.AsyncClient.
+The reminder and phone index caches are shared with the synchronous functions.
+"""
+# Deliberately mirrors the synchronous module line for line
+# pylint: disable=duplicate-code
+from datetime import datetime, timedelta
+from typing import Optional
+
+from google.cloud import firestore
+from google.cloud.firestore import ArrayUnion, AsyncTransaction, DocumentSnapshot, \
+                                   async_transactional
+from google.cloud.exceptions import NotFound
+
+from .database import _complete_if_active, _mark_attempted, _reminder_cache, _reminder_ttl, \
+                      _update_cached_reminder, _start_reminder_listener, _phone_index_cache, \
+                      _phone_index_ttl
+from .metrics import timed
+from .shared import SharedInstance
+from .storage import PHONE_INDEX, MAX_BATCH_SIZE, ROTATION_QUEUE, RESPONSE_DEADLINE, Record, \
+                     build_rotation_queue, next_in_queue
+
+def _create_client() -> firestore.AsyncClient:
+    return firestore.AsyncClient()
+
+_CLIENT = SharedInstance(_create_client)
+
+def get_async_client() -> firestore.AsyncClient:
+    """
+    Return the process-wide async firestore client, creating it on first use.
+    The client is bound to the event loop it is first used on.
+    """
+    return _CLIENT.get()
+
+def reset_async_client() -> None:
+    """
+    Drop the shared async firestore client so the next call creates a new one
+    """
+    _CLIENT.reset()
+
+@timed
+async def get_users_by_last_completed_date(collection:str, limit:int=None) \
+    -> list[DocumentSnapshot]:
+    """
+    Get users where last_attempted is before today ordered by last completed
+    """
+    before_today = datetime.now() - timedelta(days=1)
+    query = get_async_client().collection(collection).order_by("last_attempted") \
+                              .where("last_attempted", "<=", before_today) \
+                              .order_by("last_completed").limit(limit)
+    return [snapshot async for snapshot in query.stream()]
+
+@timed
+async def get_next_user(collection:str) -> Optional[Record]:
+    """
+    Return the next user on the rotation from the reminder's rotation queue,
+    or None if everyone was attempted today
+
+    raises NotFound: if collection does not exist
+    """
+    snapshot = await get_async_client().collection("reminders").document(collection).get()
+    if not snapshot.exists:
+        raise NotFound(f"reminder collection {collection} not found")
+
+    queue = snapshot.to_dict().get(ROTATION_QUEUE)
+    if queue is None:
+        queue = await rebuild_rotation_queue(collection)
+    entry = next_in_queue(queue)
+    return None if entry is None else Record(entry["phone_number"], entry)
+
+@timed
+async def rebuild_rotation_queue(collection:str) -> list[dict]:
+    """
+    Rebuild the rotation queue from the collection's users and store it on the reminder
+    """
+    queue = await _build_rotation_queue(collection)
+    await _update_reminder(collection, {ROTATION_QUEUE: queue})
+    return queue
+
+async def _build_rotation_queue(collection:str) -> list[dict]:
+    return build_rotation_queue([user async for user in
+                                 get_async_client().collection(collection).stream()])
+
+async def _update_reminder(collection:str, fields:dict) -> None:
+    await get_async_client().collection("reminders").document(collection).update(fields)
+    _update_cached_reminder(collection, fields)
+
+@timed
+async def get_user_by_phone_number(collection:str, phone_number:str) -> DocumentSnapshot:
+    """
+    Return user from phone number
+    """
+    return await get_async_client().collection(collection).document(phone_number).get()
+
+@timed
+async def get_all_users_by_collection(collection:str) -> list[DocumentSnapshot]:
+    """
+    Get all user records for a given collection
+    """
+    return [snapshot async for snapshot in get_async_client().collection(collection).stream()]
+
+@timed
+async def update_user_attempted(collection:str, phone_number:str) -> None:
+    """
+    Update a user's last_attempted to be now and move them to the back of the
+    reminder's rotation queue in the same transaction
+    """
+    db = get_async_client()
+    _update_cached_reminder(collection,
+                            await _update_user_attempted(db.transaction(), db, collection,
+                                                         phone_number))
+
+@async_transactional
+async def _update_user_attempted(transaction:AsyncTransaction, db:firestore.AsyncClient,
+                                 collection:str, phone_number:str) -> dict:
+    reminder = await db.collection("reminders").document(collection) \
+                       .get(transaction=transaction)
+    return _mark_attempted(transaction, db, reminder, collection, phone_number)
+
+@timed
+async def update_user_response(collection:str, phone_number:str, message_body:str) -> None:
+    """
+    Update users last response
+    """
+    await get_async_client().collection(collection).document(phone_number) \
+                            .update({"last_response": message_body})
+
+@timed
+async def accept_reminder(collection:str, phone_number:str, message_body:str) -> bool:
+    """
+    Record a user's acceptance and complete the reminder in a single transaction
+
+    returns false if the reminder was no longer active
+    raises NotFound: if collection does not exist
+    """
+    db = get_async_client()
+    update = await _accept_reminder(db.transaction(), db, collection, phone_number,
+                                    message_body)
+    if update is None:
+        _reminder_cache.pop(collection)
+        return False
+    _update_cached_reminder(collection, update)
+    return True
+
+@async_transactional
+async def _accept_reminder(transaction:AsyncTransaction, db:firestore.AsyncClient,
+                           collection:str, phone_number:str, message_body:str) \
+    -> Optional[dict]:
+    reminder = await db.collection("reminders").document(collection) \
+                       .get(transaction=transaction)
+    return _complete_if_active(transaction, reminder,
+                               db.collection(collection).document(phone_number), message_body)
+
+@timed
+async def get_reminder(collection:str) -> dict:
+    """
+    Return the reminder document for a collection, served from the shared cache
+
+    raises NotFound: if collection does not exist
+    """
+    _start_reminder_listener()
+    reminder = _reminder_cache.get(collection)
+    if reminder is not None:
+        return reminder
+
+    snapshot = await get_async_client().collection("reminders").document(collection).get()
+    if not snapshot.exists:
+        raise NotFound(f"reminder collection {collection} not found")
+
+    reminder = snapshot.to_dict()
+    _reminder_cache.set(collection, reminder, ttl=_reminder_ttl())
+    return reminder
+
+async def reminder_is_active(collection:str) -> bool:
+    """
+    returns true if collection's status is active
+
+    raises NotFound: if collection does not exist
+    """
+    return (await get_reminder(collection)).get("status") == "active"
+
+@timed
+async def activate_reminder(collection:str) -> None:
+    """
+    Set collection status to active, indexing its users and rebuilding its queue
+    """
+    await index_collection(collection)
+    await _update_reminder(collection, {"status": "active", RESPONSE_DEADLINE: None,
+                                        ROTATION_QUEUE: await _build_rotation_queue(collection)})
+
+@timed
+async def index_collection(collection:str) -> None:
+    """
+    Add every user of a collection to the phone number index,
+    in batches of up to MAX_BATCH_SIZE writes
+    """
+    db = get_async_client()
+    batch = db.batch()
+    pending = 0
+    async for user in db.collection(collection).stream():
+        batch.set(db.collection(PHONE_INDEX).document(user.id),
+                  {"collections": ArrayUnion([collection])}, merge=True)
+        _phone_index_cache.pop(user.id)
+        pending += 1
+        if pending == MAX_BATCH_SIZE:
+            await batch.commit()
+            batch = db.batch()
+            pending = 0
+
+    if pending:
+        await batch.commit()
+
+@timed
+async def get_collections_by_phone_number(phone_number:str) -> list[str]:
+    """
+    Return the collections a phone number belongs to, served from the shared cache.
+    Unknown numbers are not cached.
+    """
+    collections = _phone_index_cache.get(phone_number)
+    if collections is not None:
+        return collections
+
+    snapshot = await get_async_client().collection(PHONE_INDEX).document(phone_number).get()
+    collections = snapshot.to_dict().get("collections", []) if snapshot.exists else []
+    if collections:
+        _phone_index_cache.set(phone_number, collections, ttl=_phone_index_ttl())
+    return collections
@@ -0,0 +1,244 @@
+"""
+Select the storage backend with STORAGE_BACKEND and route the storage
+functions used by the rest of the application through it
+"""
+from os import environ
+from typing import ContextManager, Iterable, Iterator, Optional
+
+from .database import FirestoreBackend
+from .memory_backend import MemoryBackend
+from .metrics import timed
+from .shared import SharedInstance
+from .sqlite_backend import SQLiteBackend
+from .storage import Record, StorageBackend
+from .unit_of_work import UnitOfWork, current_unit_of_work, unit_of_work
+
+def _create_backend() -> StorageBackend:
+    name = environ.get("STORAGE_BACKEND", "firestore")
+    if name == "firestore":
+        return FirestoreBackend()
+    if name == "memory":
+        return MemoryBackend()
+    if name == "sqlite":
+        return SQLiteBackend(environ.get("SQLITE_PATH", "reminder.sqlite3"))
+    raise ValueError(f"Unknown STORAGE_BACKEND {name}, expected firestore, memory or sqlite")
+
+_BACKEND = SharedInstance(_create_backend)
+
+def get_backend() -> StorageBackend:
+    """
+    Return the process-wide storage backend, creating it on first use
+    """
+    return _BACKEND.get()
+
+def reset_backend() -> None:
+    """
+    Drop the storage backend so the next call selects it again from the environment
+    """
+    _BACKEND.reset()
+
+def _active() -> StorageBackend:
+    """
+    The unit of work open in this context, or the process-wide backend
+    """
+    return current_unit_of_work() or get_backend()
+
+def open_unit_of_work(prefetch:Iterable[tuple[str, str]] = ()) -> ContextManager[UnitOfWork]:
+    """
+    Open a unit of work over the process-wide backend, reading the prefetch
+    (collection, document_id) keys with its first read
+    """
+    return unit_of_work(get_backend(), prefetch)
+
+@timed
+def get_users_by_last_completed_date(collection:str, limit:int=None) -> Iterator[Record]:
+    """
+    Get users where last_attempted is before today ordered by last completed
+    """
+    return _active().get_users_by_last_completed_date(collection, limit)
+
+@timed
+def get_next_user(collection:str) -> Optional[Record]:
+    """
+    Return the next user on the rotation from the reminder's rotation queue,
+    or None if everyone was attempted today
+
+    raises NotFound: if collection does not exist
+    """
+    return _active().get_next_user(collection)
+
+@timed
+def rebuild_rotation_queue(collection:str) -> list[dict]:
+    """
+    Rebuild a reminder's rotation queue from its users
+    """
+    return _active().rebuild_rotation_queue(collection)
+
+@timed
+def verify_rotation_queue(collection:str) -> bool:
+    """
+    Check a reminder's rotation queue against the rotation query, rebuilding it if stale
+    """
+    return _active().verify_rotation_queue(collection)
+
+@timed
+def get_user_by_phone_number(collection:str, phone_number:str) -> Record:
+    """
+    Return user from phone number
+    """
+    return _active().get_user_by_phone_number(collection, phone_number)
+
+@timed
+def get_all_users_by_collection(collection:str) -> Iterator[Record]:
+    """
+    Get all user records for a given collection
+    """
+    return _active().get_all_users_by_collection(collection)
+
+@timed
+def update_user_attempted(collection:str, phone_number:str) -> None:
+    """
+    Update a user's last_attempted to be now
+    """
+    _active().update_user_attempted(collection, phone_number)
+
+@timed
+def update_user_response(collection:str, phone_number:str, message_body:str) -> None:
+    """
+    Update users last response
+    """
+    _active().update_user_response(collection, phone_number, message_body)
+
+@timed
+def accept_reminder(collection:str, phone_number:str, message_body:str) -> bool:
+    """
+    Record a user's acceptance and complete the reminder atomically
+
+    returns false if the reminder was no longer active
+    raises NotFound: if collection does not exist
+    """
+    return _active().accept_reminder(collection, phone_number, message_body)
+
+@timed
+def record_events(collection:str, events:dict[str, dict]) -> dict:
+    """
+    Append events, by event id, to the event log and count them into the
+    collection's aggregates together. Returns the updated aggregates.
+    """
+    return _active().record_events(collection, events)
+
+@timed
+def get_reminder(collection:str) -> dict:
+    """
+    Return the reminder document for a collection
+
+    raises NotFound: if collection does not exist
+    """
+    return _active().get_reminder(collection)
+
+@timed
+def prime_reminder_cache() -> int:
+    """
+    Load every reminder ahead of the first request and return how many there are
+    """
+    return _active().prime_reminder_cache()
+
+@timed
+def reminder_is_active(collection:str) -> bool:
+    """
+    returns true if collection's status is active
+
+    raises NotFound: if collection does not exist
+    """
+    return _active().reminder_is_active(collection)
+
+@timed
+def activate_reminder(collection:str) -> None:
+    """
+    Set collection status to active
+    """
+    _active().activate_reminder(collection)
+
+@timed
+def add_user(collection:str, phone_number:str, name:str) -> None:
+    """
+    Add a user to a collection and to the phone number index
+    """
+    _active().add_user(collection, phone_number, name)
+
+@timed
+def index_collection(collection:str) -> None:
+    """
+    Add every user of a collection to the phone number index
+    """
+    _active().index_collection(collection)
+
+@timed
+def get_collections_by_phone_number(phone_number:str) -> list[str]:
+    """
+    Return the collections a phone number belongs to
+    """
+    return _active().get_collections_by_phone_number(phone_number)
+
+@timed
+def get_document(collection:str, document_id:str) -> Optional[dict]:
+    """
+    Return a document's fields, or None if it does not exist
+    """
+    return _active().get_document(collection, document_id)
+
+@timed
+def set_document(collection:str, document_id:str, data:dict, merge:bool = False) -> None:
+    """
+    Create or replace a document, or merge fields into it when merge is set
+    """
+    _active().set_document(collection, document_id, data, merge)
+
+@timed
+def create_document(collection:str, document_id:str, data:dict) -> bool:
+    """
+    Create a document only if it does not exist yet.
+    Returns false if it already existed.
+    """
+    return _active().create_document(collection, document_id, data)
+
+@timed
+def update_document(collection:str, document_id:str, data:dict) -> None:
+    """
+    Update fields of an existing document
+
+    raises NotFound: if the document does not exist
+    """
+    _active().update_document(collection, document_id, data)
+
+@timed
+def delete_document(collection:str, document_id:str) -> None:
+    """
+    Delete a document if it exists
+    """
+    _active().delete_document(collection, document_id)
+
+@timed
+def stream_documents(collection:str) -> Iterator[Record]:
+    """
+    Yield every document of a collection
+    """
+    return _active().stream_documents(collection)
+
+@timed
+def write_documents(writes:list[tuple[str, str, Optional[dict]]]) -> None:
+    """
+    Apply (collection, document_id, data) writes together.
+    A data of None deletes the document.
+    """
+    _active().write_documents(writes)
+
+@timed
+def commit_documents(writes:list[tuple[str, str, Optional[dict]]],
+                     read:dict[tuple[str, str], Record]) -> bool:
+    """
+    Apply writes together only if none of the written documents found in read,
+    by (collection, document_id), changed since they were read.
+    Returns false, writing nothing, if one did.
+    """
+    return _active().commit_documents(writes, read)
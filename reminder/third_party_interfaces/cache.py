@@ -0,0 +1,73 @@
+"""
+Small in-process caches shared by the interface modules
+"""
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from typing import Any, Hashable
+
+_DEFAULT_TTL = object()
+
+class TTLCache:
+    """
+    Thread-safe least recently used cache whose entries expire after a time to live.
+    A ttl of None keeps entries until they are evicted or replaced.
+    """
+    def __init__(self, ttl:float = None, maxsize:int = 1024) -> None:
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key:Hashable, default:Any = None) -> Any:
+        """
+        Return the cached value for key, or default if it is missing or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key:Hashable, value:Any, ttl:float = _DEFAULT_TTL) -> None:
+        """
+        Cache value for key, evicting the least recently used entry when full
+        """
+        if ttl is _DEFAULT_TTL:
+            ttl = self.ttl
+        expires_at = None if ttl is None else monotonic() + ttl
+
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key:Hashable, default:Any = None) -> Any:
+        """
+        Remove key from the cache and return its value
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self) -> None:
+        """
+        Remove every entry
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def __contains__(self, key:Hashable) -> bool:
+        return self.get(key, _DEFAULT_TTL) is not _DEFAULT_TTL
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
@@ -2,13 +2,97 @@
 All database interface functions
 """
 from datetime import datetime, timedelta
-from typing import Generator, Any
+from functools import partial
+from os import environ, register_at_fork
+from threading import Lock
+from typing import Generator, Any, Iterator, Optional
 
+from google.api_core.exceptions import FailedPrecondition
 from google.cloud import firestore
-from google.cloud.firestore import DocumentSnapshot
-from google.cloud.exceptions import NotFound
+from google.cloud.firestore import ArrayUnion, DocumentSnapshot, Transaction, transactional
+from google.cloud.exceptions import Conflict, NotFound
 
-NULL_DATETIME = datetime(1971, 1, 1, 0, 0, 0)
+from .cache import TTLCache
+from .shared import SharedInstance
+from .storage import PHONE_INDEX, MAX_BATCH_SIZE, ROTATION_QUEUE, RESPONSE_DEADLINE, EVENTS, \
+                     STATS, StorageBackend, build_rotation_queue, enqueue, new_user, requeue, \
+                     response_deadline, apply_events
+
+def _create_client() -> firestore.Client:
+    return firestore.Client()
+
+_CLIENT = SharedInstance(_create_client)
+
+def get_client() -> firestore.Client:
+    """
+    Return the process-wide firestore client, creating it on first use.
+    The client multiplexes requests over a single gRPC channel and is safe
+    to share between gunicorn threads.
+    """
+    return _CLIENT.get()
+
+def reset_client() -> None:
+    """
+    Drop the shared firestore client so the next call creates a new one.
+    Used by tests; forked children reset it automatically.
+    """
+    _CLIENT.reset()
+
+_reminder_cache = TTLCache()
+_phone_index_cache = TTLCache(maxsize=4096)
+_reminder_watch = None  # pylint: disable=invalid-name
+_reminder_watch_lock = Lock()
+
+def _reminder_ttl() -> Optional[float]:
+    """
+    Seconds a reminder document stays cached. Entries kept current by the
+    snapshot listener never expire.
+    """
+    if _reminder_watch is not None:
+        return None
+    return float(environ.get("REMINDER_CACHE_TTL", "30"))
+
+def _on_reminders_snapshot(_documents, changes, _read_time) -> None:
+    for change in changes:
+        if change.type.name == "REMOVED":
+            _reminder_cache.pop(change.document.id)
+        else:
+            _reminder_cache.set(change.document.id, change.document.to_dict(), ttl=None)
+
+def _start_reminder_listener() -> None:
+    """
+    Keep the reminder cache coherent with Firestore through a snapshot listener
+    when REMINDER_CACHE_LISTEN is enabled
+    """
+    global _reminder_watch  # pylint: disable=global-statement
+    if _reminder_watch is not None or environ.get("REMINDER_CACHE_LISTEN", "False") != "True":
+        return
+
+    with _reminder_watch_lock:
+        if _reminder_watch is None:
+            _reminder_watch = get_client().collection("reminders") \
+                                          .on_snapshot(_on_reminders_snapshot)
+
+def _update_cached_reminder(collection:str, fields:dict) -> None:
+    cached = _reminder_cache.get(collection)
+    if cached is not None:
+        _reminder_cache.set(collection, {**cached, **fields}, ttl=_reminder_ttl())
+
+def clear_reminder_cache(unsubscribe:bool = True) -> None:
+    """
+    Drop all cached reminder and phone index documents and stop the snapshot
+    listener if running.
+    Used by tests and after fork, where the listener thread no longer exists
+    and must not be unsubscribed.
+    """
+    global _reminder_watch  # pylint: disable=global-statement
+    watch, _reminder_watch = _reminder_watch, None
+    if watch is not None and unsubscribe:
+        watch.unsubscribe()
+    _reminder_cache.clear()
+    _phone_index_cache.clear()
+
+register_at_fork(after_in_child=partial(clear_reminder_cache, unsubscribe=False))
 
 def get_users_by_last_completed_date(collection:str, limit:int=None) \
     -> Generator[DocumentSnapshot, Any, None]:
@@ -16,7 +100,7 @@ def get_users_by_last_completed_date(collection:str, limit:int=None) \
     Get users where last_attempted is before today ordered by last completed
     """
     before_today = datetime.now() - timedelta(days=1)
-    db = firestore.Client()
+    db = get_client()
     doc = db.collection(collection).order_by("last_attempted"). \
                                     where("last_attempted", "<=", before_today). \
                                     order_by("last_completed"). \
@@ -27,7 +111,7 @@ def get_user_by_phone_number(collection:str, phone_number:str) -> DocumentSnapsh
     """
     Return user from phone number
     """
-    db = firestore.Client()
+    db = get_client()
     doc = db.collection(collection).document(phone_number).get()
     return doc
 
@@ -35,47 +119,377 @@ def get_all_users_by_collection(collection:str) -> Generator[DocumentSnapshot, A
     """
     Get all user records for a given collection
     """
-    db = firestore.Client()
+    db = get_client()
     return db.collection(collection).stream()
 
 def update_user_attempted(collection:str, phone_number:str) -> None:
     """
-    Update a user's last_attempted to be now
+    Update a user's last_attempted to be now and move them to the back of the
+    reminder's rotation queue in the same transaction
+    """
+    db = get_client()
+    _update_cached_reminder(collection,
+                            _update_user_attempted(db.transaction(), db, collection,
+                                                   phone_number))
+
+@transactional
+def _update_user_attempted(transaction:Transaction, db:firestore.Client, collection:str,
+                           phone_number:str) -> dict:
+    reminder = db.collection("reminders").document(collection).get(transaction=transaction)
+    return _mark_attempted(transaction, db, reminder, collection, phone_number)
+
+def _mark_attempted(transaction, db, reminder:DocumentSnapshot, collection:str,
+                    phone_number:str) -> dict:
+    """
+    Queue the attempt writes on a sync or async transaction.
+    Returns the reminder's update, empty when it has no rotation queue or response timeout.
+    """
+    attempted = {"last_attempted": datetime.now()}
+    transaction.update(db.collection(collection).document(phone_number), attempted)
+    update = _requeued(reminder, phone_number, attempted)
+    if reminder.exists:
+        update.update(response_deadline(reminder.to_dict(), phone_number,
+                                        attempted["last_attempted"]))
+    if update:
+        transaction.update(reminder.reference, update)
+    return update
+
+def _requeued(reminder:DocumentSnapshot, phone_number:str, fields:dict) -> dict:
+    """
+    The reminder update moving a user in its rotation queue, if it has one
     """
-    db = firestore.Client()
-    db.collection(collection).document(phone_number).update({"last_attempted": datetime.now()})
+    queue = reminder.to_dict().get(ROTATION_QUEUE) if reminder.exists else None
+    if queue is None:
+        return {}
+    return {ROTATION_QUEUE: requeue(queue, phone_number, fields)}
 
 def update_user_response(collection:str, phone_number:str, message_body:str) -> None:
     """
     Update users last response
     """
-    db = firestore.Client()
+    db = get_client()
     db.collection(collection).document(phone_number).update({"last_response": message_body})
 
-def complete_reminder(collection:str, phone_number:str) -> None:
+def accept_reminder(collection:str, phone_number:str, message_body:str) -> bool:
     """
-    Set reminder type to inactive and set a user's last_completed field
+    Record a user's acceptance and complete the reminder in a single transaction.
+    The user's response and last_completed fields and the reminder's status are
+    committed together only if the reminder is still active, so concurrent replies
+    cannot both complete it.
+
+    returns false if the reminder was no longer active
+    raises NotFound: if collection does not exist
     """
-    db = firestore.Client()
-    db.collection("reminders").document(collection).update({"status": "inactive"})
-    db.collection(collection).document(phone_number).update({"last_completed": datetime.now()})
+    db = get_client()
+    update = _accept_reminder(db.transaction(), db, collection, phone_number, message_body)
+    if update is None:
+        _reminder_cache.pop(collection)
+        return False
+    _update_cached_reminder(collection, update)
+    return True
 
-def reminder_is_active(collection: str) -> bool:
+@transactional
+def _accept_reminder(transaction:Transaction, db:firestore.Client, collection:str,
+                     phone_number:str, message_body:str) -> Optional[dict]:
+    reminder_ref = db.collection("reminders").document(collection)
+    reminder = reminder_ref.get(transaction=transaction)
+    return _complete_if_active(transaction, reminder,
+                               db.collection(collection).document(phone_number), message_body)
+
+def _complete_if_active(transaction, reminder:DocumentSnapshot, user,
+                        message_body:str) -> Optional[dict]:
     """
-    returns true if collection's status is active
+    Queue the acceptance writes to the user's document on a sync or async transaction
+    if the reminder read in it is still active. Returns the reminder's update, or None
+    if it was not active.
+    """
+    if not reminder.exists:
+        raise NotFound(f"reminder collection {reminder.id} not found")
+
+    if reminder.to_dict().get("status") != "active":
+        return None
+
+    completed = {"last_completed": datetime.now()}
+    transaction.update(user, {"last_response": message_body, **completed})
+    update = {"status": "inactive", **_requeued(reminder, user.id, completed)}
+    transaction.update(reminder.reference, update)
+    return update
+
+def record_events(collection:str, events:dict[str, dict]) -> dict:
+    """
+    Append events to the event log and count them into the collection's
+    aggregates in one transaction. Returns the updated aggregates.
+    """
+    db = get_client()
+    return _record_events(db.transaction(), db, collection, events)
+
+@transactional
+def _record_events(transaction:Transaction, db:firestore.Client, collection:str,
+                   events:dict[str, dict]) -> dict:
+    reference = db.collection(STATS).document(collection)
+    snapshot = reference.get(transaction=transaction)
+    stats = apply_events(snapshot.to_dict() if snapshot.exists else None, events.values())
+    for event_id, event in events.items():
+        transaction.set(db.collection(EVENTS).document(event_id),
+                        {"collection": collection, **event})
+    transaction.set(reference, stats)
+    return stats
+
+def get_reminder(collection: str) -> dict:
+    """
+    Return the reminder document for a collection, served from the in-process
+    cache for up to REMINDER_CACHE_TTL seconds (read on each cache fill)
 
     raises NotFound: if collection does not exist
     """
-    db = firestore.Client()
-    reminder = db.collection("reminders").document(collection).get()
-    if not reminder.exists:
+    _start_reminder_listener()
+    reminder = _reminder_cache.get(collection)
+    if reminder is not None:
+        return reminder
+
+    db = get_client()
+    snapshot = db.collection("reminders").document(collection).get()
+    if not snapshot.exists:
         raise NotFound(f"reminder collection {collection} not found")
 
-    return reminder.to_dict().get("status") == "active"
+    reminder = snapshot.to_dict()
+    _reminder_cache.set(collection, reminder, ttl=_reminder_ttl())
+    return reminder
+
+def prime_reminder_cache() -> int:
+    """
+    Read every reminder into the cache in one query, opening the firestore channel.
+    Returns how many reminders were cached.
+    """
+    _start_reminder_listener()
+    primed = 0
+    for snapshot in get_client().collection("reminders").stream():
+        _reminder_cache.set(snapshot.id, snapshot.to_dict(), ttl=_reminder_ttl())
+        primed += 1
+    return primed
+
+def reminder_is_active(collection: str) -> bool:
+    """
+    returns true if collection's status is active
+
+    raises NotFound: if collection does not exist
+    """
+    return get_reminder(collection).get("status") == "active"
 
 def activate_reminder(collection:str) -> None:
     """
-    Set collection status to active
+    Set collection status to active, indexing its users and rebuilding its queue
+    """
+    index_collection(collection)
+    _update_reminder(collection, {"status": "active", RESPONSE_DEADLINE: None,
+                                  ROTATION_QUEUE: _build_rotation_queue(collection)})
+
+def rebuild_rotation_queue(collection:str) -> list[dict]:
+    """
+    Rebuild the rotation queue from the collection's users and store it on the
+    reminder document, so the next user is picked without the composite query
+    """
+    queue = _build_rotation_queue(collection)
+    _update_reminder(collection, {ROTATION_QUEUE: queue})
+    return queue
+
+def _build_rotation_queue(collection:str) -> list[dict]:
+    return build_rotation_queue(get_client().collection(collection).stream())
+
+def _update_reminder(collection:str, fields:dict) -> None:
+    get_client().collection("reminders").document(collection).update(fields)
+    _update_cached_reminder(collection, fields)
+
+def add_user(collection:str, phone_number:str, name:str) -> None:
+    """
+    Add a user to a collection, to the phone number index and to the reminder's
+    rotation queue
+    """
+    db = get_client()
+    _update_cached_reminder(collection, _add_user(db.transaction(), db, collection,
+                                                  phone_number, new_user(name)))
+    db.collection(PHONE_INDEX).document(phone_number) \
+      .set({"collections": ArrayUnion([collection])}, merge=True)
+    _phone_index_cache.pop(phone_number)
+
+@transactional
+def _add_user(transaction:Transaction, db:firestore.Client, collection:str,
+              phone_number:str, user:dict) -> dict:
+    reminder = db.collection("reminders").document(collection).get(transaction=transaction)
+    transaction.set(db.collection(collection).document(phone_number), user)
+    queue = reminder.to_dict().get(ROTATION_QUEUE) if reminder.exists else None
+    if queue is None:
+        return {}
+    update = {ROTATION_QUEUE: enqueue(queue, phone_number, user)}
+    transaction.update(reminder.reference, update)
+    return update
+
+def index_collection(collection:str) -> None:
+    """
+    Add every user of a collection to the phone number index,
+    in batches of up to MAX_BATCH_SIZE writes
+    """
+    db = get_client()
+    batch = db.batch()
+    pending = 0
+    for user in db.collection(collection).stream():
+        batch.set(db.collection(PHONE_INDEX).document(user.id),
+                  {"collections": ArrayUnion([collection])}, merge=True)
+        _phone_index_cache.pop(user.id)
+        pending += 1
+        if pending == MAX_BATCH_SIZE:
+            batch.commit()
+            batch = db.batch()
+            pending = 0
+
+    if pending:
+        batch.commit()
+
+def _phone_index_ttl() -> float:
+    return float(environ.get("PHONE_INDEX_CACHE_TTL", "300"))
+
+def get_collections_by_phone_number(phone_number:str) -> list[str]:
+    """
+    Return the collections a phone number belongs to with a single keyed lookup,
+    served from the in-process cache for up to PHONE_INDEX_CACHE_TTL seconds.
+    Unknown numbers are not cached, so a number indexed by another instance is
+    found on its next message.
+    """
+    collections = _phone_index_cache.get(phone_number)
+    if collections is not None:
+        return collections
+
+    db = get_client()
+    snapshot = db.collection(PHONE_INDEX).document(phone_number).get()
+    collections = snapshot.to_dict().get("collections", []) if snapshot.exists else []
+    if collections:
+        _phone_index_cache.set(phone_number, collections, ttl=_phone_index_ttl())
+    return collections
+
+class FirestoreBackend(StorageBackend):  # pylint: disable=too-many-public-methods
+    """
+    Storage backend on the shared firestore client. The rotation operations use
+    the cached, transactional and indexed functions of this module.
     """
-    db = firestore.Client()
-    db.collection("reminders").document(collection).update({"status": "active"})
+    def get_document(self, collection:str, document_id:str) -> Optional[dict]:
+        snapshot = get_client().collection(collection).document(document_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def set_document(self, collection:str, document_id:str, data:dict,
+                     merge:bool = False) -> None:
+        get_client().collection(collection).document(document_id).set(data, merge=merge)
+
+    def create_document(self, collection:str, document_id:str, data:dict) -> bool:
+        try:
+            get_client().collection(collection).document(document_id).create(data)
+        except Conflict:
+            return False
+        return True
+
+    def update_document(self, collection:str, document_id:str, data:dict) -> None:
+        get_client().collection(collection).document(document_id).update(data)
+
+    def delete_document(self, collection:str, document_id:str) -> None:
+        get_client().collection(collection).document(document_id).delete()
+
+    def stream_documents(self, collection:str) -> Iterator[DocumentSnapshot]:
+        return get_client().collection(collection).stream()
+
+    def write_documents(self, writes:list[tuple[str, str, Optional[dict]]]) -> None:
+        db = get_client()
+        for start in range(0, len(writes), MAX_BATCH_SIZE):
+            batch = db.batch()
+            for collection, document_id, data in writes[start:start + MAX_BATCH_SIZE]:
+                reference = db.collection(collection).document(document_id)
+                if data is None:
+                    batch.delete(reference)
+                else:
+                    batch.set(reference, data, merge=True)
+            batch.commit()
+
+    def get_documents(self, keys:list[tuple[str, str]]) \
+        -> dict[tuple[str, str], DocumentSnapshot]:
+        db = get_client()
+        keys_by_reference = {db.collection(collection).document(document_id):
+                             (collection, document_id) for collection, document_id in keys}
+        # get_all returns the snapshots in no particular order
+        return {keys_by_reference[snapshot.reference]: snapshot
+                for snapshot in db.get_all(list(keys_by_reference))}
+
+    def commit_documents(self, writes:list[tuple[str, str, Optional[dict]]],
+                         read:dict[tuple[str, str], DocumentSnapshot]) -> bool:
+        """
+        Commit writes in one batch. Documents that were read are written on the
+        precondition that they were not updated since, or were still missing.
+        """
+        db = get_client()
+        batch = db.batch()
+        for collection, document_id, data in writes:
+            reference = db.collection(collection).document(document_id)
+            snapshot = read.get((collection, document_id))
+            option = db.write_option(last_update_time=snapshot.update_time) \
+                if snapshot is not None and snapshot.exists else None
+            if data is None:
+                batch.delete(reference, option=option)
+            elif option is not None:
+                batch.update(reference, data, option=option)
+            elif snapshot is not None:
+                batch.create(reference, data)
+            else:
+                batch.set(reference, data, merge=True)
+        try:
+            batch.commit()
+        except (Conflict, FailedPrecondition):
+            return False
+
+        for collection, document_id, data in writes:
+            if collection == "reminders":
+                if data is None:
+                    _reminder_cache.pop(document_id)
+                else:
+                    _update_cached_reminder(document_id, data)
+        return True
+
+    def get_users_by_last_completed_date(self, collection:str, limit:int = None) \
+        -> Generator[DocumentSnapshot, Any, None]:
+        return get_users_by_last_completed_date(collection, limit)
+
+    def get_user_by_phone_number(self, collection:str, phone_number:str) -> DocumentSnapshot:
+        return get_user_by_phone_number(collection, phone_number)
+
+    def get_all_users_by_collection(self, collection:str) \
+        -> Generator[DocumentSnapshot, Any, None]:
+        return get_all_users_by_collection(collection)
+
+    def update_user_attempted(self, collection:str, phone_number:str) -> None:
+        update_user_attempted(collection, phone_number)
+
+    def update_user_response(self, collection:str, phone_number:str, message_body:str) -> None:
+        update_user_response(collection, phone_number, message_body)
+
+    def accept_reminder(self, collection:str, phone_number:str, message_body:str) -> bool:
+        return accept_reminder(collection, phone_number, message_body)
+
+    def record_events(self, collection:str, events:dict[str, dict]) -> dict:
+        return record_events(collection, events)
+
+    def get_reminder(self, collection:str) -> dict:
+        return get_reminder(collection)
+
+    def prime_reminder_cache(self) -> int:
+        return prime_reminder_cache()
+
+    def activate_reminder(self, collection:str) -> None:
+        activate_reminder(collection)
+
+    def rebuild_rotation_queue(self, collection:str) -> list[dict]:
+        return rebuild_rotation_queue(collection)
+
+    def add_user(self, collection:str, phone_number:str, name:str) -> None:
+        add_user(collection, phone_number, name)
+
+    def index_collection(self, collection:str) -> None:
+        index_collection(collection)
+
+    def get_collections_by_phone_number(self, phone_number:str) -> list[str]:
+        return get_collections_by_phone_number(phone_number)
@@ -0,0 +1,90 @@
+"""
+Google oauth2 token verification with cached certificates and claims
+"""
+import re
+from time import time
+from typing import TYPE_CHECKING
+
+from google.auth import transport
+
+from .cache import TTLCache
+from .metrics import timed
+from .shared import SharedInstance
+
+if TYPE_CHECKING:
+    from requests import Session
+
+_MAX_AGE = re.compile(r"max-age=(\d+)")
+# The certificates verify_oauth2_token checks signatures against
+GOOGLE_CERTS_URL = "https://www.googleapis.com/oauth2/v1/certs"
+
+class CachingRequest(transport.Request):  # pylint: disable=too-few-public-methods
+    """
+    Transport that reuses one HTTP session and keeps GET responses, such as
+    Google's public certificates, for as long as their Cache-Control max-age allows
+    """
+    def __init__(self, session:"Session" = None) -> None:
+        # Imported on first use so cold starts skip the requests transport
+        # pylint: disable=import-outside-toplevel
+        from google.auth.transport.requests import Request
+        from requests import Session
+        self._request = Request(session or Session())
+        self._responses = TTLCache(maxsize=16)
+
+    def __call__(self, url, method="GET", body=None, headers=None, timeout=None, **kwargs):
+        if method != "GET" or body is not None:
+            return self._request(url, method=method, body=body, headers=headers,
+                                 timeout=timeout, **kwargs)
+
+        response = self._responses.get(url)
+        if response is not None:
+            return response
+
+        response = self._request(url, method=method, headers=headers, timeout=timeout, **kwargs)
+        max_age = _MAX_AGE.search(response.headers.get("Cache-Control", ""))
+        if response.status == 200 and max_age is not None:
+            self._responses.set(url, response, ttl=int(max_age.group(1)))
+        return response
+
+def _create_request() -> CachingRequest:
+    return CachingRequest()
+
+_REQUEST = SharedInstance(_create_request)
+_verified_tokens = TTLCache(maxsize=256)
+
+@timed
+def verify_token(token:str) -> dict:
+    """
+    Verify a google signed ID token and return its claims.
+    Tokens that already verified are remembered by signature until they expire,
+    so repeated pushes with the same token skip the signature check.
+
+    raises GoogleAuthError, ValueError: if the token is invalid
+    """
+    from google.oauth2 import id_token  # pylint: disable=import-outside-toplevel
+
+    signature = token.rsplit(".", 1)[-1]
+    claim = _verified_tokens.get(signature)
+    if claim is not None:
+        return claim
+
+    claim = id_token.verify_oauth2_token(token, _REQUEST.get())
+    ttl = claim.get("exp", 0) - time()
+    if ttl > 0:
+        _verified_tokens.set(signature, claim, ttl=ttl)
+    return claim
+
+@timed
+def fetch_certificates() -> None:
+    """
+    Download Google's public certificates into the request cache,
+    so the first token verification does not wait on them
+    """
+    _REQUEST.get()(GOOGLE_CERTS_URL)
+
+def reset_token_cache() -> None:
+    """
+    Forget verified tokens and cached certificates
+    """
+    _verified_tokens.clear()
+    _REQUEST.reset()
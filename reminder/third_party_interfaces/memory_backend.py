@@ -0,0 +1,63 @@
+"""
+In-memory storage backend for local runs and tests
+"""
+from copy import deepcopy
+from typing import Iterator, Optional
+
+from google.cloud.exceptions import NotFound
+
+from .storage import Record, StorageBackend
+
+class MemoryBackend(StorageBackend):
+    """
+    Keeps every collection in process memory. Nothing is persisted.
+    """
+    def __init__(self) -> None:
+        super().__init__()
+        self._collections = {}
+
+    def get_document(self, collection:str, document_id:str) -> Optional[dict]:
+        with self._lock:
+            return deepcopy(self._collections.get(collection, {}).get(document_id))
+
+    def set_document(self, collection:str, document_id:str, data:dict,
+                     merge:bool = False) -> None:
+        with self._lock:
+            documents = self._collections.setdefault(collection, {})
+            if merge and document_id in documents:
+                documents[document_id].update(deepcopy(data))
+            else:
+                documents[document_id] = deepcopy(data)
+
+    def create_document(self, collection:str, document_id:str, data:dict) -> bool:
+        with self._lock:
+            documents = self._collections.setdefault(collection, {})
+            if document_id in documents:
+                return False
+            documents[document_id] = deepcopy(data)
+            return True
+
+    def update_document(self, collection:str, document_id:str, data:dict) -> None:
+        with self._lock:
+            document = self._collections.get(collection, {}).get(document_id)
+            if document is None:
+                raise NotFound(f"No document to update: {collection}/{document_id}")
+            document.update(deepcopy(data))
+
+    def delete_document(self, collection:str, document_id:str) -> None:
+        with self._lock:
+            self._collections.get(collection, {}).pop(document_id, None)
+
+    def stream_documents(self, collection:str) -> Iterator[Record]:
+        with self._lock:
+            documents = deepcopy(self._collections.get(collection, {}))
+        for document_id, data in documents.items():
+            yield Record(document_id, data)
+
+    def write_documents(self, writes:list[tuple[str, str, Optional[dict]]]) -> None:
+        with self._lock:
+            for collection, document_id, data in writes:
+                if data is None:
+                    self.delete_document(collection, document_id)
+                else:
+                    self.set_document(collection, document_id, data, merge=True)
@@ -0,0 +1,124 @@
+"""
+Latency histograms per operation, exported in the prometheus text format.
+Nothing is recorded unless METRICS_ENABLED is set.
+"""
+from functools import wraps
+from inspect import iscoroutinefunction
+from os import environ
+from threading import Lock
+from time import perf_counter
+from typing import Callable
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """
+    Count, sum and cumulative bucket counts of observed durations in seconds
+    """
+    def __init__(self, buckets:tuple[float, ...] = BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = Lock()
+
+    def observe(self, seconds:float) -> None:
+        """
+        Record one duration
+        """
+        with self._lock:
+            self.count += 1
+            self.sum += seconds
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    self.counts[index] += 1
+
+    def snapshot(self) -> tuple[list[int], int, float]:
+        """
+        Return consistent copies of the bucket counts, count and sum
+        """
+        with self._lock:
+            return list(self.counts), self.count, self.sum
+
+_histograms: dict[str, Histogram] = {}
+_histograms_lock = Lock()
+
+def metrics_enabled() -> bool:
+    """
+    True when METRICS_ENABLED is set, checked on every call so it can be toggled
+    """
+    return environ.get("METRICS_ENABLED", "False") == "True"
+
+def observe(operation:str, seconds:float) -> None:
+    """
+    Record how long an operation took
+    """
+    histogram = _histograms.get(operation)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(operation, Histogram())
+    histogram.observe(seconds)
+
+def timed(func:Callable) -> Callable:
+    """
+    Record each call of func under <module>.<function>.
+    Coroutines are timed until they complete; functions returning iterators
+    are timed until they return, not while consumed.
+    """
+    operation = f"{func.__module__.rsplit('.', 1)[-1]}.{func.__qualname__}"
+
+    if iscoroutinefunction(func):
+        @wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            if not metrics_enabled():
+                return await func(*args, **kwargs)
+            start = perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                observe(operation, perf_counter() - start)
+        return async_wrapper
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not metrics_enabled():
+            return func(*args, **kwargs)
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            observe(operation, perf_counter() - start)
+    return wrapper
+
+def _format(value:float) -> str:
+    return f"{value:g}"
+
+def render_metrics(gauges:dict[str, float] = None) -> str:
+    """
+    Render every histogram, and any extra gauges, in the prometheus text format
+    """
+    lines = ["# HELP reminder_operation_seconds Time spent per operation",
+             "# TYPE reminder_operation_seconds histogram"]
+    with _histograms_lock:
+        histograms = sorted(_histograms.items())
+    for operation, histogram in histograms:
+        counts, count, total = histogram.snapshot()
+        label = f'operation="{operation}"'
+        for bound, bucket_count in zip(histogram.buckets, counts):
+            lines.append(f'reminder_operation_seconds_bucket{{{label},le="{_format(bound)}"}} '
+                         f"{bucket_count}")
+        lines.append(f'reminder_operation_seconds_bucket{{{label},le="+Inf"}} {count}')
+        lines.append(f"reminder_operation_seconds_sum{{{label}}} {_format(total)}")
+        lines.append(f"reminder_operation_seconds_count{{{label}}} {count}")
+
+    for name, value in sorted((gauges or {}).items()):
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {_format(value)}")
+    return "\n".join(lines) + "\n"
+
+def reset_metrics() -> None:
+    """
+    Forget every recorded duration. Used by tests.
+    """
+    with _histograms_lock:
+        _histograms.clear()
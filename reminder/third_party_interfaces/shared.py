@@ -0,0 +1,36 @@
+"""
+Process-wide clients shared between threads
+"""
+from os import register_at_fork
+from threading import Lock
+from typing import Any, Callable
+
+class SharedInstance:
+    """
+    Lazily builds one instance with factory and hands it to every caller.
+    The instance is dropped in forked children, since network channels and
+    sockets must not cross processes.
+    """
+    def __init__(self, factory:Callable[[], Any]) -> None:
+        self._factory = factory
+        self._instance = None
+        self._lock = Lock()
+        register_at_fork(after_in_child=self.reset)
+
+    def get(self) -> Any:
+        """
+        Return the shared instance, creating it on first use
+        """
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    self._instance = self._factory()
+        return self._instance
+
+    def reset(self) -> None:
+        """
+        Drop the shared instance so the next call creates a new one.
+        The lock is replaced too, as a fork can copy it while another thread holds it.
+        """
+        self._instance = None
+        self._lock = Lock()
@@ -0,0 +1,172 @@
+"""
+SQLite storage backend for single node deployments and local load testing
+"""
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from json import dumps, loads
+import sqlite3
+from typing import Iterator, Optional
+
+from google.cloud.exceptions import NotFound
+
+from .storage import Record, StorageBackend
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    collection TEXT NOT NULL,
+    id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    last_attempted TEXT GENERATED ALWAYS AS
+        (json_extract(data, '$.last_attempted.__datetime__')) VIRTUAL,
+    last_completed TEXT GENERATED ALWAYS AS
+        (json_extract(data, '$.last_completed.__datetime__')) VIRTUAL,
+    PRIMARY KEY (collection, id)
+);
+CREATE INDEX IF NOT EXISTS documents_rotation
+    ON documents (collection, last_attempted, last_completed);
+"""
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    raise TypeError(f"Cannot store {type(value).__name__}")
+
+def _decode(fields:dict):
+    if "__datetime__" in fields:
+        return datetime.fromisoformat(fields["__datetime__"])
+    return fields
+
+def _dumps(data:dict) -> str:
+    return dumps(data, default=_encode)
+
+def _loads(data:str) -> dict:
+    return loads(data, object_hook=_decode)
+
+class SQLiteBackend(StorageBackend):
+    """
+    Stores documents as JSON in a single table. The rotation fields are exposed
+    as generated columns indexed on (collection, last_attempted, last_completed),
+    so picking the next user is an index range scan.
+    """
+    def __init__(self, path:str) -> None:
+        super().__init__()
+        self._connection = sqlite3.connect(path, check_same_thread=False,
+                                           isolation_level=None)
+        self._connection.executescript(_SCHEMA)
+        self._depth = 0
+
+    @contextmanager
+    def _transaction(self):
+        """
+        Run the block in one immediate transaction; nested blocks join the outer one
+        """
+        with self._lock:
+            if self._depth:
+                self._depth += 1
+                try:
+                    yield
+                finally:
+                    self._depth -= 1
+                return
+
+            self._connection.execute("BEGIN IMMEDIATE")
+            self._depth = 1
+            try:
+                yield
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            else:
+                self._connection.execute("COMMIT")
+            finally:
+                self._depth = 0
+
+    def get_document(self, collection:str, document_id:str) -> Optional[dict]:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT data FROM documents WHERE collection = ? AND id = ?",
+                (collection, document_id)).fetchone()
+        return None if row is None else _loads(row[0])
+
+    def set_document(self, collection:str, document_id:str, data:dict,
+                     merge:bool = False) -> None:
+        with self._transaction():
+            if merge:
+                data = {**(self.get_document(collection, document_id) or {}), **data}
+            self._connection.execute(
+                "INSERT OR REPLACE INTO documents (collection, id, data) VALUES (?, ?, ?)",
+                (collection, document_id, _dumps(data)))
+
+    def create_document(self, collection:str, document_id:str, data:dict) -> bool:
+        with self._transaction():
+            cursor = self._connection.execute(
+                "INSERT OR IGNORE INTO documents (collection, id, data) VALUES (?, ?, ?)",
+                (collection, document_id, _dumps(data)))
+            return cursor.rowcount == 1
+
+    def update_document(self, collection:str, document_id:str, data:dict) -> None:
+        with self._transaction():
+            document = self.get_document(collection, document_id)
+            if document is None:
+                raise NotFound(f"No document to update: {collection}/{document_id}")
+            self.set_document(collection, document_id, {**document, **data})
+
+    def delete_document(self, collection:str, document_id:str) -> None:
+        with self._transaction():
+            self._connection.execute("DELETE FROM documents WHERE collection = ? AND id = ?",
+                                     (collection, document_id))
+
+    def stream_documents(self, collection:str) -> Iterator[Record]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, data FROM documents WHERE collection = ? ORDER BY id",
+                (collection,)).fetchall()
+        for document_id, data in rows:
+            yield Record(document_id, _loads(data))
+
+    def write_documents(self, writes:list[tuple[str, str, Optional[dict]]]) -> None:
+        with self._transaction():
+            for collection, document_id, data in writes:
+                if data is None:
+                    self.delete_document(collection, document_id)
+                else:
+                    self.set_document(collection, document_id, data, merge=True)
+
+    def commit_documents(self, writes:list[tuple[str, str, Optional[dict]]],
+                         read:dict[tuple[str, str], Record]) -> bool:
+        with self._transaction():
+            return super().commit_documents(writes, read)
+
+    def get_users_by_last_completed_date(self, collection:str, limit:int = None) \
+        -> Iterator[Record]:
+        before_today = datetime.now() - timedelta(days=1)
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, data FROM documents "
+                "WHERE collection = ? AND last_attempted <= ? AND last_completed IS NOT NULL "
+                "ORDER BY last_attempted, last_completed LIMIT ?",
+                (collection, before_today.isoformat(), -1 if limit is None else limit)) \
+                .fetchall()
+        return iter([Record(document_id, _loads(data)) for document_id, data in rows])
+
+    def update_user_attempted(self, collection:str, phone_number:str) -> None:
+        with self._transaction():
+            super().update_user_attempted(collection, phone_number)
+
+    def accept_reminder(self, collection:str, phone_number:str, message_body:str) -> bool:
+        with self._transaction():
+            return super().accept_reminder(collection, phone_number, message_body)
+
+    def add_user(self, collection:str, phone_number:str, name:str) -> None:
+        with self._transaction():
+            super().add_user(collection, phone_number, name)
+
+    def record_events(self, collection:str, events:dict[str, dict]) -> dict:
+        with self._transaction():
+            return super().record_events(collection, events)
+
+    def close(self) -> None:
+        """
+        Close the database connection
+        """
+        self._connection.close()
@@ -0,0 +1,439 @@
+"""
+Storage backend interface shared by the firestore, in-memory and sqlite engines
+"""
+from abc import ABC, abstractmethod
+from bisect import insort
+from copy import deepcopy
+from datetime import datetime, timedelta
+from os import environ
+from threading import RLock
+from typing import Iterable, Iterator, Optional
+import logging
+
+from google.cloud.exceptions import NotFound
+
+NULL_DATETIME = datetime(1971, 1, 1, 0, 0, 0)
+PHONE_INDEX = "phone_index"
+MAX_BATCH_SIZE = 500
+ROTATION_QUEUE = "rotation_queue"
+RESPONSE_DEADLINE = "response_deadline"
+EVENTS = "events"
+STATS = "stats"
+
+class Record:
+    """
+    Document read from a storage backend, exposing the same id, exists and
+    to_dict interface as a firestore DocumentSnapshot
+    """
+    def __init__(self, document_id:str, data:Optional[dict]) -> None:
+        self.id = document_id  # pylint: disable=invalid-name
+        self._data = data
+
+    @property
+    def exists(self) -> bool:
+        """
+        True if the document was found
+        """
+        return self._data is not None
+
+    def to_dict(self) -> Optional[dict]:
+        """
+        Return a copy of the document fields, or None if it does not exist
+        """
+        return deepcopy(self._data)
+
+def _naive(value:datetime) -> datetime:
+    """
+    Firestore reads timestamps back in UTC; compare them as the naive times written
+    """
+    return value.replace(tzinfo=None) if value.tzinfo is not None else value
+
+def new_user(name:str) -> dict:
+    """
+    The fields of a user who has not been attempted or completed a reminder yet
+    """
+    return {
+        "name": name,
+        "last_completed": NULL_DATETIME,
+        "last_attempted": NULL_DATETIME,
+        "last_response": "",
+    }
+
+def _queue_key(entry:dict) -> tuple:
+    return (_naive(entry["last_attempted"]), _naive(entry["last_completed"]),
+            entry["phone_number"])
+
+def build_rotation_queue(users:Iterable[Record]) -> list[dict]:
+    """
+    Order users as the rotation query does, by last_attempted then last_completed.
+    Users missing either field are left out, as firestore leaves them out of the query.
+    """
+    queue = []
+    for user in users:
+        fields = user.to_dict()
+        if "last_attempted" in fields and "last_completed" in fields:
+            queue.append(_queue_entry(user.id, fields))
+    return sorted(queue, key=_queue_key)
+
+def _queue_entry(phone_number:str, user:dict) -> dict:
+    return {"phone_number": phone_number, "name": user.get("name"),
+            "last_attempted": _naive(user["last_attempted"]),
+            "last_completed": _naive(user["last_completed"])}
+
+def enqueue(queue:list[dict], phone_number:str, user:dict) -> list[dict]:
+    """
+    Return the queue with the user placed by their last_attempted and last_completed
+    """
+    queue = [entry for entry in queue if entry["phone_number"] != phone_number]
+    insort(queue, _queue_entry(phone_number, user), key=_queue_key)
+    return queue
+
+def requeue(queue:list[dict], phone_number:str, fields:dict) -> Optional[list[dict]]:
+    """
+    Return the queue with a queued user's fields updated and the user moved to their
+    new place, or None when the user is not queued and the queue must be rebuilt
+    """
+    for entry in queue:
+        if entry["phone_number"] == phone_number:
+            return enqueue(queue, phone_number, {**entry, **fields})
+    return None
+
+def next_in_queue(queue:list[dict]) -> Optional[dict]:
+    """
+    The first queued user, if they were last attempted before today
+    """
+    before_today = datetime.now() - timedelta(days=1)
+    if queue and _naive(queue[0]["last_attempted"]) <= before_today:
+        return queue[0]
+    return None
+
+def response_deadline(reminder:dict, phone_number:str, now:datetime) -> dict:
+    """
+    The reminder update giving a user until the reminder's response_timeout, or else
+    RESPONSE_TIMEOUT, in seconds to answer. Empty when neither is set.
+    """
+    timeout = float(reminder.get("response_timeout") or environ.get("RESPONSE_TIMEOUT", "0"))
+    if timeout <= 0:
+        return {}
+    return {RESPONSE_DEADLINE: {"phone_number": phone_number,
+                                "due": now + timedelta(seconds=timeout)}}
+
+def deadline_of(reminder:dict) -> Optional[tuple[datetime, str]]:
+    """
+    When an active reminder's response deadline expires and whose answer it waits for
+    """
+    deadline = reminder.get(RESPONSE_DEADLINE)
+    if not deadline or reminder.get("status") != "active":
+        return None
+    return _naive(deadline["due"]), deadline["phone_number"]
+
+def apply_events(stats:Optional[dict], events:Iterable[dict]) -> dict:
+    """
+    Return a collection's aggregates with events counted in. Each event type is
+    counted in total, per phone number and per month.
+    """
+    stats = deepcopy(stats) if stats else {}
+    totals = stats.setdefault("totals", {})
+    users = stats.setdefault("users", {})
+    periods = stats.setdefault("periods", {})
+    for event in events:
+        kind = event["type"]
+        user = users.setdefault(event["phone_number"], {})
+        period = periods.setdefault(_naive(event["time"]).strftime("%Y-%m"), {})
+        for counts in (totals, user, period):
+            counts[kind] = counts.get(kind, 0) + 1
+        if event.get("name"):
+            user["name"] = event["name"]
+    return stats
+
+class StorageBackend(ABC):  # pylint: disable=too-many-public-methods
+    """
+    A backend stores documents by collection and id. Subclasses implement the
+    document primitives; the rotation operations are built on top of them and
+    may be overridden where the engine can answer more efficiently.
+    """
+    def __init__(self) -> None:
+        self._lock = RLock()
+
+    @abstractmethod
+    def get_document(self, collection:str, document_id:str) -> Optional[dict]:
+        """
+        Return a document's fields, or None if it does not exist
+        """
+
+    @abstractmethod
+    def set_document(self, collection:str, document_id:str, data:dict,
+                     merge:bool = False) -> None:
+        """
+        Create or replace a document, or merge fields into it when merge is set
+        """
+
+    @abstractmethod
+    def create_document(self, collection:str, document_id:str, data:dict) -> bool:
+        """
+        Create a document only if it does not exist yet.
+        Returns false, leaving the stored document untouched, if it already existed.
+        """
+
+    @abstractmethod
+    def update_document(self, collection:str, document_id:str, data:dict) -> None:
+        """
+        Update fields of an existing document
+
+        raises NotFound: if the document does not exist
+        """
+
+    @abstractmethod
+    def delete_document(self, collection:str, document_id:str) -> None:
+        """
+        Delete a document if it exists
+        """
+
+    @abstractmethod
+    def stream_documents(self, collection:str) -> Iterator[Record]:
+        """
+        Yield every document of a collection
+        """
+
+    @abstractmethod
+    def write_documents(self, writes:list[tuple[str, str, Optional[dict]]]) -> None:
+        """
+        Apply (collection, document_id, data) writes together, merging data into
+        each document. A data of None deletes the document.
+        """
+
+    def get_documents(self, keys:list[tuple[str, str]]) -> dict[tuple[str, str], Record]:
+        """
+        Read several (collection, document_id) documents, by key, in as few round
+        trips as the engine allows
+        """
+        return {key: Record(key[1], self.get_document(*key)) for key in keys}
+
+    def commit_documents(self, writes:list[tuple[str, str, Optional[dict]]],
+                         read:dict[tuple[str, str], Record]) -> bool:
+        """
+        Apply writes like write_documents, but only if none of the written documents
+        found in read changed since they were read. Returns false, writing nothing,
+        if one did.
+        """
+        with self._lock:
+            for collection, document_id, _ in writes:
+                record = read.get((collection, document_id))
+                if record is not None and \
+                    self.get_document(collection, document_id) != record.to_dict():
+                    return False
+            self.write_documents(writes)
+            return True
+
+    def prime_reminder_cache(self) -> int:
+        """
+        Load every reminder ahead of the first request and return how many there are.
+        Engines without a reminder cache only open their connection.
+        """
+        return sum(1 for _ in self.stream_documents("reminders"))
+
+    def get_users_by_last_completed_date(self, collection:str, limit:int = None) \
+        -> Iterator[Record]:
+        """
+        Get users where last_attempted is before today ordered by last completed
+        """
+        before_today = datetime.now() - timedelta(days=1)
+        users = []
+        for user in self.stream_documents(collection):
+            fields = user.to_dict()
+            # firestore leaves out documents missing a filtered or ordered field
+            if "last_attempted" in fields and "last_completed" in fields and \
+                fields["last_attempted"] <= before_today:
+                users.append((fields["last_attempted"], fields["last_completed"], user))
+        users.sort(key=lambda entry: entry[:2])
+        return iter([user for _, _, user in users[:limit]])
+
+    def get_user_by_phone_number(self, collection:str, phone_number:str) -> Record:
+        """
+        Return user from phone number
+        """
+        return Record(phone_number, self.get_document(collection, phone_number))
+
+    def get_all_users_by_collection(self, collection:str) -> Iterator[Record]:
+        """
+        Get all user records for a given collection
+        """
+        return self.stream_documents(collection)
+
+    def get_next_user(self, collection:str) -> Optional[Record]:
+        """
+        Return the next user on the rotation from the reminder's rotation queue in a
+        single read, or None if everyone was attempted today. A reminder without a
+        queue has it rebuilt from its users first.
+
+        raises NotFound: if collection does not exist
+        """
+        reminder = self.get_document("reminders", collection)
+        if reminder is None:
+            raise NotFound(f"reminder collection {collection} not found")
+
+        queue = reminder.get(ROTATION_QUEUE)
+        if queue is None:
+            queue = self.rebuild_rotation_queue(collection)
+        entry = next_in_queue(queue)
+        return None if entry is None else Record(entry["phone_number"], entry)
+
+    def rebuild_rotation_queue(self, collection:str) -> list[dict]:
+        """
+        Rebuild the rotation queue from the collection's users and store it on the reminder
+        """
+        with self._lock:
+            queue = build_rotation_queue(self.stream_documents(collection))
+            self.update_document("reminders", collection, {ROTATION_QUEUE: queue})
+            return queue
+
+    def verify_rotation_queue(self, collection:str) -> bool:
+        """
+        Check the users due in the stored rotation queue against the rotation query,
+        rebuilding the queue when they differ. Returns true if the queue was correct.
+        """
+        reminder = self.get_document("reminders", collection) or {}
+        queue = reminder.get(ROTATION_QUEUE)
+        expected = build_rotation_queue(self.get_users_by_last_completed_date(collection))
+        if queue is not None:
+            before_today = datetime.now() - timedelta(days=1)
+            due = [_queue_entry(entry["phone_number"], entry) for entry in queue
+                   if _naive(entry["last_attempted"]) <= before_today]
+            if due == expected:
+                return True
+
+        logging.warning("Rebuilding stale rotation queue for %s", collection)
+        self.rebuild_rotation_queue(collection)
+        return False
+
+    def _requeue_writes(self, collection:str, phone_number:str, reminder:Optional[dict],
+                        fields:dict) -> list[tuple[str, str, dict]]:
+        """
+        The writes updating a user's fields together with their place in the reminder's
+        rotation queue. A user missing from the queue is updated on their own, raising
+        NotFound if they do not exist, and the queue is dropped to be rebuilt.
+        """
+        queue = (reminder or {}).get(ROTATION_QUEUE)
+        queue = None if queue is None else requeue(queue, phone_number, fields)
+        if queue is None:
+            self.update_document(collection, phone_number, fields)
+            return [] if reminder is None else [("reminders", collection, {ROTATION_QUEUE: None})]
+        return [(collection, phone_number, fields),
+                ("reminders", collection, {ROTATION_QUEUE: queue})]
+
+    def update_user_attempted(self, collection:str, phone_number:str) -> None:
+        """
+        Update a user's last_attempted to be now, moving them to the back of the queue
+        and starting their response deadline
+        """
+        with self._lock:
+            now = datetime.now()
+            reminder = self.get_document("reminders", collection)
+            writes = self._requeue_writes(collection, phone_number, reminder,
+                                          {"last_attempted": now})
+            deadline = response_deadline(reminder, phone_number, now) if reminder else {}
+            if deadline:
+                writes.append(("reminders", collection, deadline))
+            self.write_documents(writes)
+
+    def update_user_response(self, collection:str, phone_number:str, message_body:str) -> None:
+        """
+        Update users last response
+        """
+        self.update_document(collection, phone_number, {"last_response": message_body})
+
+    def accept_reminder(self, collection:str, phone_number:str, message_body:str) -> bool:
+        """
+        Record a user's acceptance and complete the reminder atomically
+
+        returns false if the reminder was no longer active
+        raises NotFound: if collection does not exist
+        """
+        with self._lock:
+            reminder = self.get_reminder(collection)
+            if reminder.get("status") != "active":
+                return False
+
+            writes = self._requeue_writes(collection, phone_number, reminder,
+                                          {"last_response": message_body,
+                                           "last_completed": datetime.now()})
+            self.write_documents(writes + [("reminders", collection, {"status": "inactive"})])
+            return True
+
+    def record_events(self, collection:str, events:dict[str, dict]) -> dict:
+        """
+        Append events, by event id, to the event log and count them into the
+        collection's aggregates together. Returns the updated aggregates.
+        """
+        with self._lock:
+            stats = apply_events(self.get_document(STATS, collection), events.values())
+            self.write_documents([(EVENTS, event_id, {"collection": collection, **event})
+                                  for event_id, event in events.items()] +
+                                 [(STATS, collection, stats)])
+            return stats
+
+    def get_reminder(self, collection:str) -> dict:
+        """
+        Return the reminder document for a collection
+
+        raises NotFound: if collection does not exist
+        """
+        reminder = self.get_document("reminders", collection)
+        if reminder is None:
+            raise NotFound(f"reminder collection {collection} not found")
+        return reminder
+
+    def reminder_is_active(self, collection:str) -> bool:
+        """
+        returns true if collection's status is active
+
+        raises NotFound: if collection does not exist
+        """
+        return self.get_reminder(collection).get("status") == "active"
+
+    def activate_reminder(self, collection:str) -> None:
+        """
+        Set collection status to active, indexing its users and rebuilding its queue
+        """
+        self.update_document("reminders", collection,
+                             {"status": "active", RESPONSE_DEADLINE: None})
+        self.index_collection(collection)
+        self.rebuild_rotation_queue(collection)
+
+    def add_user(self, collection:str, phone_number:str, name:str) -> None:
+        """
+        Add a user to a collection and to the phone number index
+        """
+        user = new_user(name)
+        with self._lock:
+            self.set_document(collection, phone_number, user)
+            self._index_phone_numbers(collection, [phone_number])
+            reminder = self.get_document("reminders", collection)
+            if reminder is not None and reminder.get(ROTATION_QUEUE) is not None:
+                self.update_document("reminders", collection, {
+                    ROTATION_QUEUE: enqueue(reminder[ROTATION_QUEUE], phone_number, user)})
+
+    def index_collection(self, collection:str) -> None:
+        """
+        Add every user of a collection to the phone number index
+        """
+        self._index_phone_numbers(collection,
+                                  [user.id for user in self.stream_documents(collection)])
+
+    def _index_phone_numbers(self, collection:str, phone_numbers:list[str]) -> None:
+        with self._lock:
+            writes = []
+            for phone_number in phone_numbers:
+                collections = self.get_collections_by_phone_number(phone_number)
+                if collection not in collections:
+                    writes.append((PHONE_INDEX, phone_number,
+                                   {"collections": collections + [collection]}))
+            for start in range(0, len(writes), MAX_BATCH_SIZE):
+                self.write_documents(writes[start:start + MAX_BATCH_SIZE])
+
+    def get_collections_by_phone_number(self, phone_number:str) -> list[str]:
+        """
+        Return the collections a phone number belongs to
+        """
+        index = self.get_document(PHONE_INDEX, phone_number)
+        return list(index.get("collections", [])) if index is not None else []
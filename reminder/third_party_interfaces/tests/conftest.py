@@ -0,0 +1,34 @@
+"""
+Shared fixtures for third party interface tests
+"""
+import pytest
+
+from reminder.third_party_interfaces import reset_client, reset_twilio_client, \
+                                            clear_reminder_cache, reset_token_cache, \
+                                            reset_backend, reset_async_twilio_client, \
+                                            reset_sms_sender
+from reminder.third_party_interfaces.async_database import reset_async_client
+
+@pytest.fixture(autouse=True)
+def fresh_client():
+    """
+    Each test patches firestore and twilio with its own mock,
+    so never reuse a cached client or cached documents
+    """
+    reset_client()
+    reset_async_client()
+    reset_twilio_client()
+    reset_async_twilio_client()
+    reset_sms_sender()
+    clear_reminder_cache()
+    reset_token_cache()
+    reset_backend()
+    yield
+    reset_backend()
+    reset_token_cache()
+    clear_reminder_cache()
+    reset_client()
+    reset_async_client()
+    reset_twilio_client()
+    reset_async_twilio_client()
+    reset_sms_sender()
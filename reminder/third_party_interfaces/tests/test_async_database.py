@@ -0,0 +1,100 @@
+"""
+Tests for the async firestore functions
+"""
+from asyncio import run
+from datetime import datetime
+from unittest.mock import patch, MagicMock, AsyncMock
+from assertpy import assert_that
+from google.cloud.exceptions import NotFound
+
+from reminder.third_party_interfaces import async_database, reminder_is_active, ROTATION_QUEUE
+
+# pylint: disable=unused-argument
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+
+def _snapshot(document_id:str, data:dict = None) -> MagicMock:
+    snapshot = MagicMock(id=document_id, exists=data is not None)
+    snapshot.to_dict.return_value = data
+    return snapshot
+
+async def _stream(snapshots:list):
+    for snapshot in snapshots:
+        yield snapshot
+
+@patch("reminder.third_party_interfaces.async_database.firestore")
+def test_get_reminder_is_cached(firestore_mock: MagicMock):
+    document = firestore_mock.AsyncClient.return_value.collection.return_value.document
+    document.return_value.get = AsyncMock(return_value=_snapshot("123", {"status": "active"}))
+
+    assert_that(run(async_database.reminder_is_active("123"))).is_true()
+    assert_that(run(async_database.reminder_is_active("123"))).is_true()
+    document.return_value.get.assert_awaited_once()
+
+@patch("reminder.third_party_interfaces.async_database.firestore")
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_reminder_cache_is_shared_with_sync_functions(sync_firestore: MagicMock,
+                                                     firestore_mock: MagicMock):
+    document = firestore_mock.AsyncClient.return_value.collection.return_value.document
+    document.return_value.get = AsyncMock(return_value=_snapshot("123", {"status": "active"}))
+
+    run(async_database.get_reminder("123"))
+    assert_that(reminder_is_active("123")).is_true()
+    sync_firestore.Client.return_value.collection.assert_not_called()
+
+@patch("reminder.third_party_interfaces.async_database.firestore")
+def test_get_missing_reminder(firestore_mock: MagicMock):
+    document = firestore_mock.AsyncClient.return_value.collection.return_value.document
+    document.return_value.get = AsyncMock(return_value=_snapshot("000"))
+
+    assert_that(run).raises(NotFound).when_called_with(async_database.get_reminder("000"))
+
+@patch("reminder.third_party_interfaces.async_database.firestore")
+def test_get_users_by_last_completed_date(firestore_mock: MagicMock):
+    collection = firestore_mock.AsyncClient.return_value.collection.return_value
+    query = collection.order_by.return_value.where.return_value.order_by.return_value
+    query.limit.return_value.stream = lambda: _stream([_snapshot("+11111111111", {})])
+
+    users = run(async_database.get_users_by_last_completed_date("123", 1))
+    query.limit.assert_called_once_with(1)
+    assert_that([user.id for user in users]).is_equal_to(["+11111111111"])
+
+@patch("reminder.third_party_interfaces.async_database.firestore")
+def test_get_next_user_rebuilds_missing_queue(firestore_mock: MagicMock):
+    client = firestore_mock.AsyncClient.return_value
+    document = client.collection.return_value.document
+    document.return_value.get = AsyncMock(return_value=_snapshot("123", {"status": "active"}))
+    document.return_value.update = AsyncMock()
+    client.collection.return_value.stream = lambda: _stream([
+        _snapshot("+11111111111", {"name": "Brian", "last_attempted": datetime(2023,1,1),
+                                   "last_completed": datetime(2023,2,1)}),
+        _snapshot("+12222222222", {"name": "Annie", "last_attempted": datetime(2023,1,1),
+                                   "last_completed": datetime(2023,1,1)})])
+
+    user = run(async_database.get_next_user("123"))
+    assert_that(user.id).is_equal_to("+12222222222")
+    queue = document.return_value.update.call_args.args[0][ROTATION_QUEUE]
+    assert_that([entry["phone_number"] for entry in queue]) \
+        .is_equal_to(["+12222222222", "+11111111111"])
+
+@patch("reminder.third_party_interfaces.async_database._accept_reminder",
+       new_callable=AsyncMock)
+@patch("reminder.third_party_interfaces.async_database.firestore")
+def test_accept_reminder_updates_cache(firestore_mock: MagicMock, accept: AsyncMock):
+    document = firestore_mock.AsyncClient.return_value.collection.return_value.document
+    document.return_value.get = AsyncMock(return_value=_snapshot("123", {"status": "active"}))
+    accept.return_value = {"status": "inactive"}
+
+    run(async_database.get_reminder("123"))
+    assert_that(run(async_database.accept_reminder("123", "+11111111111", "yes"))).is_true()
+    assert_that(run(async_database.reminder_is_active("123"))).is_false()
+
+@patch("reminder.third_party_interfaces.async_database.firestore")
+def test_index_collection_commits_batch(firestore_mock: MagicMock):
+    client = firestore_mock.AsyncClient.return_value
+    client.collection.return_value.stream = lambda: _stream([_snapshot("+11111111111", {})])
+    client.batch.return_value.commit = AsyncMock()
+
+    run(async_database.index_collection("123"))
+    client.batch.return_value.set.assert_called_once()
+    client.batch.return_value.commit.assert_awaited_once_with()
@@ -0,0 +1,50 @@
+"""
+Tests for the in-process caches
+"""
+from unittest.mock import patch, MagicMock
+from assertpy import assert_that
+from reminder.third_party_interfaces.cache import TTLCache
+
+# pylint: disable=unused-argument
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+
+@patch("reminder.third_party_interfaces.cache.monotonic")
+def test_entries_expire_after_ttl(monotonic:MagicMock):
+    monotonic.return_value = 100
+    cache = TTLCache(ttl=10)
+    cache.set("key", "value")
+    monotonic.return_value = 109
+    assert_that(cache.get("key")).is_equal_to("value")
+    monotonic.return_value = 110
+    assert_that(cache.get("key")).is_none()
+    assert_that(cache).is_length(0)
+
+@patch("reminder.third_party_interfaces.cache.monotonic")
+def test_entry_ttl_overrides_default(monotonic:MagicMock):
+    monotonic.return_value = 100
+    cache = TTLCache(ttl=10)
+    cache.set("forever", "value", ttl=None)
+    cache.set("short", "value", ttl=1)
+    monotonic.return_value = 1000
+    assert_that(cache.get("forever")).is_equal_to("value")
+    assert_that("short" in cache).is_false()
+
+def test_least_recently_used_is_evicted():
+    cache = TTLCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert_that("a" in cache).is_true()
+    assert_that("b" in cache).is_false()
+    assert_that("c" in cache).is_true()
+
+def test_pop_and_clear():
+    cache = TTLCache()
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert_that(cache.pop("a")).is_equal_to(1)
+    assert_that(cache.pop("a", "missing")).is_equal_to("missing")
+    cache.clear()
+    assert_that(cache).is_length(0)
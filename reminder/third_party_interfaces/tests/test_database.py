@@ -4,18 +4,42 @@ All database connection tests writted with Mock firestore
 from unittest.mock import patch, MagicMock
 from datetime import datetime, timedelta
 from assertpy import assert_that
-from mockfirestore import MockFirestore
+from mockfirestore import MockFirestore, DocumentReference
 from google.cloud.exceptions import NotFound
 
 from reminder.third_party_interfaces import get_users_by_last_completed_date, NULL_DATETIME, \
                                             get_user_by_phone_number, update_user_response, \
-                                            complete_reminder, reminder_is_active
+                                            reminder_is_active, get_client, \
+                                            reset_client, accept_reminder, activate_reminder, \
+                                            get_reminder, add_user, index_collection, \
+                                            get_collections_by_phone_number, prime_reminder_cache, \
+                                            update_user_attempted, get_next_user, ROTATION_QUEUE, \
+                                            RESPONSE_DEADLINE, STATS, record_events
 
 # pylint: disable=unused-argument
 # pylint: disable=missing-function-docstring
 # pylint: disable=missing-class-docstring
 # pylint: disable=protected-access
 
+_mock_document_get = DocumentReference.get
+
+def _get_in_transaction(reference: DocumentReference, transaction=None):
+    """
+    mockfirestore references do not accept the transaction keyword
+    """
+    return _mock_document_get(reference)
+
+def _with_batches(mock_db: MockFirestore) -> MockFirestore:
+    """
+    mockfirestore has no write batches, but a begun transaction commits the same way
+    """
+    def batch():
+        transaction = mock_db.transaction()
+        transaction._begin()
+        return transaction
+    mock_db.batch = batch
+    return mock_db
+
 @patch("reminder.third_party_interfaces.database.firestore")
 def test_get_record_when_no_dates_set_one_record(firestore_mock: MagicMock):
     mock_db = MockFirestore()
@@ -202,8 +226,9 @@ def test_update_user_response_with_bad_number(firestore_mock: MagicMock):
     assert_that(update_user_response).raises(NotFound).when_called_with("123", "+12222222222",
                                                                         "Yes")
 
+@patch.object(DocumentReference, "get", _get_in_transaction)
 @patch("reminder.third_party_interfaces.database.firestore")
-def test_complete_reminder(firestore_mock: MagicMock):
+def test_accept_reminder(firestore_mock: MagicMock):
     mock_db = MockFirestore()
     rotation = ("123", {"name": "Trash Reminder", "schedule": "0 17 * * THU", "status": "active"})
     brian = ("+14444444444", {"name": "Brian", "last_completed": datetime(2023,2,1),
@@ -217,8 +242,90 @@ def test_complete_reminder(firestore_mock: MagicMock):
         }
     }
     firestore_mock.Client.return_value = mock_db
-    complete_reminder(rotation[0], brian[0])
+    assert_that(accept_reminder(rotation[0], brian[0], "Yes")).is_true()
     assert_that(rotation[1].get("status")).is_equal_to("inactive")
+    assert_that(brian[1].get("last_response")).is_equal_to("Yes")
+    assert_that(brian[1].get("last_completed")).is_greater_than(datetime(2023,2,1))
+
+@patch.object(DocumentReference, "get", _get_in_transaction)
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_accept_reminder_when_already_completed(firestore_mock: MagicMock):
+    mock_db = MockFirestore()
+    rotation = ("123", {"name": "Trash Reminder", "schedule": "0 17 * * THU",
+                        "status": "inactive"})
+    brian = ("+14444444444", {"name": "Brian", "last_completed": datetime(2023,2,1),
+                              "last_attempted": datetime(2023,2,1), "last_response": ""})
+    mock_db._data = {
+        "reminders": {
+            rotation[0]: rotation[1],
+        },
+        rotation[0]: {
+            brian[0]: brian[1]
+        }
+    }
+    firestore_mock.Client.return_value = mock_db
+    assert_that(accept_reminder(rotation[0], brian[0], "Yes")).is_false()
+    assert_that(brian[1].get("last_response")).is_equal_to("")
+    assert_that(brian[1].get("last_completed")).is_equal_to(datetime(2023,2,1))
+    assert_that(accept_reminder).raises(NotFound).when_called_with("000", brian[0], "Yes")
+
+@patch.object(DocumentReference, "get", _get_in_transaction)
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_rotation_queue_updated_in_transactions(firestore_mock: MagicMock):
+    mock_db = MockFirestore()
+    rotation = ("123", {"name": "Trash Reminder", "schedule": "0 17 * * THU", "status": "active"})
+    brian = ("+14444444444", {"name": "Brian", "last_completed": datetime(2023,2,1),
+                              "last_attempted": datetime(2023,1,1), "last_response": ""})
+    annie = ("+15555555555", {"name": "Annie", "last_completed": datetime(2023,1,1),
+                              "last_attempted": NULL_DATETIME, "last_response": ""})
+    mock_db._data = {
+        "reminders": {
+            rotation[0]: rotation[1],
+        },
+        rotation[0]: {
+            brian[0]: brian[1],
+            annie[0]: annie[1],
+        }
+    }
+    firestore_mock.Client.return_value = mock_db
+    assert_that(get_next_user("123").id).is_equal_to(annie[0])
+    update_user_attempted("123", annie[0])
+    assert_that([entry["phone_number"] for entry in rotation[1][ROTATION_QUEUE]]) \
+        .is_equal_to([brian[0], annie[0]])
+    assert_that(rotation[1][ROTATION_QUEUE][1]["last_attempted"]) \
+        .is_equal_to(annie[1]["last_attempted"])
+    assert_that(accept_reminder("123", brian[0], "Yes")).is_true()
+    assert_that(rotation[1][ROTATION_QUEUE][0]["last_completed"]) \
+        .is_equal_to(brian[1]["last_completed"])
+    assert_that(get_next_user("123").id).is_equal_to(brian[0])
+
+@patch.object(DocumentReference, "get", _get_in_transaction)
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_attempt_starts_response_deadline(firestore_mock: MagicMock):
+    mock_db = MockFirestore()
+    rotation = ("123", {"name": "Trash Reminder", "status": "active", "response_timeout": 600})
+    annie = ("+15555555555", {"name": "Annie", "last_completed": datetime(2023,1,1),
+                              "last_attempted": NULL_DATETIME, "last_response": ""})
+    mock_db._data = {"reminders": {rotation[0]: rotation[1]}, rotation[0]: {annie[0]: annie[1]}}
+    firestore_mock.Client.return_value = mock_db
+    update_user_attempted("123", annie[0])
+    deadline = rotation[1][RESPONSE_DEADLINE]
+    assert_that(deadline["phone_number"]).is_equal_to(annie[0])
+    assert_that((deadline["due"] - annie[1]["last_attempted"]).total_seconds()) \
+        .is_equal_to(600)
+    assert_that(get_reminder("123")[RESPONSE_DEADLINE]).is_equal_to(deadline)
+
+@patch.object(DocumentReference, "get", _get_in_transaction)
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_record_events_updates_aggregates(firestore_mock: MagicMock):
+    mock_db = MockFirestore()
+    mock_db._data = {STATS: {"123": {"totals": {"sent": 4}, "users": {}, "periods": {}}}}
+    firestore_mock.Client.return_value = mock_db
+    stats = record_events("123", {"a": {"type": "sent", "phone_number": "+11111111111",
+                                        "time": datetime(2023,3,2)}})
+    assert_that(stats["totals"]).is_equal_to({"sent": 5})
+    assert_that(mock_db._data[STATS]["123"]).is_equal_to(stats)
+    assert_that(mock_db._data["events"]["a"]).contains_entry({"collection": "123"})
 
 @patch("reminder.third_party_interfaces.database.firestore")
 def test_is_active(firestore_mock: MagicMock):
@@ -235,3 +342,205 @@ def test_is_active(firestore_mock: MagicMock):
     assert_that(reminder_is_active("123")).is_true()
     assert_that(reminder_is_active("456")).is_false()
     assert_that(reminder_is_active).raises(NotFound).when_called_with("000")
+
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_client_is_shared_between_calls(firestore_mock: MagicMock):
+    mock_db = MockFirestore()
+    rotation = ("123", {"name": "Trash Reminder", "schedule": "0 17 * * THU", "status": "active"})
+    mock_db._data = {
+        "reminders": {
+            rotation[0]: rotation[1],
+        }
+    }
+    firestore_mock.Client.return_value = mock_db
+    reminder_is_active("123")
+    reminder_is_active("123")
+    assert_that(get_client()).is_same_as(mock_db)
+    firestore_mock.Client.assert_called_once_with()
+
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_reset_client_creates_new_client(firestore_mock: MagicMock):
+    firestore_mock.Client.side_effect = [MockFirestore(), MockFirestore()]
+    first = get_client()
+    reset_client()
+    second = get_client()
+    assert_that(firestore_mock.Client.call_count).is_equal_to(2)
+    assert_that(first).is_not_same_as(second)
+
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_reminder_is_served_from_cache(firestore_mock: MagicMock):
+    mock_db = MockFirestore()
+    rotation = ("123", {"name": "Trash Reminder", "schedule": "0 17 * * THU", "status": "active"})
+    mock_db._data = {
+        "reminders": {
+            rotation[0]: rotation[1],
+        }
+    }
+    firestore_mock.Client.return_value = mock_db
+    assert_that(reminder_is_active("123")).is_true()
+    rotation[1]["status"] = "inactive"
+    assert_that(reminder_is_active("123")).is_true()
+
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_prime_reminder_cache(firestore_mock: MagicMock):
+    mock_db = MockFirestore()
+    mock_db._data = {
+        "reminders": {
+            "123": {"name": "Trash Reminder", "status": "active"},
+            "456": {"name": "Recycling Reminder", "status": "inactive"},
+        }
+    }
+    firestore_mock.Client.return_value = mock_db
+    assert_that(prime_reminder_cache()).is_equal_to(2)
+    mock_db._data["reminders"]["123"]["status"] = "inactive"
+    assert_that(reminder_is_active("123")).is_true()
+
+@patch.dict("os.environ", {"REMINDER_CACHE_TTL": "0"})
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_reminder_cache_expires(firestore_mock: MagicMock):
+    mock_db = MockFirestore()
+    rotation = ("123", {"name": "Trash Reminder", "schedule": "0 17 * * THU", "status": "active"})
+    mock_db._data = {
+        "reminders": {
+            rotation[0]: rotation[1],
+        }
+    }
+    firestore_mock.Client.return_value = mock_db
+    assert_that(reminder_is_active("123")).is_true()
+    rotation[1]["status"] = "inactive"
+    assert_that(reminder_is_active("123")).is_false()
+
+@patch.object(DocumentReference, "get", _get_in_transaction)
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_reminder_cache_is_written_through(firestore_mock: MagicMock):
+    mock_db = _with_batches(MockFirestore())
+    rotation = ("123", {"name": "Trash Reminder", "schedule": "0 17 * * THU",
+                        "status": "inactive"})
+    brian = ("+14444444444", {"name": "Brian", "last_completed": datetime(2023,2,1),
+                              "last_attempted": datetime(2023,2,1), "last_response": ""})
+    mock_db._data = {
+        "reminders": {
+            rotation[0]: rotation[1],
+        },
+        rotation[0]: {
+            brian[0]: brian[1]
+        }
+    }
+    firestore_mock.Client.return_value = mock_db
+    assert_that(reminder_is_active("123")).is_false()
+    activate_reminder("123")
+    assert_that(reminder_is_active("123")).is_true()
+    accept_reminder("123", brian[0], "Yes")
+    assert_that(reminder_is_active("123")).is_false()
+    assert_that(get_reminder("123")).is_equal_to(rotation[1])
+
+@patch.dict("os.environ", {"REMINDER_CACHE_LISTEN": "True"})
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_reminder_cache_listener(firestore_mock: MagicMock):
+    client = firestore_mock.Client.return_value
+    reminders = client.collection.return_value
+    reminders.document.return_value.get.return_value.exists = False
+    assert_that(reminder_is_active).raises(NotFound).when_called_with("123")
+    reminders.on_snapshot.assert_called_once()
+    on_snapshot = reminders.on_snapshot.call_args.args[0]
+
+    change = MagicMock()
+    change.type.name = "ADDED"
+    change.document.id = "123"
+    change.document.to_dict.return_value = {"status": "active"}
+    on_snapshot([change.document], [change], datetime.now())
+    assert_that(reminder_is_active("123")).is_true()
+
+    with patch("reminder.third_party_interfaces.database._reminder_cache.set") as cache_set:
+        activate_reminder("123")
+        cache_set.assert_called_once_with("123", {"status": "active", RESPONSE_DEADLINE: None,
+                                                  ROTATION_QUEUE: []},
+                                          ttl=None)
+
+    change.type.name = "REMOVED"
+    on_snapshot([], [change], datetime.now())
+    assert_that(reminder_is_active).raises(NotFound).when_called_with("123")
+    reminders.on_snapshot.assert_called_once()
+
+@patch.object(DocumentReference, "get", _get_in_transaction)
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_add_user_indexes_phone_number(firestore_mock: MagicMock):
+    mock_db = MockFirestore()
+    mock_db._data = {
+        "phone_index": {
+            "+14444444444": {"collections": ["456"]},
+        },
+    }
+    firestore_mock.Client.return_value = mock_db
+    assert_that(get_collections_by_phone_number("+14444444444")).is_equal_to(["456"])
+    add_user("123", "+14444444444", "Brian")
+    assert_that(mock_db._data["123"]["+14444444444"]).is_equal_to({
+        "name": "Brian", "last_completed": NULL_DATETIME,
+        "last_attempted": NULL_DATETIME, "last_response": ""})
+    assert_that(mock_db._data["phone_index"]["+14444444444"]["collections"]) \
+        .is_equal_to(["456", "123"])
+    assert_that(get_collections_by_phone_number("+14444444444")).is_equal_to(["456", "123"])
+
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_activate_reminder_indexes_collection(firestore_mock: MagicMock):
+    mock_db = _with_batches(MockFirestore())
+    rotation = ("123", {"name": "Trash Reminder", "schedule": "0 17 * * THU",
+                        "status": "inactive"})
+    brian = ("+14444444444", {"name": "Brian", "last_completed": datetime(2023,2,1),
+                              "last_attempted": datetime(2023,2,1), "last_response": ""})
+    annie = ("+15555555555", {"name": "Annie", "last_completed": datetime(2023,1,1),
+                              "last_attempted": datetime(2023,2,1), "last_response": ""})
+    mock_db._data = {
+        "reminders": {
+            rotation[0]: rotation[1],
+        },
+        rotation[0]: {
+            brian[0]: brian[1],
+            annie[0]: annie[1],
+        },
+        "phone_index": {
+            brian[0]: {"collections": []},
+            annie[0]: {"collections": ["456"]},
+        },
+    }
+    firestore_mock.Client.return_value = mock_db
+    activate_reminder("123")
+    assert_that(get_collections_by_phone_number(brian[0])).is_equal_to(["123"])
+    assert_that(get_collections_by_phone_number(annie[0])).is_equal_to(["456", "123"])
+
+@patch("reminder.third_party_interfaces.database.MAX_BATCH_SIZE", 2)
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_index_collection_commits_in_batches(firestore_mock: MagicMock):
+    client = firestore_mock.Client.return_value
+    users = [MagicMock(id=f"+1555555555{index}") for index in range(5)]
+    client.collection.return_value.stream.return_value = iter(users)
+    index_collection("123")
+    assert_that(client.batch.call_count).is_equal_to(3)
+    assert_that(client.batch.return_value.set.call_count).is_equal_to(5)
+    assert_that(client.batch.return_value.commit.call_count).is_equal_to(3)
+
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_unknown_phone_number_has_no_collections(firestore_mock: MagicMock):
+    firestore_mock.Client.return_value = MockFirestore()
+    assert_that(get_collections_by_phone_number("+12222222222")).is_empty()
+
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_unknown_phone_number_is_not_cached(firestore_mock: MagicMock):
+    mock_db = MockFirestore()
+    firestore_mock.Client.return_value = mock_db
+    assert_that(get_collections_by_phone_number("+12222222222")).is_empty()
+    # indexed by another instance or the cli
+    mock_db._data = {"phone_index": {"+12222222222": {"collections": ["123"]}}}
+    assert_that(get_collections_by_phone_number("+12222222222")).is_equal_to(["123"])
+
+@patch.object(DocumentReference, "get", _get_in_transaction)
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_add_user_clears_cached_index(firestore_mock: MagicMock):
+    mock_db = MockFirestore()
+    mock_db._data = {"phone_index": {"+14444444444": {"collections": ["456"]}}}
+    firestore_mock.Client.return_value = mock_db
+    assert_that(get_collections_by_phone_number("+14444444444")).is_equal_to(["456"])
+    add_user("123", "+14444444444", "Brian")
+    mock_db._data["phone_index"]["+14444444444"]["collections"].append("789")
+    assert_that(get_collections_by_phone_number("+14444444444")) \
+        .is_equal_to(["456", "123", "789"])
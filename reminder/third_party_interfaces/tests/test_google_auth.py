@@ -0,0 +1,61 @@
+"""
+Tests for google token verification
+"""
+from time import time
+from unittest.mock import patch, MagicMock
+from assertpy import assert_that
+from reminder.third_party_interfaces import verify_token, fetch_certificates
+from reminder.third_party_interfaces.google_auth import CachingRequest, GOOGLE_CERTS_URL
+
+# pylint: disable=unused-argument
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+
+@patch("google.oauth2.id_token.verify_oauth2_token")
+def test_verified_token_is_cached_until_expiry(verify_oauth2_token:MagicMock):
+    claim = {"aud": "https://localhost", "exp": time() + 300}
+    verify_oauth2_token.return_value = claim
+    assert_that(verify_token("header.payload.signature")).is_equal_to(claim)
+    assert_that(verify_token("header.payload.signature")).is_equal_to(claim)
+    verify_oauth2_token.assert_called_once()
+
+@patch("google.oauth2.id_token.verify_oauth2_token")
+def test_expired_token_is_not_cached(verify_oauth2_token:MagicMock):
+    verify_oauth2_token.return_value = {"exp": time() - 1}
+    verify_token("header.payload.signature")
+    verify_token("header.payload.signature")
+    assert_that(verify_oauth2_token.call_count).is_equal_to(2)
+
+@patch("google.oauth2.id_token.verify_oauth2_token")
+def test_invalid_token_is_not_cached(verify_oauth2_token:MagicMock):
+    verify_oauth2_token.side_effect = ValueError("bad signature")
+    assert_that(verify_token).raises(ValueError).when_called_with("header.payload.signature")
+    assert_that(verify_token).raises(ValueError).when_called_with("header.payload.signature")
+    assert_that(verify_oauth2_token.call_count).is_equal_to(2)
+
+@patch("google.auth.transport.requests.Request")
+def test_certificates_cached_for_max_age(request:MagicMock):
+    response = MagicMock(status=200, headers={"Cache-Control": "public, max-age=19000"})
+    request.return_value.return_value = response
+    caching_request = CachingRequest()
+    assert_that(caching_request("https://certs")).is_same_as(response)
+    assert_that(caching_request("https://certs")).is_same_as(response)
+    request.return_value.assert_called_once()
+
+@patch("google.auth.transport.requests.Request")
+def test_uncacheable_responses_are_fetched_again(request:MagicMock):
+    request.return_value.return_value = MagicMock(status=200, headers={"Cache-Control": "no-store"})
+    caching_request = CachingRequest()
+    caching_request("https://certs")
+    caching_request("https://certs")
+    caching_request("https://token", method="POST", body=b"data")
+    assert_that(request.return_value.call_count).is_equal_to(3)
+
+@patch("google.auth.transport.requests.Request")
+def test_fetch_certificates_fills_the_request_cache(request:MagicMock):
+    request.return_value.return_value = MagicMock(
+        status=200, headers={"Cache-Control": "public, max-age=19000"})
+    fetch_certificates()
+    fetch_certificates()
+    request.return_value.assert_called_once_with(GOOGLE_CERTS_URL, method="GET", headers=None,
+                                                 timeout=None)
@@ -0,0 +1,53 @@
+"""
+Tests for latency histograms
+"""
+from os import environ
+from unittest.mock import patch
+from assertpy import assert_that
+
+from reminder.third_party_interfaces.metrics import Histogram, timed, observe, render_metrics, \
+                                                    reset_metrics
+
+# pylint: disable=missing-function-docstring
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram((0.1, 1.0))
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+    assert_that(histogram.snapshot()).is_equal_to(([1, 2], 3, 5.55))
+
+@patch.dict(environ, {"METRICS_ENABLED": "True"})
+def test_timed_records_calls_and_failures():
+    reset_metrics()
+
+    @timed
+    def fail():
+        raise ValueError("boom")
+
+    assert_that(fail).raises(ValueError).when_called_with()
+    assert_that(fail.__name__).is_equal_to("fail")
+    assert_that(render_metrics()).contains(
+        'reminder_operation_seconds_count{operation="test_metrics.'
+        'test_timed_records_calls_and_failures.<locals>.fail"} 1')
+    reset_metrics()
+
+@patch.dict(environ, {"METRICS_ENABLED": "False"})
+def test_timed_records_nothing_when_disabled():
+    reset_metrics()
+    timed(len)([1, 2])
+    assert_that(render_metrics()).does_not_contain("_count")
+
+def test_render_metrics():
+    reset_metrics()
+    observe("backend.get_reminder", 0.02)
+    text = render_metrics({"reminder_outbox_depth": 3})
+    reset_metrics()
+
+    assert_that(text).contains(
+        "# TYPE reminder_operation_seconds histogram\n",
+        'reminder_operation_seconds_bucket{operation="backend.get_reminder",le="0.01"} 0\n',
+        'reminder_operation_seconds_bucket{operation="backend.get_reminder",le="0.025"} 1\n',
+        'reminder_operation_seconds_bucket{operation="backend.get_reminder",le="+Inf"} 1\n',
+        'reminder_operation_seconds_sum{operation="backend.get_reminder"} 0.02\n',
+        "# TYPE reminder_outbox_depth gauge\nreminder_outbox_depth 3\n")
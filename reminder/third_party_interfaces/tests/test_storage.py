@@ -0,0 +1,265 @@
+"""
+Tests for the in-memory and sqlite storage backends
+"""
+from datetime import datetime
+from unittest.mock import patch, MagicMock
+import pytest
+from assertpy import assert_that
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud.exceptions import NotFound
+from mockfirestore import MockFirestore
+
+from reminder.third_party_interfaces import NULL_DATETIME, ROTATION_QUEUE, RESPONSE_DEADLINE, \
+                                            EVENTS, STATS, MemoryBackend, SQLiteBackend, \
+                                            FirestoreBackend, get_backend, deadline_of
+
+# pylint: disable=unused-argument
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+# pylint: disable=protected-access
+# pylint: disable=redefined-outer-name
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request):
+    if request.param == "memory":
+        yield MemoryBackend()
+    else:
+        sqlite_backend = SQLiteBackend(":memory:")
+        yield sqlite_backend
+        sqlite_backend.close()
+
+def _household(backend):
+    backend.set_document("reminders", "123", {"name": "Trash Reminder",
+                                              "schedule": "0 17 * * THU", "status": "active"})
+    backend.set_document("123", "+11111111111", {"name": "Brian",
+                                                 "last_completed": datetime(2023,2,1),
+                                                 "last_attempted": datetime(2023,1,1),
+                                                 "last_response": ""})
+    backend.set_document("123", "+12222222222", {"name": "Annie",
+                                                 "last_completed": datetime(2023,1,1),
+                                                 "last_attempted": NULL_DATETIME,
+                                                 "last_response": ""})
+    backend.set_document("123", "+13333333333", {"name": "Haley",
+                                                 "last_completed": datetime(2023,1,1),
+                                                 "last_attempted": datetime.now(),
+                                                 "last_response": ""})
+
+def test_documents_round_trip(backend):
+    backend.set_document("123", "a", {"name": "Brian", "last_completed": datetime(2023,2,1)})
+    assert_that(backend.get_document("123", "a")) \
+        .is_equal_to({"name": "Brian", "last_completed": datetime(2023,2,1)})
+    backend.set_document("123", "a", {"last_response": "Yes"}, merge=True)
+    backend.update_document("123", "a", {"name": "Annie"})
+    assert_that(backend.get_document("123", "a")).is_equal_to(
+        {"name": "Annie", "last_completed": datetime(2023,2,1), "last_response": "Yes"})
+    backend.delete_document("123", "a")
+    assert_that(backend.get_document("123", "a")).is_none()
+    assert_that(backend.update_document).raises(NotFound).when_called_with("123", "a", {})
+
+def test_create_document_only_once(backend):
+    assert_that(backend.create_document("123", "a", {"name": "Brian"})).is_true()
+    assert_that(backend.create_document("123", "a", {"name": "Annie"})).is_false()
+    assert_that(backend.get_document("123", "a")).is_equal_to({"name": "Brian"})
+
+def test_write_documents(backend):
+    backend.set_document("123", "a", {"name": "Brian"})
+    backend.write_documents([("123", "a", None), ("123", "b", {"name": "Annie"}),
+                             ("456", "c", {"name": "Haley"})])
+    assert_that([user.id for user in backend.stream_documents("123")]).is_equal_to(["b"])
+    assert_that(backend.get_document("456", "c")).is_equal_to({"name": "Haley"})
+
+def test_get_documents(backend):
+    backend.set_document("123", "a", {"name": "Brian"})
+    records = backend.get_documents([("123", "a"), ("reminders", "123")])
+    assert_that(records[("123", "a")].to_dict()).is_equal_to({"name": "Brian"})
+    assert_that(records[("reminders", "123")].exists).is_false()
+
+def test_commit_documents_only_if_unchanged(backend):
+    backend.set_document("123", "a", {"name": "Brian"})
+    read = backend.get_documents([("123", "a")])
+    assert_that(backend.commit_documents([("123", "a", {"last_response": "No"}),
+                                          ("123", "b", {"name": "Annie"})], read)).is_true()
+    assert_that(backend.get_document("123", "a")) \
+        .is_equal_to({"name": "Brian", "last_response": "No"})
+
+    assert_that(backend.commit_documents([("123", "a", None), ("123", "b", None)],
+                                         read)).is_false()
+    assert_that(backend.get_document("123", "a")).is_not_none()
+    assert_that(backend.get_document("123", "b")).is_equal_to({"name": "Annie"})
+
+def test_users_ordered_by_last_attempted_then_completed(backend):
+    _household(backend)
+    users = list(backend.get_users_by_last_completed_date("123"))
+    assert_that([user.id for user in users]).is_equal_to(["+12222222222", "+11111111111"])
+    first = list(backend.get_users_by_last_completed_date("123", 1))
+    assert_that(first).is_length(1)
+    assert_that(first[0].to_dict().get("name")).is_equal_to("Annie")
+
+def test_user_lookup_and_updates(backend):
+    _household(backend)
+    assert_that(backend.get_user_by_phone_number("123", "+19999999999").exists).is_false()
+    backend.update_user_response("123", "+11111111111", "No")
+    backend.update_user_attempted("123", "+11111111111")
+    brian = backend.get_user_by_phone_number("123", "+11111111111")
+    assert_that(brian.to_dict()["last_response"]).is_equal_to("No")
+    assert_that(brian.to_dict()["last_attempted"]).is_greater_than(datetime(2023,1,1))
+    assert_that(list(backend.get_all_users_by_collection("123"))).is_length(3)
+
+def test_accept_reminder_only_once(backend):
+    _household(backend)
+    assert_that(backend.accept_reminder("123", "+11111111111", "Yes")).is_true()
+    assert_that(backend.accept_reminder("123", "+12222222222", "Yes")).is_false()
+    assert_that(backend.reminder_is_active("123")).is_false()
+    assert_that(backend.get_document("123", "+12222222222")["last_response"]).is_equal_to("")
+    assert_that(backend.reminder_is_active).raises(NotFound).when_called_with("000")
+
+def _queued(backend):
+    return [entry["phone_number"]
+            for entry in backend.get_document("reminders", "123")[ROTATION_QUEUE]]
+
+def test_next_user_read_from_rotation_queue(backend):
+    _household(backend)
+    assert_that(backend.get_next_user("123").to_dict()["name"]).is_equal_to("Annie")
+    assert_that(_queued(backend)).is_equal_to(["+12222222222", "+11111111111", "+13333333333"])
+    backend.update_user_attempted("123", "+12222222222")
+    assert_that(_queued(backend)).is_equal_to(["+11111111111", "+13333333333", "+12222222222"])
+    assert_that(backend.get_next_user("123").id).is_equal_to("+11111111111")
+    backend.update_user_attempted("123", "+11111111111")
+    assert_that(backend.get_next_user("123")).is_none()
+    assert_that(backend.get_next_user).raises(NotFound).when_called_with("000")
+
+def test_attempt_starts_response_deadline(backend):
+    _household(backend)
+    backend.update_user_attempted("123", "+11111111111")
+    assert_that(backend.get_document("reminders", "123")).does_not_contain_key(RESPONSE_DEADLINE)
+
+    backend.update_document("reminders", "123", {"response_timeout": 3600})
+    before = datetime.now()
+    backend.update_user_attempted("123", "+12222222222")
+    due, phone_number = deadline_of(backend.get_reminder("123"))
+    assert_that(phone_number).is_equal_to("+12222222222")
+    assert_that((due - before).total_seconds()).is_between(3600, 3601)
+
+    backend.activate_reminder("123")
+    assert_that(deadline_of(backend.get_reminder("123"))).is_none()
+
+@patch.dict("os.environ", {"RESPONSE_TIMEOUT": "60"})
+def test_response_timeout_defaults_from_environment(backend):
+    _household(backend)
+    backend.update_user_attempted("123", "+11111111111")
+    assert_that(deadline_of(backend.get_reminder("123"))[1]).is_equal_to("+11111111111")
+    backend.update_document("reminders", "123", {"status": "inactive"})
+    assert_that(deadline_of(backend.get_reminder("123"))).is_none()
+
+def test_events_counted_into_aggregates(backend):
+    backend.record_events("123", {
+        "a": {"type": "sent", "phone_number": "+11111111111", "name": "Brian",
+              "time": datetime(2023,3,2,17)},
+        "b": {"type": "declined", "phone_number": "+11111111111",
+              "time": datetime(2023,3,2,18)}})
+    stats = backend.record_events("123", {
+        "c": {"type": "completed", "phone_number": "+12222222222", "time": datetime(2023,4,1)}})
+    assert_that(backend.get_document(STATS, "123")).is_equal_to(stats)
+    assert_that(stats["totals"]).is_equal_to({"sent": 1, "declined": 1, "completed": 1})
+    assert_that(stats["users"]["+11111111111"]) \
+        .is_equal_to({"name": "Brian", "sent": 1, "declined": 1})
+    assert_that(stats["periods"]).is_equal_to({"2023-03": {"sent": 1, "declined": 1},
+                                               "2023-04": {"completed": 1}})
+    assert_that(backend.get_document(EVENTS, "b")) \
+        .contains_entry({"collection": "123"}, {"type": "declined"})
+
+def test_rotation_queue_follows_completions_and_new_users(backend):
+    _household(backend)
+    backend.rebuild_rotation_queue("123")
+    backend.accept_reminder("123", "+11111111111", "Yes")
+    brian = backend.get_document("reminders", "123")[ROTATION_QUEUE][1]
+    assert_that(brian["last_completed"]).is_greater_than(datetime(2023,2,1))
+    assert_that(backend.get_document("reminders", "123")["status"]).is_equal_to("inactive")
+    backend.add_user("123", "+14444444444", "Dana")
+    assert_that(backend.get_next_user("123").id).is_equal_to("+14444444444")
+
+def test_verify_rotation_queue_rebuilds_stale_queue(backend):
+    _household(backend)
+    assert_that(backend.verify_rotation_queue("123")).is_false()
+    assert_that(backend.verify_rotation_queue("123")).is_true()
+    backend.update_document("123", "+13333333333", {"last_attempted": NULL_DATETIME})
+    assert_that(backend.verify_rotation_queue("123")).is_false()
+    assert_that(_queued(backend)[:2]).is_equal_to(["+12222222222", "+13333333333"])
+
+def test_prime_reminder_cache_counts_reminders(backend):
+    _household(backend)
+    assert_that(backend.prime_reminder_cache()).is_equal_to(1)
+
+def test_activate_reminder_indexes_users(backend):
+    _household(backend)
+    backend.add_user("456", "+11111111111", "Brian")
+    backend.update_document("reminders", "123", {"status": "inactive"})
+    backend.activate_reminder("123")
+    assert_that(backend.reminder_is_active("123")).is_true()
+    assert_that(backend.get_collections_by_phone_number("+11111111111")) \
+        .is_equal_to(["456", "123"])
+    assert_that(backend.get_collections_by_phone_number("+12222222222")).is_equal_to(["123"])
+    assert_that(backend.get_user_by_phone_number("456", "+11111111111").to_dict()).is_equal_to(
+        {"name": "Brian", "last_completed": NULL_DATETIME, "last_attempted": NULL_DATETIME,
+         "last_response": ""})
+
+def test_sqlite_rotation_query_uses_index():
+    backend = SQLiteBackend(":memory:")
+    plan = backend._connection.execute(
+        "EXPLAIN QUERY PLAN SELECT id, data FROM documents "
+        "WHERE collection = ? AND last_attempted <= ? AND last_completed IS NOT NULL "
+        "ORDER BY last_attempted, last_completed LIMIT ?", ("123", "2023", 1)).fetchall()
+    assert_that(str(plan)).contains("documents_rotation")
+    backend.close()
+
+@patch.dict("os.environ", {"STORAGE_BACKEND": "memory"})
+def test_backend_selected_from_environment():
+    assert_that(get_backend()).is_instance_of(MemoryBackend)
+
+def test_firestore_is_the_default_backend():
+    assert_that(get_backend()).is_instance_of(FirestoreBackend)
+
+@patch.dict("os.environ", {"STORAGE_BACKEND": "paper"})
+def test_unknown_backend():
+    assert_that(get_backend).raises(ValueError).when_called_with().contains("paper")
+
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_firestore_write_documents_batches(firestore_mock: MagicMock):
+    client = firestore_mock.Client.return_value
+    FirestoreBackend().write_documents([("123", "a", {"name": "Brian"}), ("123", "b", None)])
+    batch = client.batch.return_value
+    batch.set.assert_called_once()
+    batch.delete.assert_called_once()
+    batch.commit.assert_called_once_with()
+
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_firestore_get_documents_in_one_call(firestore_mock: MagicMock):
+    mock_db = MockFirestore()
+    mock_db._data = {"reminders": {"123": {"status": "active"}}}
+    firestore_mock.Client.return_value = mock_db
+    with patch.object(mock_db, "get_all", wraps=mock_db.get_all) as get_all:
+        records = FirestoreBackend().get_documents([("123", "a"), ("reminders", "123")])
+    get_all.assert_called_once()
+    assert_that(records[("reminders", "123")].to_dict()).is_equal_to({"status": "active"})
+    assert_that(records[("123", "a")].exists).is_false()
+
+@patch("reminder.third_party_interfaces.database.firestore")
+def test_firestore_commit_documents_preconditions(firestore_mock: MagicMock):
+    client = firestore_mock.Client.return_value
+    found, missing = MagicMock(exists=True), MagicMock(exists=False)
+    read = {("123", "a"): found, ("123", "b"): missing}
+    assert_that(FirestoreBackend().commit_documents(
+        [("123", "a", {"last_response": "No"}), ("123", "b", {"name": "Annie"}),
+         ("123", "c", {"name": "Haley"})], read)).is_true()
+
+    batch = client.batch.return_value
+    client.write_option.assert_called_once_with(last_update_time=found.update_time)
+    batch.update.assert_called_once_with(client.collection.return_value.document.return_value,
+                                         {"last_response": "No"},
+                                         option=client.write_option.return_value)
+    batch.create.assert_called_once()
+    batch.set.assert_called_once()
+    batch.commit.assert_called_once_with()
+
+    batch.commit.side_effect = FailedPrecondition("changed")
+    assert_that(FirestoreBackend().commit_documents([("123", "a", None)], read)).is_false()
@@ -0,0 +1,76 @@
+"""
+Tests for the rate limiting and ordering primitives
+"""
+from asyncio import gather, run, sleep as async_sleep
+from threading import Event, Thread
+from unittest.mock import patch, MagicMock
+from assertpy import assert_that
+from reminder.third_party_interfaces import TokenBucket, KeyedTurns
+
+# pylint: disable=unused-argument
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+
+@patch("reminder.third_party_interfaces.throttle.monotonic", return_value=0.0)
+class TestTokenBucket:
+
+    def test_burst_then_paced(self, monotonic:MagicMock):
+        bucket = TokenBucket(rate=10, burst=2)
+        assert_that([bucket.reserve() for _ in range(4)]).is_equal_to([0.0, 0.0, 0.1, 0.2])
+
+    def test_refills_up_to_burst(self, monotonic:MagicMock):
+        bucket = TokenBucket(rate=10, burst=2)
+        bucket.reserve()
+        bucket.reserve()
+        monotonic.return_value = 60.0
+        assert_that([bucket.reserve() for _ in range(3)]).is_equal_to([0.0, 0.0, 0.1])
+
+    def test_rejects_non_positive_rate(self, monotonic:MagicMock):
+        assert_that(TokenBucket).raises(ValueError).when_called_with(0).contains("rate")
+
+class TestKeyedTurns:
+
+    def test_same_key_runs_in_arrival_order(self):
+        turns = KeyedTurns()
+        order = []
+        first_inside = Event()
+        release = Event()
+
+        def first():
+            with turns.turn("+12222222222"):
+                first_inside.set()
+                release.wait(5)
+                order.append("first")
+
+        def second():
+            with turns.turn("+12222222222"):
+                order.append("second")
+
+        threads = [Thread(target=first)]
+        threads[0].start()
+        first_inside.wait(5)
+        threads.append(Thread(target=second))
+        threads[1].start()
+        with turns.turn("+13333333333"):
+            order.append("other")
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        assert_that(order).is_equal_to(["other", "first", "second"])
+        assert_that(turns).is_empty()
+
+    def test_async_same_key_runs_in_arrival_order(self):
+        turns = KeyedTurns()
+        order = []
+
+        async def send(key:str, name:str, delay:float):
+            async with turns.async_turn(key):
+                await async_sleep(delay)
+                order.append(name)
+
+        async def scenario():
+            await gather(send("a", "a1", 0.02), send("a", "a2", 0), send("b", "b1", 0))
+
+        run(scenario())
+        assert_that(order).is_equal_to(["b1", "a1", "a2"])
+        assert_that(turns).is_empty()
@@ -1,19 +1,136 @@
 """
 Tests for the twilio client usage
 """
-from unittest.mock import patch, MagicMock, call
-from reminder.third_party_interfaces import send_sms
+from asyncio import run
+from unittest.mock import patch, MagicMock, AsyncMock, call, ANY
+from assertpy import assert_that
+from reminder.third_party_interfaces import send_sms, get_twilio_client, open_twilio_session, \
+                                            async_send_sms, SmsSender, \
+                                            get_sms_sender
 
 # pylint: disable=unused-argument
 # pylint: disable=missing-function-docstring
 # pylint: disable=missing-class-docstring
+# pylint: disable=protected-access
 
-@patch("reminder.third_party_interfaces.twilio_client.Client")
+@patch("twilio.rest.Client")
 def test_send_sms(client:MagicMock):
     from_number = '+19999999999'
     to_number = "+12222222222"
     message = "message"
     send_sms(to_number, message)
-    client.assert_has_calls([call('ABC', 'DEF'), call().messages.create(body=message,
-                                                                        from_=from_number,
-                                                                        to=to_number)])
+    client.assert_has_calls([call('ABC', 'DEF', http_client=ANY),
+                             call().messages.create(body=message,
+                                                    from_=from_number,
+                                                    to=to_number)])
+
+@patch.dict("os.environ", {"TWILIO_STATUS_CALLBACK": "https://localhost/sms_status"})
+@patch("twilio.rest.Client")
+def test_send_sms_requests_status_callback(client:MagicMock):
+    send_sms("+12222222222", "message")
+    client.return_value.messages.create.assert_called_once_with(
+        body="message", from_='+19999999999', to="+12222222222",
+        status_callback="https://localhost/sms_status")
+
+@patch("twilio.rest.Client")
+def test_send_sms_reuses_client(client:MagicMock):
+    send_sms("+12222222222", "first")
+    send_sms("+13333333333", "second")
+    client.assert_called_once()
+    assert_that(client.return_value.messages.create.call_count).is_equal_to(2)
+
+@patch.dict("os.environ", {"TWILIO_POOL_SIZE": "3", "TWILIO_TIMEOUT": "2.5"})
+@patch("twilio.rest.Client")
+def test_twilio_client_uses_pooled_session(client:MagicMock):
+    get_twilio_client()
+    http_client = client.call_args.kwargs["http_client"]
+    assert_that(http_client.timeout).is_equal_to(2.5)
+    assert_that(http_client.session).is_not_none()
+    assert_that(http_client.session.get_adapter("https://api.twilio.com")._pool_maxsize) \
+        .is_equal_to(3)
+
+@patch.dict("os.environ", {"TWILIO_POOL_SIZE": "0"})
+@patch("twilio.rest.Client")
+def test_twilio_client_rejects_empty_pool(client:MagicMock):
+    assert_that(get_twilio_client).raises(ValueError).when_called_with() \
+        .contains("TWILIO_POOL_SIZE")
+    client.assert_not_called()
+
+@patch.dict("os.environ", {"TWILIO_TIMEOUT": "-1"})
+@patch("twilio.rest.Client")
+def test_twilio_client_rejects_non_positive_timeout(client:MagicMock):
+    assert_that(get_twilio_client).raises(ValueError).when_called_with() \
+        .contains("TWILIO_TIMEOUT")
+    client.assert_not_called()
+
+@patch("twilio.rest.Client")
+def test_open_twilio_session(client:MagicMock):
+    http_client = client.return_value.http_client
+    open_twilio_session()
+    http_client.session.head.assert_called_once_with("https://api.twilio.com/",
+                                                     timeout=http_client.timeout)
+
+@patch("twilio.http.async_http_client.AsyncTwilioHttpClient")
+@patch("twilio.rest.Client")
+def test_async_send_sms(client:MagicMock, http_client:MagicMock):
+    client.return_value.messages.create_async = AsyncMock()
+    run(async_send_sms("+12222222222", "message"))
+    run(async_send_sms("+13333333333", "message"))
+    client.assert_called_once_with('ABC', 'DEF', http_client=http_client.return_value)
+    client.return_value.messages.create_async.assert_awaited_with(
+        body="message", from_='+19999999999', to="+13333333333")
+
+class _TwilioError(Exception):
+    def __init__(self, status:int) -> None:
+        super().__init__(f"HTTP {status}")
+        self.status = status
+
+@patch("reminder.third_party_interfaces.twilio_client.uniform", side_effect=lambda low, high: high)
+@patch("reminder.third_party_interfaces.twilio_client.sleep")
+class TestSmsSender:
+
+    def test_retries_throttled_and_server_errors(self, sleep:MagicMock, uniform:MagicMock):
+        create = MagicMock(side_effect=[_TwilioError(429), _TwilioError(503), "sent"])
+        sender = SmsSender(100, max_attempts=4, backoff=0.5)
+        assert_that(sender.send("+12222222222", create)).is_equal_to("sent")
+        assert_that(create.call_count).is_equal_to(3)
+        assert_that([delay for delay in (c.args[0] for c in sleep.call_args_list) if delay]) \
+            .is_equal_to([0.5, 1.0])
+
+    def test_gives_up_after_max_attempts(self, sleep:MagicMock, uniform:MagicMock):
+        create = MagicMock(side_effect=_TwilioError(500))
+        sender = SmsSender(100, max_attempts=3)
+        assert_that(sender.send).raises(_TwilioError).when_called_with("+12222222222", create)
+        assert_that(create.call_count).is_equal_to(3)
+
+    def test_client_errors_are_not_retried(self, sleep:MagicMock, uniform:MagicMock):
+        create = MagicMock(side_effect=_TwilioError(400))
+        sender = SmsSender(100)
+        assert_that(sender.send).raises(_TwilioError).when_called_with("+12222222222", create)
+        create.assert_called_once()
+        uniform.assert_not_called()
+
+    def test_waits_for_the_rate_limit(self, sleep:MagicMock, uniform:MagicMock):
+        with patch("reminder.third_party_interfaces.throttle.monotonic", return_value=100.0):
+            sender = SmsSender(2, burst=1)
+            sender.send("+12222222222", MagicMock())
+            sender.send("+13333333333", MagicMock())
+        assert_that([c.args[0] for c in sleep.call_args_list]).is_equal_to([0.0, 0.5])
+
+    def test_async_send_retries(self, sleep:MagicMock, uniform:MagicMock):
+        create = AsyncMock(side_effect=[_TwilioError(429), "sent"])
+        sender = SmsSender(100, backoff=0)
+        assert_that(run(sender.async_send("+12222222222", create))).is_equal_to("sent")
+        assert_that(create.await_count).is_equal_to(2)
+        sleep.assert_not_called()
+
+@patch.dict("os.environ", {"TWILIO_RATE": "5", "TWILIO_MAX_ATTEMPTS": "2"})
+@patch("reminder.third_party_interfaces.twilio_client.sleep")
+@patch("twilio.rest.Client")
+def test_send_sms_retries_through_shared_sender(client:MagicMock, sleep:MagicMock):
+    create = client.return_value.messages.create
+    create.side_effect = [_TwilioError(429), None]
+    send_sms("+12222222222", "message")
+    assert_that(create.call_count).is_equal_to(2)
+    assert_that(get_sms_sender().max_attempts).is_equal_to(2)
+    assert_that(get_sms_sender()._bucket.rate).is_equal_to(5)
@@ -0,0 +1,98 @@
+"""
+Tests for the request-scoped unit of work
+"""
+from unittest.mock import patch, MagicMock
+from assertpy import assert_that
+from google.cloud.exceptions import NotFound
+
+from reminder.third_party_interfaces import MemoryBackend, UnitOfWork, WriteConflict, \
+                                            current_unit_of_work, get_document, \
+                                            open_unit_of_work, reminder_is_active, \
+                                            unit_of_work, update_document
+
+# pylint: disable=unused-argument
+# pylint: disable=missing-function-docstring
+# pylint: disable=missing-class-docstring
+
+def _backend() -> MagicMock:
+    backend = MemoryBackend()
+    backend.set_document("reminders", "123", {"status": "active"})
+    backend.set_document("123", "+11111111111", {"name": "Brian"})
+    return MagicMock(wraps=backend)
+
+def test_reads_prefetched_together_and_cached():
+    backend = _backend()
+    work = UnitOfWork(backend, [("123", "+11111111111"), ("reminders", "123")])
+    assert_that(work.get_document("reminders", "123")).is_equal_to({"status": "active"})
+    assert_that(work.get_document("123", "+11111111111")).is_equal_to({"name": "Brian"})
+    assert_that(work.get_document("123", "+11111111111")).is_equal_to({"name": "Brian"})
+    backend.get_documents.assert_called_once_with([("123", "+11111111111"),
+                                                   ("reminders", "123")])
+    backend.get_document.assert_not_called()
+
+def test_writes_coalesced_into_one_commit():
+    backend = _backend()
+    work = UnitOfWork(backend)
+    work.update_document("123", "+11111111111", {"last_response": "No"})
+    work.write_documents([("123", "+11111111111", {"last_attempted": 1}),
+                          ("reminders", "123", {"status": "inactive"})])
+    assert_that(work.get_document("123", "+11111111111")) \
+        .is_equal_to({"name": "Brian", "last_response": "No", "last_attempted": 1})
+    assert_that(backend.get_document("reminders", "123")).is_equal_to({"status": "active"})
+
+    work.commit()
+    backend.commit_documents.assert_called_once()
+    assert_that(backend.commit_documents.call_args.args[0]).is_equal_to(
+        [("123", "+11111111111", {"last_response": "No", "last_attempted": 1}),
+         ("reminders", "123", {"status": "inactive"})])
+    assert_that(backend.get_document("reminders", "123")).is_equal_to({"status": "inactive"})
+
+def test_update_of_missing_document():
+    work = UnitOfWork(_backend())
+    assert_that(work.update_document).raises(NotFound).when_called_with("123", "a", {})
+
+def test_conflict_writes_nothing():
+    backend = _backend()
+    work = UnitOfWork(backend)
+    callback = MagicMock()
+    work.update_document("123", "+11111111111", {"last_response": "No"})
+    work.after_commit(callback, "sent")
+    backend.update_document("123", "+11111111111", {"last_response": "Yes"})
+
+    assert_that(work.commit).raises(WriteConflict).when_called_with()
+    assert_that(backend.get_document("123", "+11111111111")) \
+        .is_equal_to({"name": "Brian", "last_response": "Yes"})
+    callback.assert_not_called()
+
+def test_after_commit_runs_in_order_outside_the_unit():
+    calls = []
+    with unit_of_work(_backend()) as work:
+        work.after_commit(lambda name: calls.append((name, current_unit_of_work())), "first")
+        work.after_commit(lambda name: calls.append((name, current_unit_of_work())), "second")
+        assert_that(calls).is_empty()
+    assert_that(calls).is_equal_to([("first", None), ("second", None)])
+
+@patch("reminder.third_party_interfaces.backend.get_backend")
+def test_storage_functions_routed_through_open_unit(get_backend:MagicMock):
+    backend = get_backend.return_value = _backend()
+    with open_unit_of_work([("123", "+11111111111")]):
+        assert_that(reminder_is_active("123")).is_true()
+        update_document("reminders", "123", {"status": "inactive"})
+        assert_that(get_document("reminders", "123")).is_equal_to({"status": "inactive"})
+        assert_that(backend.get_document("reminders", "123")).is_equal_to({"status": "active"})
+    assert_that(get_document("reminders", "123")).is_equal_to({"status": "inactive"})
+    backend.get_documents.assert_called_once()
+
+@patch("reminder.third_party_interfaces.backend.get_backend")
+def test_error_discards_the_unit(get_backend:MagicMock):
+    backend = get_backend.return_value = _backend()
+    callback = MagicMock()
+    def handle():
+        with open_unit_of_work() as work:
+            update_document("reminders", "123", {"status": "inactive"})
+            work.after_commit(callback)
+            raise KeyError("User not found")
+    assert_that(handle).raises(KeyError).when_called_with()
+    assert_that(current_unit_of_work()).is_none()
+    assert_that(backend.get_document("reminders", "123")).is_equal_to({"status": "active"})
+    callback.assert_not_called()
@@ -0,0 +1,95 @@
+"""
+Rate limiting and ordering primitives for outgoing API calls
+"""
+from asyncio import Lock as AsyncLock
+from contextlib import asynccontextmanager, contextmanager
+from threading import Condition, Lock
+from time import monotonic
+from typing import Hashable
+
+class TokenBucket:  # pylint: disable=too-few-public-methods
+    """
+    Thread-safe token bucket refilled at rate tokens per second up to burst tokens.
+    Callers reserve a token and wait the returned delay, so the limit holds for
+    threads and event loops alike and callers are served in the order they reserved.
+    """
+    def __init__(self, rate:float, burst:float = None) -> None:
+        if rate <= 0:
+            raise ValueError(f"rate must be greater than 0, got {rate}")
+        self.rate = rate
+        self.burst = max(1.0, burst if burst is not None else rate)
+        self._tokens = self.burst
+        self._updated = monotonic()
+        self._lock = Lock()
+
+    def reserve(self) -> float:
+        """
+        Take a token and return how many seconds to wait before using it
+        """
+        with self._lock:
+            now = monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0.0, -self._tokens / self.rate)
+
+class _Turns:  # pylint: disable=too-few-public-methods
+    def __init__(self, condition:Condition) -> None:
+        self.condition = condition
+        self.issued = 0
+        self.serving = 0
+
+class KeyedTurns:
+    """
+    Lets callers sharing a key through one at a time, in the order they arrived.
+    Callers with different keys never wait on each other.
+    """
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._turns = {}
+        self._async_turns = {}
+
+    @contextmanager
+    def turn(self, key:Hashable):
+        """
+        Block until every earlier caller with the same key has finished
+        """
+        with self._lock:
+            turns = self._turns.get(key)
+            if turns is None:
+                turns = self._turns[key] = _Turns(Condition(self._lock))
+            ticket = turns.issued
+            turns.issued += 1
+            turns.condition.wait_for(lambda: turns.serving == ticket)
+        try:
+            yield
+        finally:
+            with self._lock:
+                turns.serving += 1
+                if turns.serving == turns.issued:
+                    del self._turns[key]
+                else:
+                    turns.condition.notify_all()
+
+    @asynccontextmanager
+    async def async_turn(self, key:Hashable):
+        """
+        Wait until every earlier coroutine with the same key has finished.
+        asyncio locks wake their waiters in order.
+        """
+        lock, users = self._async_turns.get(key, (None, 0))
+        if lock is None:
+            lock = AsyncLock()
+        self._async_turns[key] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._async_turns[key]
+            if users == 1:
+                del self._async_turns[key]
+            else:
+                self._async_turns[key] = (lock, users - 1)
+
+    def __len__(self) -> int:
+        return len(self._turns) + len(self._async_turns)
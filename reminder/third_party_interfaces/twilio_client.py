@@ -1,20 +1,219 @@
 """
 All twilio interface API calls
 """
+from asyncio import sleep as async_sleep
 from os import environ
-from twilio.rest import Client
+from random import uniform
+from time import sleep
+from typing import TYPE_CHECKING, Any, Awaitable, Callable
+import logging
 
+from .metrics import timed
+from .shared import SharedInstance
+from .throttle import KeyedTurns, TokenBucket
+
+if TYPE_CHECKING:
+    from twilio.rest import Client
+
+def _create_client() -> "Client":
+    # Imported on the first message so cold starts that never send skip the twilio SDK
+    # pylint: disable=import-outside-toplevel
+    from requests.adapters import HTTPAdapter
+    from twilio.http.http_client import TwilioHttpClient
+    from twilio.rest import Client
+
+    pool_size = int(environ.get("TWILIO_POOL_SIZE", "8"))
+    if pool_size < 1:
+        raise ValueError(f"TWILIO_POOL_SIZE must be at least 1, got {pool_size}")
+    timeout = float(environ.get("TWILIO_TIMEOUT", "10"))
+    if timeout <= 0:
+        raise ValueError(f"TWILIO_TIMEOUT must be greater than 0, got {timeout}")
+
+    http_client = TwilioHttpClient(pool_connections=True, timeout=timeout)
+    # Replaces the adapter TwilioHttpClient mounts with its default
+    # min(32, cpu + 4) pool so the pool matches the configured size
+    http_client.session.mount("https://", HTTPAdapter(pool_connections=1,
+                                                      pool_maxsize=pool_size))
+    return Client(environ['TWILIO_ACCOUNT_SID'], environ['TWILIO_AUTH_TOKEN'],
+                  http_client=http_client)
+
+_CLIENT = SharedInstance(_create_client)
+
+def get_twilio_client() -> "Client":
+    """
+    Return the process-wide twilio client, creating it on first use.
+    The client keeps a pooled keep-alive HTTP session, sized by TWILIO_POOL_SIZE
+    and bounded by TWILIO_TIMEOUT seconds, that is reused across messages and threads.
+    """
+    return _CLIENT.get()
+
+@timed
+def open_twilio_session() -> None:
+    """
+    Create the twilio client and open a pooled TLS connection to the API,
+    so the first message does not pay for the handshake
+    """
+    http_client = get_twilio_client().http_client
+    http_client.session.head("https://api.twilio.com/", timeout=http_client.timeout)
+
+def reset_twilio_client() -> None:
+    """
+    Drop the shared twilio client so the next message creates a new one.
+    Used by tests; forked children reset it automatically.
+    """
+    _CLIENT.reset()
+
+def validate_twilio_request(url:str, params:dict, signature:str) -> bool:
+    """
+    Check that a webhook request was signed by twilio with TWILIO_AUTH_TOKEN.
+    url must be the https url twilio called, including any query string.
+    """
+    # pylint: disable=import-outside-toplevel
+    from twilio.request_validator import RequestValidator
+    return RequestValidator(environ['TWILIO_AUTH_TOKEN']).validate(url, params, signature)
+
+def _status_callback() -> dict:
+    """
+    Ask twilio to report delivery states to TWILIO_STATUS_CALLBACK when it is set
+    """
+    url = environ.get("TWILIO_STATUS_CALLBACK")
+    return {"status_callback": url} if url else {}
+
+def _retryable(error:Exception) -> bool:
+    """
+    True for twilio responses worth retrying: too many requests and server errors
+    """
+    status = getattr(error, "status", None)
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+class SmsSender:
+    """
+    Sends messages through a token bucket shared by every thread and event loop,
+    so bursts stay under the account's rate. Responses of 429 and 5xx are retried
+    with full jitter exponential backoff up to max_attempts. Messages to the same
+    phone number go out one at a time in the order they were sent, retries included.
+    """
+    def __init__(self, rate:float, burst:float = None, max_attempts:int = 4,
+                 backoff:float = 0.5, max_backoff:float = 30.0) -> None:
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._bucket = TokenBucket(rate, burst)
+        self._turns = KeyedTurns()
+
+    def _delay(self, attempt:int) -> float:
+        return uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    def _retry_delay(self, error:Exception, phone_number:str, attempt:int) -> float:
+        """
+        Seconds to wait before retrying, re-raising errors that should not be retried
+        """
+        if attempt >= self.max_attempts or not _retryable(error):
+            raise error
+        delay = self._delay(attempt)
+        logging.warning("Twilio returned %s sending to %s, retrying in %.2fs",
+                        error.status, phone_number, delay)
+        return delay
+
+    def send(self, phone_number:str, create:Callable[[], Any]) -> Any:
+        """
+        Call create, which sends one message to phone_number, within the rate limit
+        """
+        with self._turns.turn(phone_number):
+            for attempt in range(1, self.max_attempts + 1):
+                sleep(self._bucket.reserve())
+                try:
+                    return create()
+                except Exception as error:  # pylint: disable=broad-exception-caught
+                    sleep(self._retry_delay(error, phone_number, attempt))
+        return None
+
+    async def async_send(self, phone_number:str, create:Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Await create, which sends one message to phone_number, within the rate limit
+        """
+        async with self._turns.async_turn(phone_number):
+            for attempt in range(1, self.max_attempts + 1):
+                await async_sleep(self._bucket.reserve())
+                try:
+                    return await create()
+                except Exception as error:  # pylint: disable=broad-exception-caught
+                    await async_sleep(self._retry_delay(error, phone_number, attempt))
+        return None
+
+def _create_sender() -> SmsSender:
+    rate = float(environ.get("TWILIO_RATE", "10"))
+    return SmsSender(rate, float(environ.get("TWILIO_BURST", str(rate))),
+                     max_attempts=int(environ.get("TWILIO_MAX_ATTEMPTS", "4")),
+                     backoff=float(environ.get("TWILIO_BACKOFF", "0.5")))
+
+_SENDER = SharedInstance(_create_sender)
+
+def get_sms_sender() -> SmsSender:
+    """
+    Return the process-wide sender, limited to TWILIO_RATE messages per second
+    with bursts of up to TWILIO_BURST, to match the account's throughput tier
+    """
+    return _SENDER.get()
+
+def reset_sms_sender() -> None:
+    """
+    Drop the shared sender and its rate limit state. Used by tests.
+    """
+    _SENDER.reset()
+
+@timed
 def send_sms(phone_number: str, message: str):
     """
     Send sms message to provided phone number
-    uses environment variables for authentication and from number
+    uses environment variables for authentication and from number,
+    and for the delivery status callback url when one is set
+    """
+    client = get_twilio_client()
+
+    get_sms_sender().send(phone_number, lambda: client.messages.create(
+        body=message,
+        from_=environ['TWILIO_PHONE_NUMBER'],
+        to=phone_number,
+        **_status_callback()
+    ))
+
+def _create_async_client() -> "Client":
+    # pylint: disable=import-outside-toplevel
+    from twilio.http.async_http_client import AsyncTwilioHttpClient
+    from twilio.rest import Client
+
+    timeout = float(environ.get("TWILIO_TIMEOUT", "10"))
+    if timeout <= 0:
+        raise ValueError(f"TWILIO_TIMEOUT must be greater than 0, got {timeout}")
+    return Client(environ['TWILIO_ACCOUNT_SID'], environ['TWILIO_AUTH_TOKEN'],
+                  http_client=AsyncTwilioHttpClient(timeout=timeout))
+
+_ASYNC_CLIENT = SharedInstance(_create_async_client)
+
+def get_async_twilio_client() -> "Client":
+    """
+    Return the process-wide twilio client for async sends, creating it on first use.
+    Its aiohttp session is bound to the event loop it is first used on.
+    """
+    return _ASYNC_CLIENT.get()
+
+def reset_async_twilio_client() -> None:
+    """
+    Drop the shared async twilio client so the next message creates a new one
+    """
+    _ASYNC_CLIENT.reset()
+
+@timed
+async def async_send_sms(phone_number: str, message: str):
+    """
+    Send sms message to provided phone number without blocking the event loop
     """
-    account_sid = environ['TWILIO_ACCOUNT_SID']
-    auth_token = environ['TWILIO_AUTH_TOKEN']
-    client = Client(account_sid, auth_token)
+    client = get_async_twilio_client()
 
-    client.messages.create(
+    await get_sms_sender().async_send(phone_number, lambda: client.messages.create_async(
         body=message,
         from_=environ['TWILIO_PHONE_NUMBER'],
-        to=phone_number
-    )
+        to=phone_number,
+        **_status_callback()
+    ))
@@ -0,0 +1,132 @@
+"""
+Request-scoped unit of work. While one is open, the storage functions read documents
+through it, in one batched read for everything the request is known to need, and
+keep their writes until the unit commits them together in one batch.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from copy import deepcopy
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+from google.cloud.exceptions import NotFound
+
+from .storage import Record, StorageBackend
+
+class WriteConflict(Exception):
+    """
+    A document the unit read was changed by someone else before the unit committed
+    """
+
+class UnitOfWork(StorageBackend):  # pylint: disable=too-many-public-methods
+    """
+    Storage backend over another one for the length of a request. The first read
+    fetches the prefetch keys with it in one batch, and every document read is kept,
+    so the rotation operations built on the document primitives read each document
+    at most once. Updates and batched writes are coalesced per document and committed
+    together, only if the documents they change were not changed since they were read.
+    Single document sets, creates, deletes and streams go straight to the backend.
+    """
+    def __init__(self, backend:StorageBackend,
+                 prefetch:Iterable[tuple[str, str]] = ()) -> None:
+        super().__init__()
+        self._backend = backend
+        self._prefetch = list(prefetch)
+        self._read = {}
+        self._documents = {}
+        self._writes = {}
+        self._after_commit = []
+
+    def _fetch(self, keys:list[tuple[str, str]]) -> None:
+        wanted = list(dict.fromkeys(key for key in self._prefetch + keys
+                                    if key not in self._documents))
+        self._prefetch = []
+        for key, record in self._backend.get_documents(wanted).items():
+            self._read[key] = record
+            document = record.to_dict()
+            if key in self._writes:
+                pending = self._writes[key]
+                document = None if pending is None else {**(document or {}), **pending}
+            self._documents[key] = document
+
+    def get_documents(self, keys:list[tuple[str, str]]) -> dict[tuple[str, str], Record]:
+        missing = [key for key in keys if key not in self._documents]
+        if missing:
+            self._fetch(missing)
+        return {key: Record(key[1], self._documents[key]) for key in keys}
+
+    def get_document(self, collection:str, document_id:str) -> Optional[dict]:
+        return self.get_documents([(collection, document_id)])[(collection, document_id)] \
+            .to_dict()
+
+    def update_document(self, collection:str, document_id:str, data:dict) -> None:
+        if self.get_document(collection, document_id) is None:
+            raise NotFound(f"No document to update: {collection}/{document_id}")
+        self.write_documents([(collection, document_id, data)])
+
+    def write_documents(self, writes:list[tuple[str, str, Optional[dict]]]) -> None:
+        for collection, document_id, data in writes:
+            key = (collection, document_id)
+            if data is None:
+                self._writes[key] = None
+                self._documents[key] = None
+                continue
+            self._writes[key] = {**(self._writes.get(key) or {}), **deepcopy(data)}
+            if key in self._documents:
+                self._documents[key] = {**(self._documents[key] or {}), **deepcopy(data)}
+
+    def set_document(self, collection:str, document_id:str, data:dict,
+                     merge:bool = False) -> None:
+        self._backend.set_document(collection, document_id, data, merge)
+
+    def create_document(self, collection:str, document_id:str, data:dict) -> bool:
+        return self._backend.create_document(collection, document_id, data)
+
+    def delete_document(self, collection:str, document_id:str) -> None:
+        self._backend.delete_document(collection, document_id)
+
+    def stream_documents(self, collection:str) -> Iterator[Record]:
+        return self._backend.stream_documents(collection)
+
+    def after_commit(self, callback:Callable[..., Any], *args) -> None:
+        """
+        Run callback once the writes are committed, and never if they are not
+        """
+        self._after_commit.append((callback, args))
+
+    def commit(self) -> None:
+        """
+        Commit the writes in one batch, then run the after commit callbacks
+
+        raises WriteConflict: if a document was changed since the unit read it;
+        nothing was written
+        """
+        writes = [(*key, data) for key, data in self._writes.items()]
+        if writes and not self._backend.commit_documents(writes, self._read):
+            raise WriteConflict(f"{', '.join('/'.join(key) for key in self._writes)} "
+                                "changed while the request was handled")
+        self._writes = {}
+        callbacks, self._after_commit = self._after_commit, []
+        for callback, args in callbacks:
+            callback(*args)
+
+_CURRENT = ContextVar("unit_of_work", default=None)
+
+def current_unit_of_work() -> Optional[UnitOfWork]:
+    """
+    The unit of work open in this context, if any
+    """
+    return _CURRENT.get()
+
+@contextmanager
+def unit_of_work(backend:StorageBackend, prefetch:Iterable[tuple[str, str]] = ()):
+    """
+    Route the storage functions through a new unit of work over backend, committing
+    it when the block finishes and dropping it if the block raises
+    """
+    work = UnitOfWork(backend, prefetch)
+    token = _CURRENT.set(work)
+    try:
+        yield work
+    finally:
+        _CURRENT.reset(token)
+    work.commit()
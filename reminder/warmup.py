@@ -0,0 +1,43 @@
+"""
+Warm-up for new instances. Opens the connections the first request would
+otherwise pay for: the firestore channel, Google's certificates and the twilio session.
+"""
+from os import environ
+from time import perf_counter
+from typing import Callable
+import logging
+
+from .third_party_interfaces import get_backend, prime_reminder_cache, fetch_certificates, \
+                                    open_twilio_session
+
+STEPS: list[tuple[str, Callable[[], object]]] = [
+    ("storage", get_backend),
+    ("reminders", prime_reminder_cache),
+    ("certificates", fetch_certificates),
+    ("twilio", open_twilio_session),
+]
+
+def warmup_enabled() -> bool:
+    """
+    True when WARMUP_ENABLED is set
+    """
+    return environ.get("WARMUP_ENABLED", "False") == "True"
+
+def warm_up() -> dict:
+    """
+    Run every warm-up step and return how long each took in milliseconds.
+    A failing step is logged without stopping the others, since the request that
+    needs it will retry anyway; the report holds timings only.
+    """
+    report = {"steps": {}}
+    for name, step in STEPS:
+        start = perf_counter()
+        try:
+            step()
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            logging.warning("Warm-up step %s failed: %s", name, error)
+        report["steps"][name] = round((perf_counter() - start) * 1000, 3)
+
+    report["total"] = round(sum(report["steps"].values()), 3)
+    logging.info("Warm-up took %sms: %s", report["total"], report["steps"])
+    return report